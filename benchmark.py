@@ -0,0 +1,848 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmarks for the data pipeline and the model.
+Every benchmark is a sub-command, use 'python benchmark.py --help' to list them.
+"""
+import os
+import time
+import argparse
+import logging
+
+from utilities import low_level_cornell
+
+#Sizes of the random model used by the model benchmarks.
+BENCH_DICT_SIZE = 5000
+BENCH_PHRASE_LEN = 10
+
+log = logging.getLogger("bench")
+
+
+def timed(func, *args, **kwargs):
+    """
+    Calls the function and returns its result together with wall time in seconds.
+    """
+    start = time.perf_counter()
+    res = func(*args, **kwargs)
+    return res, time.perf_counter() - start
+
+
+def bench_tokenize(args):
+    """
+    Runs read_phrases with growing count of worker processes and checks
+    that every parallel run gives exactly the same dictionary as the serial one.
+    """
+    movies = None
+    if args.data:
+        movies = low_level_cornell.get_filtered_set(args.data_dir, args.data)
+    reference, serial_time = timed(low_level_cornell.read_phrases, args.data_dir, movies)
+    log.info("workers=1: %.2f s, %d phrases", serial_time, len(reference))
+    workers = 2
+    while workers <= args.max_workers:
+        res, took = timed(low_level_cornell.read_phrases, args.data_dir, movies, workers=workers)
+        assert res == reference, "Parallel result differs from serial one"
+        log.info("workers=%d: %.2f s, speed-up %.2fx", workers, took, serial_time / took)
+        workers *= 2
+
+
+def bench_parse(args):
+    """
+    Compares lines/sec of iterate_entries generator and bytes-level iterate_columns
+    on movie_lines.txt, extracting the three columns which read_phrases needs.
+    """
+    columns = (0, 2, 4)
+    reference, entries_time = timed(lambda: [tuple(e[c] for c in columns) for e in
+                                             low_level_cornell.iterate_entries(args.data_dir, "movie_lines.txt")])
+    res, columns_time = timed(lambda: list(low_level_cornell.iterate_columns(args.data_dir, "movie_lines.txt", columns)))
+    assert res == reference, "iterate_columns result differs from iterate_entries"
+    log.info("iterate_entries: %.0f lines/s", len(reference) / entries_time)
+    log.info("iterate_columns: %.0f lines/s, speed-up %.2fx", len(res) / columns_time, entries_time / columns_time)
+
+
+def bench_model_sizes(args):
+    """
+    Sizes of the benchmarked model as PhraseModel arguments, 0 in the options means the default of model.py.
+    """
+    import model
+
+    return dict(emb_size=args.emb_size or model.EMBEDDING_DIM, hid_size=args.hidden_size or model.HIDDEN_STATE_SIZE,
+                num_layers=args.layers or model.NUM_LAYERS)
+
+
+def make_bench_model(args):
+    """
+    Random PhraseModel of the size given by --hidden-size, --emb-size and --layers(defaults of model.py)
+    and a batch of random phrases(token IDs starting with #BEG).
+    Weights don't matter for timing, but #END(ID 2) is made unlikely so replies run to full length.
+    """
+    import torch
+    import model
+
+    torch.manual_seed(args.seed)
+    net = model.PhraseModel(dict_size=BENCH_DICT_SIZE, **bench_model_sizes(args))
+    with torch.no_grad():
+        net.output[0].bias[2] = -100.0
+    phrases = [[1] + torch.randint(3, BENCH_DICT_SIZE, (BENCH_PHRASE_LEN,)).tolist() + [2]
+               for _ in range(args.batch)]
+    return net, phrases
+
+
+def bench_decode(args):
+    """
+    Greedy decoding of a batch of phrases, one row at a time against decode_chain_argmax_batch().
+    """
+    import torch
+    import model
+
+    net, phrases = make_bench_model(args)
+    with torch.no_grad():
+        input_seq, phr, _ = model.pack_batch_no_out([(p, [1, 2]) for p in phrases], net.emb)
+        enc = net.encode(input_seq)
+        beg = net.emb(torch.LongTensor([1]))
+
+        def per_row():
+            return [net.decode_chain_argmax(net.get_encoded_item(enc, idx), beg, args.seq_len, stop_token=2)[1]
+                    for idx in range(len(phr))]
+
+        serial, serial_time = timed(per_row)
+        (_, batched), batch_time = timed(net.decode_chain_argmax_batch, enc, beg, args.seq_len, stop_token=2)
+    assert [list(map(int, t)) for t in serial] == batched, "Batched decoding differs"
+    log.info("per-row: %.3f s, batched: %.3f s, speed-up %.1fx for %d rows",
+             serial_time, batch_time, serial_time / batch_time, len(phr))
+
+
+def bench_beam(args):
+    """
+    Wall time of decode_beam() for a batch of phrases with growing beam width.
+    Beams are batched, so time should grow slower than the width. Width 1 has to match greedy decoding.
+    """
+    import torch
+    import model
+
+    net, phrases = make_bench_model(args)
+    with torch.no_grad():
+        input_seq, phr, _ = model.pack_batch_no_out([(p, [1, 2]) for p in phrases], net.emb)
+        enc = net.encode(input_seq)
+        beg = net.emb(torch.LongTensor([1]))
+        _, greedy = net.decode_chain_argmax_batch(enc, beg, args.seq_len, stop_token=2)
+        base_time = None
+        for width in args.widths:
+            (tokens, _), took = timed(net.decode_beam, enc, beg, args.seq_len, width, stop_token=2)
+            if width == 1:
+                assert tokens == greedy, "Beam of width 1 differs from greedy decoding"
+            base_time = base_time or took
+            log.info("beam %d: %.3f s, %.2fx of the first width", width, took, took / base_time)
+
+
+def bench_sessions(args):
+    """
+    Encoding cost of multi-turn conversations: ChatSession continuing from its stored state against
+    re-encoding the whole conversation every turn. Then many conversations go round-robin through
+    a SessionStore of args.capacity sessions for args.rounds turns to show memory stays bounded.
+    """
+    import torch
+    import model
+    import sessions
+
+    net, phrases = make_bench_model(args)
+    emb_dict = {"#BEG": 1, "#END": 2, "#UNK": 0}
+
+    with torch.no_grad():
+        def incremental():
+            session = sessions.ChatSession(net, emb_dict, {}, keep_context=True)
+            for tokens in phrases:
+                hid = session._encode(tokens, session.state)
+                session.state = session._encode(tokens, hid)
+            return session.state
+
+        def from_scratch():
+            history = []
+            for tokens in phrases:
+                history += tokens
+                #Without stored state every turn encodes the whole conversation again.
+                net.encode(model.pack_input(history, net.emb))
+                history += tokens
+            return net.encode(model.pack_input(history, net.emb))
+
+        state, inc_time = timed(incremental)
+        ref_state, full_time = timed(from_scratch)
+    assert torch.allclose(state[0], ref_state[0], atol=1e-4), "Incremental state differs"
+    log.info("%d turns: incremental %.3f s, re-encoding the conversation %.3f s, speed-up %.1fx",
+             len(phrases), inc_time, full_time, full_time / inc_time)
+
+    store = sessions.SessionStore(net, emb_dict, {}, capacity=args.capacity, keep_context=True)
+    #Every round gives one more turn to each conversation in turn, so sessions evicted
+    #in the previous round are created again.
+    for turn in range(args.rounds):
+        for idx in range(args.conversations):
+            session = store.get(idx)
+            with torch.no_grad():
+                session.state = session._encode(phrases[turn % len(phrases)], session.state)
+    state_bytes = sum(t.numel() * t.element_size() for t in next(iter(store.sessions.values())).state)
+    log.info("%d conversations of %d turns, %d sessions kept(%d evicted), %.1f MB of LSTM state",
+             args.conversations, args.rounds, len(store), store.evicted, len(store) * state_bytes / 2**20)
+
+
+def bench_softmax(args):
+    """
+    Forward and backward of the training loss and greedy prediction for decoder outputs of args.tokens
+    positions with the dense layer, dense layer with sampled softmax and the adaptive softmax.
+    """
+    import torch
+    import softmax
+
+    torch.manual_seed(args.seed)
+    hid_size = bench_model_sizes(args)["hid_size"]
+    hidden = torch.randn(args.tokens, hid_size)
+    #Frequency-ordered IDs, so targets follow the log-uniform distribution.
+    targets = softmax.log_uniform_sample(args.tokens, args.dict_size)
+    for name, mode, sampled in (("dense", "dense", 0), ("sampled %d" % args.sampled, "dense", args.sampled),
+                                ("adaptive", "adaptive", 0)):
+        output = softmax.make_output(mode, hid_size, args.dict_size)
+
+        def loss_step():
+            output.zero_grad()
+            loss_v = softmax.output_nll(output, hidden, targets, sampled) / args.tokens
+            loss_v.backward()
+            return loss_v.item()
+
+        loss_step()
+        loss, loss_time = timed(lambda: [loss_step() for _ in range(args.repeat)][-1])
+        with torch.no_grad():
+            _, predict_time = timed(lambda: [softmax.output_predict(output, hidden) for _ in range(args.repeat)])
+        params = sum(p.numel() for p in output.parameters())
+        log.info("%s: loss %.2f, train step %.1f ms, predict %.1f ms, %.1fM parameters", name, loss,
+                 loss_time / args.repeat * 1e3, predict_time / args.repeat * 1e3, params / 1e6)
+
+
+def bench_sampling(args):
+    """
+    Cost of drawing one token per row from logits [rows,dict_size]: softmax copied to NumPy and
+    np.random.choice for every row, as decode_chain_sampling() used to do, against model.sample_tokens()
+    with full, temperature, top-k and nucleus settings. Logits are random with args.scale deviation,
+    larger scale gives more peaked distributions with smaller nucleus, like a trained model has.
+    """
+    import numpy as np
+    import torch
+    import torch.nn.functional as F
+    import model
+
+    torch.manual_seed(args.seed)
+    #Replies are decoded without gradients, see sessions.ChatSession.
+    with torch.no_grad():
+        for rows in args.rows:
+            logits = torch.randn(rows, args.dict_size) * args.scale
+
+            def numpy_choice():
+                probs = F.softmax(logits, dim=1).data.cpu().numpy()
+                return [int(np.random.choice(probs.shape[1], p=row)) for row in probs]
+
+            _, base_time = timed(lambda: [numpy_choice() for _ in range(args.repeat)])
+            log.info("%d rows, NumPy full softmax: %.0f us/step", rows, base_time / args.repeat * 1e6)
+            for name, kwargs in (("full", {}), ("temperature 0.7", dict(temperature=0.7)),
+                                 ("top-k %d" % args.top_k, dict(top_k=args.top_k)),
+                                 ("top-p %.2f" % args.top_p, dict(top_p=args.top_p)),
+                                 ("top-k %d + top-p %.2f" % (args.top_k, args.top_p), dict(top_k=args.top_k, top_p=args.top_p))):
+                _, took = timed(lambda: [model.sample_tokens(logits, **kwargs) for _ in range(args.repeat)])
+                log.info("%d rows, %s: %.0f us/step, %.1fx faster", rows, name, took / args.repeat * 1e6, base_time / took)
+
+
+def bench_jit(args):
+    """
+    Per-reply latency of the eager model in a ChatSession against the TorchScript archive
+    of export.py loaded by scripted_model.py, greedy and sampling. Greedy replies have to match.
+    """
+    import tempfile
+    import export
+    import sessions
+    import scripted_model
+    from utilities import high_level_cornell
+
+    net, phrases = make_bench_model(args)
+    net.eval()
+    words = ["w%d" % idx for idx in range(BENCH_DICT_SIZE - 4)]
+    emb_dict = {high_level_cornell.UNKNOWN_TOKEN: 0, high_level_cornell.BEGIN_TOKEN: 1,
+                high_level_cornell.END_TOKEN: 2, "#PAD": 3}
+    emb_dict.update((w, idx + 4) for idx, w in enumerate(words))
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "model.pt")
+        export.export(net, emb_dict, path)
+        for sample in (False, True):
+            session = sessions.ChatSession(net, emb_dict, high_level_cornell.reverse_emb_dict(emb_dict),
+                                           use_sampling=sample)
+            bot = scripted_model.ScriptedChatbot(path, sample=sample)
+            bot.reply_tokens(phrases[0])
+            eager, eager_time = timed(lambda: [session.reply_tokens(p) for p in phrases])
+            scripted, jit_time = timed(lambda: [bot.reply_tokens(p) for p in phrases])
+            if not sample:
+                assert eager == scripted, "Scripted replies differ from eager ones"
+            tokens = sum(len(r) for r in eager)
+            log.info("%s: eager %.1f ms/reply, TorchScript %.1f ms/reply, speed-up %.2fx(%.1f tokens/reply)",
+                     "sampling" if sample else "greedy", eager_time / len(phrases) * 1e3,
+                     jit_time / len(phrases) * 1e3, eager_time / jit_time, tokens / len(phrases))
+
+
+def bench_numpy(args):
+    """
+    NumPy engine of numpy_model.py against the eager model in a ChatSession: per-reply latency of greedy
+    and sampling decoding, then cold start of a fresh interpreter which loads the model and replies once.
+    Greedy replies have to match.
+    """
+    import sys
+    import subprocess
+    import tempfile
+    import model
+    import export
+    import sessions
+    import numpy_model
+    from utilities import high_level_cornell
+
+    net, phrases = make_bench_model(args)
+    net.eval()
+    words = ["w%d" % idx for idx in range(BENCH_DICT_SIZE - 4)]
+    emb_dict = {high_level_cornell.UNKNOWN_TOKEN: 0, high_level_cornell.BEGIN_TOKEN: 1,
+                high_level_cornell.END_TOKEN: 2, "#PAD": 3}
+    emb_dict.update((w, idx + 4) for idx, w in enumerate(words))
+    with tempfile.TemporaryDirectory() as tmp:
+        npz_path = os.path.join(tmp, "model.npz")
+        export.export_npz(net, emb_dict, npz_path)
+        npm = numpy_model.NumpyPhraseModel(npz_path)
+        for sample in (False, True):
+            session = sessions.ChatSession(net, emb_dict, high_level_cornell.reverse_emb_dict(emb_dict),
+                                           use_sampling=sample)
+            npm.reply_tokens(phrases[0], sample=sample)
+            eager, eager_time = timed(lambda: [session.reply_tokens(p) for p in phrases])
+            replies, np_time = timed(lambda: [npm.reply_tokens(p, sample=sample) for p in phrases])
+            if not sample:
+                assert eager == replies, "NumPy replies differ from eager ones"
+            tokens = sum(len(r) for r in eager)
+            log.info("%s: eager %.1f ms/reply, NumPy %.1f ms/reply, speed-up %.2fx(%.1f tokens/reply)",
+                     "sampling" if sample else "greedy", eager_time / len(phrases) * 1e3,
+                     np_time / len(phrases) * 1e3, eager_time / np_time, tokens / len(phrases))
+
+        #The torch side loads a checkpoint like use_model.py does.
+        pt_path = os.path.join(tmp, "model.dat")
+        model.save_checkpoint(net, pt_path, emb_dict)
+        phrase = phrases[0]
+        scripts = {
+            "torch": "import model, sessions\n"
+                     "net = model.load_checkpoint(%r)\n"
+                     "sessions.ChatSession(net, {'#END': 2}, {}).reply_tokens(%r)\n" % (pt_path, phrase),
+            "numpy": "import numpy_model\n"
+                     "numpy_model.NumpyPhraseModel(%r).reply_tokens(%r)\n" % (npz_path, phrase),
+        }
+        env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.abspath(__file__)))
+        for name, script in scripts.items():
+            took = []
+            for _ in range(args.starts):
+                _, t = timed(subprocess.run, [sys.executable, "-c", script], env=env, check=True)
+                took.append(t)
+            log.info("%s: cold start and first reply %.2f s(best of %d)", name, min(took), args.starts)
+
+
+def state_size(net):
+    """
+    Bytes of the serialized state_dict of the model.
+    """
+    import io
+    import torch
+
+    buf = io.BytesIO()
+    torch.save(net.state_dict(), buf)
+    return buf.tell()
+
+
+def bench_quantize(args):
+    """
+    Trained model against its int8 dynamically quantized copy on the held-out split of split_train_test():
+    BLEU drift of greedy replies(train_crossent.run_test()), share of replies which changed,
+    per-reply latency and size of the weights.
+    """
+    import numpy as np
+    import torch
+    import model
+    import sessions
+    import train_crossent
+    from utilities import high_level_cornell, vocabulary
+
+    emb_dict = high_level_cornell.load_emb_dict(os.path.dirname(args.model))
+    net = model.load_checkpoint(args.model, emb_dict, output=args.output)
+    net.eval()
+    qnet = model.quantize_dynamic(net)
+
+    #The same shuffle and split as the training scripts do.
+    data, data_dict = high_level_cornell.load_encoded_data(genre_filter=args.data)
+    if vocabulary.fingerprint(data_dict) != vocabulary.fingerprint(emb_dict):
+        raise ValueError("Model %s wasn't trained on genre %r, its dictionary differs" % (args.model, args.data))
+    data.shuffle(np.random.RandomState(high_level_cornell.SHUFFLE_SEED))
+    _, test_data = high_level_cornell.split_train_test(data)
+    end_token = emb_dict[high_level_cornell.END_TOKEN]
+    with torch.no_grad():
+        bleu, fp32_time = timed(train_crossent.run_test, test_data, net, end_token)
+        qbleu, int8_time = timed(train_crossent.run_test, test_data, qnet, end_token)
+    log.info("%d test pairs: BLEU fp32 %.4f, int8 %.4f, drift %+.4f; batched test %.2f s -> %.2f s",
+             len(test_data), bleu, qbleu, qbleu - bleu, fp32_time, int8_time)
+
+    rev_emb_dict = high_level_cornell.reverse_emb_dict(emb_dict)
+    phrases = [p for p, _ in test_data[:args.replies]]
+    session = sessions.ChatSession(net, emb_dict, rev_emb_dict)
+    qsession = sessions.ChatSession(qnet, emb_dict, rev_emb_dict)
+    replies, fp32_time = timed(lambda: [session.reply_tokens(p) for p in phrases])
+    qreplies, int8_time = timed(lambda: [qsession.reply_tokens(p) for p in phrases])
+    changed = sum(r != q for r, q in zip(replies, qreplies))
+    log.info("%d replies: %.1f ms/reply fp32, %.1f ms/reply int8, speed-up %.2fx, %d replies changed",
+             len(phrases), fp32_time / len(phrases) * 1e3, int8_time / len(phrases) * 1e3,
+             fp32_time / int8_time, changed)
+    log.info("Weights: fp32 %.1f MB, int8 %.1f MB", state_size(net) / 2**20, state_size(qnet) / 2**20)
+
+
+def decode_argmax_host_sync(net, hid, begin_emb, seq_len, stop_token):
+    """
+    Greedy decoding of one row as decode_chain_argmax() did it before decode_chain_device():
+    two torch.max() calls and a copy of the token to host every step.
+    """
+    import torch
+
+    out_logits = []
+    out_tokens = []
+    curr_emb = begin_emb
+    for _ in range(seq_len):
+        logits, hid = net.decode_one(hid, curr_emb)
+        token = torch.max(logits, dim=1)[1].data.cpu().numpy()[0]
+        curr_emb = net.emb(torch.max(logits, dim=1)[1])
+        out_logits.append(logits)
+        out_tokens.append(token)
+        if token == stop_token:
+            break
+    return torch.cat(out_logits), out_tokens
+
+
+def decode_sampling_host_sync(net, hid, begin_emb, seq_len, stop_token):
+    """
+    Sampling of one row as decode_chain_sampling() did it before: softmax copied to NumPy every step.
+    """
+    import numpy as np
+    import torch
+    import torch.nn.functional as F
+
+    out_logits = []
+    out_actions = []
+    curr_emb = begin_emb
+    for _ in range(seq_len):
+        logits, hid = net.decode_one(hid, curr_emb)
+        token_probs = F.softmax(logits, dim=1).data.cpu().numpy()[0]
+        action = int(np.random.choice(token_probs.shape[0], p=token_probs))
+        curr_emb = net.emb(torch.LongTensor([action]).to(begin_emb.device))
+        out_logits.append(logits)
+        out_actions.append(action)
+        if action == stop_token:
+            break
+    return torch.cat(out_logits), out_actions
+
+
+def bench_latency(args):
+    """
+    Per-token latency of single-row decoding, as use_model.py does it: the loop of the original code with
+    the token copied to host every step, decode_chain_argmax()/decode_chain_sampling(), which keep that on CPU,
+    and the device-resident decode_chain_device(), which they use on GPU. --cuda runs all of them on GPU.
+    """
+    import torch
+    import model
+
+    device = torch.device("cuda" if args.cuda else "cpu")
+    net, phrases = make_bench_model(args)
+    net.to(device)
+
+    def sync(res):
+        if args.cuda:
+            torch.cuda.synchronize()
+        return res
+
+    def device_chain(hid, sample):
+        logits, tokens, lens = net.decode_chain_device(hid, beg, args.seq_len, stop_token=2, sample=sample)
+        out_len = int(lens[0])
+        return logits[0, :out_len], tokens[0, :out_len].tolist()
+
+    with torch.no_grad():
+        input_seq, phr, _ = model.pack_batch_no_out([(p, [1, 2]) for p in phrases], net.emb, device)
+        enc = net.encode(input_seq)
+        beg = net.emb(torch.LongTensor([1]).to(device))
+        rows = [net.get_encoded_item(enc, idx) for idx in range(len(phr))]
+        for name, old, new, sample in (("argmax", decode_argmax_host_sync, net.decode_chain_argmax, False),
+                                       ("sampling", decode_sampling_host_sync, net.decode_chain_sampling, True)):
+            old_res, old_time = timed(lambda: sync([old(net, hid, beg, args.seq_len, 2) for hid in rows]))
+            new_res, new_time = timed(lambda: sync([new(hid, beg, args.seq_len, stop_token=2) for hid in rows]))
+            dev_res, dev_time = timed(lambda: sync([device_chain(hid, sample) for hid in rows]))
+            if name == "argmax":
+                assert [list(map(int, r[1])) for r in old_res] == [r[1] for r in new_res] == \
+                       [r[1] for r in dev_res], "Decoded tokens differ"
+            per_token = [took / sum(len(r[1]) for r in res) * 1e6
+                         for res, took in ((old_res, old_time), (new_res, new_time), (dev_res, dev_time))]
+            log.info("%s on %s: original loop %.0f us/token, decode_chain_%s() %.0f us/token, "
+                     "decode_chain_device() %.0f us/token", name, device.type, per_token[0], name, per_token[1],
+                     per_token[2])
+
+
+def crossent_step_per_sample(net, prepared, teach_prob):
+    """
+    Cross-entropy step as train_crossent.py did it before train_batch(): one decoder call per sample.
+    """
+    import random
+    import torch
+    import torch.nn.functional as F
+    import model
+    import utils
+
+    input_seq, out_seq_list, _, out_idx = model.embed_batch(prepared, net.emb, "cpu")
+    enc = net.encode(input_seq)
+    net_results = []
+    net_targets = []
+    bleu_sum = 0.0
+    for idx, out_seq in enumerate(out_seq_list):
+        ref_seqs = out_idx[idx][1:]
+        enc_item = net.get_encoded_item(enc, idx)
+        if random.random() < teach_prob:
+            r = net.decode_teacher(enc_item, out_seq)
+            bleu_sum += model.seq_bleu(r, ref_seqs)
+        else:
+            r, seq = net.decode_chain_argmax(enc_item, out_seq.data[0:1], len(ref_seqs))
+            bleu_sum += utils.calc_bleu(seq, ref_seqs)
+        net_results.append(r)
+        net_targets.extend(ref_seqs)
+    return F.cross_entropy(torch.cat(net_results), torch.LongTensor(net_targets)), bleu_sum
+
+
+def bench_crossent(args):
+    """
+    Samples/sec of the cross-entropy training step(forward and backward) with the per-sample
+    decoder loop against the batched train_crossent.train_batch(), for growing batch sizes.
+    Both get the same teacher-forcing/curriculum choices, so their losses have to match.
+    """
+    import random
+    import torch
+    import model
+    import train_crossent
+
+    for batch_size in args.batch_sizes:
+        args.batch = batch_size
+        net, phrases = make_bench_model(args)
+        #Random replies of different lengths, #END at the end only.
+        batch = [(p, [1] + torch.randint(3, BENCH_DICT_SIZE, (random.randint(2, args.seq_len),)).tolist() + [2])
+                 for p in phrases]
+        prepared = model.prepare_batch(batch)
+
+        def per_sample():
+            random.seed(args.seed)
+            loss_v, bleu = crossent_step_per_sample(net, prepared, train_crossent.TEACH_CURR_PROB)
+            loss_v.backward()
+            return loss_v.item(), bleu
+
+        def batched():
+            random.seed(args.seed)
+            input_seq, _, out_idx = model.embed_batch_no_out(prepared, net.emb, "cpu")
+            loss_v, bleu, _ = train_crossent.train_batch(net, input_seq, out_idx)
+            loss_v.backward()
+            return loss_v.item(), bleu
+
+        (ref_loss, ref_bleu), serial_time = timed(lambda: [per_sample() for _ in range(args.repeat)][-1])
+        (loss, bleu), batch_time = timed(lambda: [batched() for _ in range(args.repeat)][-1])
+        assert abs(loss - ref_loss) < 1e-4 * abs(ref_loss) and abs(bleu - ref_bleu) < 1e-6, \
+            "Batched step differs from per-sample one"
+        log.info("batch %d: per-sample %.0f samples/s, batched %.0f samples/s, speed-up %.1fx",
+                 batch_size, batch_size * args.repeat / serial_time, batch_size * args.repeat / batch_time,
+                 serial_time / batch_time)
+
+
+def saved_tensor_bytes(func):
+    """
+    Calls func under autograd hooks and returns its result with bytes of the tensors saved
+    for backward, which is the activation memory held between forward and backward passes.
+    """
+    import torch
+
+    storages = {}
+
+    def pack(t):
+        storages[t.untyped_storage().data_ptr()] = t.untyped_storage().nbytes()
+        return t
+
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda t: t):
+        res = func()
+    return res, sum(storages.values())
+
+
+def bench_amp(args):
+    """
+    fp32 training against the mixed-precision mode of train_crossent.py --amp(bfloat16 autocast on CPU,
+    float16 with gradient scaling with --cuda). Step time and memory of the train step of the random
+    model for growing batch sizes: peak allocated memory on GPU, activations saved for backward on CPU.
+    With --epochs, both modes train from the same weights on the --data genre and the mean loss
+    and test BLEU of every epoch are compared.
+    """
+    import copy
+    import random
+    import numpy as np
+    import torch
+    import torch.optim as optim
+    import model
+    import train_crossent
+    from utilities import high_level_cornell
+
+    device = torch.device("cuda" if args.cuda else "cpu")
+    modes = (("fp32", False), ("fp16" if args.cuda else "bf16", True))
+    for batch_size in args.batch_sizes:
+        args.batch = batch_size
+        net, phrases = make_bench_model(args)
+        net.to(device)
+        batch = [(p, [1] + torch.randint(3, BENCH_DICT_SIZE, (random.randint(2, args.seq_len),)).tolist() + [2])
+                 for p in phrases]
+        prepared = model.prepare_batch_no_out(batch)
+        results = {}
+        for name, amp in modes:
+            optimiser = optim.Adam(net.parameters(), lr=train_crossent.LEARNING_RATE)
+            scaler = model.grad_scaler(device, enabled=amp)
+
+            def forward():
+                with model.autocast(device, enabled=amp):
+                    input_seq, _, out_idx = model.embed_batch_no_out(prepared, net.emb, device)
+                    return train_crossent.train_batch(net, input_seq, out_idx, device)[0]
+
+            def step():
+                random.seed(args.seed)
+                optimiser.zero_grad()
+                loss_v = forward()
+                scaler.scale(loss_v).backward()
+                scaler.step(optimiser)
+                scaler.update()
+
+            step()
+            if args.cuda:
+                torch.cuda.synchronize()
+                torch.cuda.reset_peak_memory_stats()
+            random.seed(args.seed)
+            _, saved = saved_tensor_bytes(forward)
+            _, took = timed(lambda: [step() for _ in range(args.repeat)])
+            if args.cuda:
+                torch.cuda.synchronize()
+                saved = torch.cuda.max_memory_allocated()
+            results[name] = (took / args.repeat, saved)
+        (ref_time, ref_mem), (amp_time, amp_mem) = results[modes[0][0]], results[modes[1][0]]
+        log.info("batch %d: fp32 %.1f ms/step %.1f MB, %s %.1f ms/step %.1f MB, speed-up %.2fx, memory %.2fx",
+                 batch_size, ref_time * 1e3, ref_mem / 2**20, modes[1][0], amp_time * 1e3, amp_mem / 2**20,
+                 ref_time / amp_time, amp_mem / ref_mem)
+
+    if not args.epochs:
+        return
+    #The same shuffle and split as the training scripts do.
+    data, emb_dict = high_level_cornell.load_encoded_data(genre_filter=args.data)
+    data.shuffle(np.random.RandomState(high_level_cornell.SHUFFLE_SEED))
+    train_data, test_data = high_level_cornell.split_train_test(data)
+    end_token = emb_dict[high_level_cornell.END_TOKEN]
+    torch.manual_seed(args.seed)
+    initial = model.PhraseModel(dict_size=len(emb_dict), **bench_model_sizes(args))
+    log.info("%s: %d train and %d test pairs, %d words", args.data or "all genres", len(train_data),
+             len(test_data), len(emb_dict))
+    history = {}
+    for name, amp in modes:
+        net = copy.deepcopy(initial).to(device)
+        optimiser = optim.Adam(net.parameters(), lr=train_crossent.LEARNING_RATE)
+        scaler = model.grad_scaler(device, enabled=amp)
+        random.seed(args.seed)
+        history[name] = []
+        for epoch in range(args.epochs):
+            losses = []
+            start = time.perf_counter()
+            for batch in high_level_cornell.iterate_batches(train_data, train_crossent.BATCH_SIZE):
+                prepared = model.prepare_batch_no_out(batch)
+                optimiser.zero_grad()
+                with model.autocast(device, enabled=amp):
+                    input_seq, _, out_idx = model.embed_batch_no_out(prepared, net.emb, device)
+                    loss_v, _, _ = train_crossent.train_batch(net, input_seq, out_idx, device)
+                scaler.scale(loss_v).backward()
+                scaler.step(optimiser)
+                scaler.update()
+                losses.append(loss_v.item())
+            took = time.perf_counter() - start
+            with torch.no_grad():
+                bleu_test = train_crossent.run_test(test_data, net, end_token, device)
+            history[name].append((np.mean(losses), bleu_test))
+            log.info("%s epoch %d: mean loss %.3f, test BLEU %.4f, %.1f s", name, epoch, np.mean(losses), bleu_test, took)
+    for epoch, ((ref_loss, ref_bleu), (amp_loss, amp_bleu)) in enumerate(zip(*history.values())):
+        log.info("epoch %d: loss %.3f -> %.3f(%+.3f), test BLEU %.4f -> %.4f(%+.4f)", epoch, ref_loss, amp_loss,
+                 amp_loss - ref_loss, ref_bleu, amp_bleu, amp_bleu - ref_bleu)
+
+
+def bench_bucketing(args):
+    """
+    Padding efficiency of fixed-size batches against length-bucketed batches with --token-budget,
+    for phrase-reply pairs of train_crossent.py and for (phrase, [reply, ...]) groups of train_scst.py,
+    which are bucketed by phrase length only. Every sample has to come out exactly once and every
+    batch has to fit into the budget.
+    """
+    import numpy as np
+    import train_crossent
+    from utilities import high_level_cornell, batching
+
+    data, _ = high_level_cornell.load_encoded_data(genre_filter=args.data)
+    data.shuffle(np.random.RandomState(high_level_cornell.SHUFFLE_SEED))
+    train_data, _ = high_level_cornell.split_train_test(data)
+    pairs = list(train_data)
+    groups = high_level_cornell.group_train_data(train_data)
+    for name, samples, length in (("pairs", pairs, batching.pair_length),
+                                  ("SCST groups", groups, batching.phrase_length)):
+        fixed = batching.PaddingStats()
+        for batch in high_level_cornell.iterate_batches(samples, train_crossent.BATCH_SIZE):
+            fixed.add_batch(batch)
+        bucketed = batching.PaddingStats()
+        count = 0
+        for batch in batching.iterate_bucketed_batches(samples, args.token_budget,
+                                                       rand=np.random.RandomState(args.seed), length=length):
+            assert len(batch) * max(map(length, batch)) <= args.token_budget, "Batch is over the budget"
+            bucketed.add_batch(batch)
+            count += len(batch)
+        assert count == len(samples), "Bucketing lost or repeated samples"
+        log.info("%s: %d samples, fixed %d batches with padding efficiency %.3f, "
+                 "budget %d: %d batches with padding efficiency %.3f", name, len(samples), fixed.batches,
+                 fixed.efficiency, args.token_budget, bucketed.batches, bucketed.efficiency)
+
+
+def bench_rollout(args):
+    """
+    SCST rollouts of a batch: argmax baseline plus decode_chain_sampling() called args.samples times
+    for every phrase, against one decode_rollouts() pass. Both run with gradients like in training.
+    """
+    import torch
+    import model
+
+    net, phrases = make_bench_model(args)
+    input_seq, phr, _ = model.pack_batch_no_out([(p, [1, 2]) for p in phrases], net.emb)
+    enc = net.encode(input_seq)
+    beg = net.emb(torch.LongTensor([1]))
+
+    def per_sample():
+        _, baseline = net.decode_chain_argmax_batch(enc, beg, args.seq_len, stop_token=2)
+        for idx in range(len(phr)):
+            for _ in range(args.samples):
+                net.decode_chain_sampling(net.get_encoded_item(enc, idx), beg, args.seq_len, stop_token=2)
+        return baseline
+
+    baseline, serial_time = timed(per_sample)
+    rollouts, batch_time = timed(net.decode_rollouts, enc, beg, args.seq_len, args.samples, stop_token=2)
+    assert rollouts.to_lists()[0] == baseline, "Argmax rows differ from decode_chain_argmax_batch()"
+    count = len(phr) * args.samples
+    log.info("per-sample: %.0f samples/s, batched: %.0f samples/s, speed-up %.1fx for %d samples",
+             count / serial_time, count / batch_time, serial_time / batch_time, count)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(format="%(asctime)-15s %(levelname)s %(message)s", level=logging.INFO)
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--data-dir", default=low_level_cornell.DATA_DIR, help="Directory with Cornell corpus")
+    parser.add_argument("--data", default="", help="Genre to use. Empty string to use full dataset")
+    #Sizes of the models built by the benchmarks, for latency/quality sweeps across model sizes.
+    parser.add_argument("--hidden-size", type=int, default=0, help="Size of LSTM hidden state, 0 for default of model.py")
+    parser.add_argument("--emb-size", type=int, default=0, help="Size of word embeddings, 0 for default of model.py")
+    parser.add_argument("--layers", type=int, default=0, help="Count of LSTM layers, 0 for default of model.py")
+    subparsers = parser.add_subparsers(dest="bench", required=True)
+
+    p = subparsers.add_parser("tokenize", help="Scaling of parallel read_phrases with count of workers")
+    p.add_argument("--max-workers", type=int, default=os.cpu_count(), help="Largest count of workers to try")
+    p.set_defaults(func=bench_tokenize)
+
+    p = subparsers.add_parser("parse", help="Lines/sec of record readers on movie_lines.txt")
+    p.set_defaults(func=bench_parse)
+
+    p = subparsers.add_parser("decode", help="Per-row against batched greedy decoding")
+    p.add_argument("--batch", type=int, default=64, help="Count of phrases to decode")
+    p.add_argument("--seq-len", type=int, default=20, help="Length of decoded replies")
+    p.add_argument("--seed", type=int, default=0, help="Seed of random model weights")
+    p.set_defaults(func=bench_decode)
+
+    p = subparsers.add_parser("beam", help="Wall time of beam search against beam width")
+    p.add_argument("--batch", type=int, default=32, help="Count of phrases")
+    p.add_argument("--widths", type=int, nargs="+", default=[1, 2, 4, 8, 16], help="Beam widths to try")
+    p.add_argument("--seq-len", type=int, default=20, help="Length of decoded replies")
+    p.add_argument("--seed", type=int, default=0, help="Seed of random model weights")
+    p.set_defaults(func=bench_beam)
+
+    p = subparsers.add_parser("sessions", help="Incremental multi-turn encoding and session eviction")
+    p.add_argument("--batch", type=int, default=50, help="Count of turns in the conversation")
+    p.add_argument("--conversations", type=int, default=5000, help="Count of conversations to go through the store")
+    p.add_argument("--capacity", type=int, default=1000, help="Sessions kept by the store")
+    p.add_argument("--rounds", type=int, default=2, help="Turns of every conversation going through the store")
+    p.add_argument("--seed", type=int, default=0, help="Seed of random model weights")
+    p.set_defaults(func=bench_sessions)
+
+    p = subparsers.add_parser("softmax", help="Dense, sampled and adaptive softmax output layers")
+    p.add_argument("--dict-size", type=int, default=50000, help="Size of dictionary")
+    p.add_argument("--tokens", type=int, default=2048, help="Decoder positions in a batch")
+    p.add_argument("--sampled", type=int, default=1024, help="Words of sampled softmax")
+    p.add_argument("--repeat", type=int, default=5, help="Steps to time")
+    p.add_argument("--seed", type=int, default=0, help="Seed of random decoder outputs")
+    p.set_defaults(func=bench_softmax)
+
+    p = subparsers.add_parser("sampling", help="Cost of drawing tokens with sampling settings")
+    p.add_argument("--rows", type=int, nargs="+", default=[1, 64], help="Rows of logits")
+    p.add_argument("--dict-size", type=int, default=BENCH_DICT_SIZE, help="Size of dictionary")
+    p.add_argument("--top-k", type=int, default=50, help="Top-k setting")
+    p.add_argument("--top-p", type=float, default=0.9, help="Top-p setting")
+    p.add_argument("--scale", type=float, default=3.0, help="Standard deviation of random logits")
+    p.add_argument("--repeat", type=int, default=200, help="Steps to time")
+    p.add_argument("--seed", type=int, default=0, help="Seed of random logits")
+    p.set_defaults(func=bench_sampling)
+
+    p = subparsers.add_parser("jit", help="Per-reply latency of eager and TorchScript models")
+    p.add_argument("--batch", type=int, default=32, help="Count of phrases to reply to")
+    p.add_argument("--seed", type=int, default=0, help="Seed of random model weights")
+    p.set_defaults(func=bench_jit)
+
+    p = subparsers.add_parser("numpy", help="Per-reply latency and cold start of NumPy and torch models")
+    p.add_argument("--batch", type=int, default=32, help="Count of phrases to reply to")
+    p.add_argument("--starts", type=int, default=3, help="Fresh interpreters to time cold start on")
+    p.add_argument("--seed", type=int, default=0, help="Seed of random model weights")
+    p.set_defaults(func=bench_numpy)
+
+    p = subparsers.add_parser("quantize", help="BLEU drift, latency and size of int8 quantized model")
+    p.add_argument("-m", "--model", required=True, help="Trained model, its directory has the dictionary")
+    #Test split is cut from the genre, so it has to be the one the model was trained on.
+    p.add_argument("--data", required=True, help="Genre the model was trained on. Empty string for full dataset")
+    p.add_argument("--output", choices=("dense", "adaptive"), default="dense", help="Output layer of model saved without its configuration")
+    p.add_argument("--replies", type=int, default=200, help="Test phrases to time single replies on")
+    p.set_defaults(func=bench_quantize)
+
+    p = subparsers.add_parser("latency", help="Per-token latency of single-row decoding")
+    p.add_argument("--batch", type=int, default=32, help="Count of phrases decoded one by one")
+    p.add_argument("--seq-len", type=int, default=20, help="Length of decoded replies")
+    p.add_argument("--cuda", action="store_true", default=False, help="Decode on GPU")
+    p.add_argument("--seed", type=int, default=0, help="Seed of random model weights")
+    p.set_defaults(func=bench_latency)
+
+    p = subparsers.add_parser("rollout", help="Per-sample against batched SCST rollouts")
+    p.add_argument("--batch", type=int, default=16, help="Count of phrases")
+    p.add_argument("--samples", type=int, default=4, help="Samples of every phrase")
+    p.add_argument("--seq-len", type=int, default=20, help="Length of decoded replies")
+    p.add_argument("--seed", type=int, default=0, help="Seed of random model weights")
+    p.set_defaults(func=bench_rollout)
+
+    p = subparsers.add_parser("crossent", help="Per-sample against batched cross-entropy training step")
+    p.add_argument("--batch-sizes", type=int, nargs="+", default=[32, 128, 512], help="Batch sizes to try")
+    p.add_argument("--seq-len", type=int, default=20, help="Max length of reference replies")
+    p.add_argument("--repeat", type=int, default=3, help="Steps to time for every batch size")
+    p.add_argument("--seed", type=int, default=0, help="Seed of random model weights and teacher-forcing choices")
+    p.set_defaults(func=bench_crossent)
+
+    p = subparsers.add_parser("amp", help="Step time, memory and convergence of fp32 and mixed-precision training")
+    p.add_argument("--batch-sizes", type=int, nargs="+", default=[32, 128], help="Batch sizes to time")
+    p.add_argument("--seq-len", type=int, default=20, help="Max length of reference replies")
+    p.add_argument("--repeat", type=int, default=5, help="Steps to time for every batch size")
+    p.add_argument("--epochs", type=int, default=0, help="Epochs to train on --data genre in both modes, 0 to skip")
+    p.add_argument("--cuda", action="store_true", default=False, help="Float16 on GPU instead of bfloat16 on CPU")
+    p.add_argument("--seed", type=int, default=0, help="Seed of random model weights and teacher-forcing choices")
+    p.set_defaults(func=bench_amp)
+
+    p = subparsers.add_parser("bucketing", help="Padding of fixed-size against length-bucketed batches")
+    p.add_argument("--token-budget", type=int, default=640, help="Max padded tokens per bucketed batch")
+    p.add_argument("--seed", type=int, default=0, help="Seed of bucketing")
+    p.set_defaults(func=bench_bucketing)
+
+    args = parser.parse_args()
+    args.func(args)
@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+"""
+Export of a trained PhraseModel into a TorchScript archive for inference.
+The archive holds the encoder and complete greedy and sampling decode loops compiled by torch.jit,
+so a reply is one call into the TorchScript interpreter instead of Python-level decode steps,
+and the vocabulary of the model as an extra file. It is loaded by scripted_model.py, which
+doesn't need model.py or the training code.
+With --format npz weights and the vocabulary are saved for numpy_model.py, which doesn't need torch at all.
+"""
+import os
+import argparse
+import logging
+from typing import List, Tuple
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from utilities import high_level_cornell, vocabulary
+import model, softmax, numpy_model
+
+#Name of the vocabulary inside of the archive.
+VOCAB_FILE = "vocab.bin"
+
+log = logging.getLogger("export")
+
+
+class ScriptedPhraseModel(nn.Module):
+    """
+    Inference part of PhraseModel which can be compiled by torch.jit.script().
+    forward() takes token IDs of one encoded phrase(with '#BEG' and '#END') and returns
+    token IDs of the reply without '#END', decoded greedily or by sampling.
+    Only the dense output layer can be exported.
+    """
+    def __init__(self, net, begin_token, end_token, unknown_token, max_tokens):
+        super(ScriptedPhraseModel, self).__init__()
+        if not isinstance(net.output, nn.Sequential):
+            raise ValueError("Only models with the dense output layer can be exported")
+        self.emb = net.emb
+        self.encoder = net.encoder
+        self.decoder = net.decoder
+        self.output = net.output[0]
+        self.begin_token = begin_token
+        self.end_token = end_token
+        self.unknown_token = unknown_token
+        self.max_tokens = max_tokens
+        self.top_p_window = model.TOP_P_WINDOW
+        self.top_p_growth = model.TOP_P_GROWTH
+
+    @torch.jit.export
+    def encode(self, tokens: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        _, hid = self.encoder(self.emb(tokens.unsqueeze(0)))
+        return hid
+
+    def pick(self, logits: torch.Tensor, sample: bool, temperature: float, top_k: int, top_p: float) -> torch.Tensor:
+        """
+        The same as model.sample_tokens() for sampling, argmax otherwise.
+        """
+        if not sample:
+            return torch.argmax(logits, dim=1)
+        if temperature != 1.0:
+            logits = logits / temperature
+        if top_k > 0 and top_k < logits.size(1):
+            values, ids = logits.topk(top_k, dim=1)
+            probs = F.softmax(values, dim=1)
+        elif top_p < 1.0:
+            full_probs = F.softmax(logits, dim=1)
+            window = self.top_p_window
+            values, ids = logits.topk(min(window, logits.size(1)), dim=1)
+            probs = full_probs.gather(1, ids)
+            while float(probs.sum(dim=1).min()) < top_p and window < logits.size(1):
+                window *= self.top_p_growth
+                values, ids = logits.topk(min(window, logits.size(1)), dim=1)
+                probs = full_probs.gather(1, ids)
+        else:
+            return self.draw(F.softmax(logits, dim=1), 1.0).squeeze(1)
+        return ids.gather(1, self.draw(probs, top_p)).squeeze(1)
+
+    def draw(self, probs: torch.Tensor, top_p: float) -> torch.Tensor:
+        """
+        The same as model.draw_tokens().
+        """
+        cum = probs.cumsum(dim=1)
+        last = cum.size(1) - 1
+        if top_p < 1.0:
+            top_p_v = torch.full([cum.size(0), 1], top_p)
+            mass = cum.gather(1, torch.searchsorted(cum, top_p_v).clamp(max=last))
+        else:
+            mass = cum[:, last:]
+        u = torch.rand(cum.size(0), 1) * mass
+        return torch.searchsorted(cum, u, right=True).clamp(max=last)
+
+    def forward(self, tokens: torch.Tensor, sample: bool = False, temperature: float = 1.0,
+                top_k: int = 0, top_p: float = 1.0) -> torch.Tensor:
+        hid = self.encode(tokens)
+        curr = tokens[:1]
+        out: List[torch.Tensor] = []
+        for _ in range(self.max_tokens):
+            dec_out, hid = self.decoder(self.emb(curr).unsqueeze(0), hid)
+            curr = self.pick(self.output(dec_out[0]), sample, temperature, top_k, top_p)
+            if int(curr[0]) == self.end_token:
+                break
+            out.append(curr)
+        if len(out) == 0:
+            return torch.zeros(0, dtype=torch.long)
+        return torch.cat(out)
+
+
+"""
+Compiles the model with its dictionary and saves the archive to path.
+"""
+def export(net, emb_dict, path):
+    scripted = torch.jit.script(ScriptedPhraseModel(net.cpu().eval(), emb_dict[high_level_cornell.BEGIN_TOKEN],
+                                                    emb_dict[high_level_cornell.END_TOKEN],
+                                                    emb_dict[high_level_cornell.UNKNOWN_TOKEN],
+                                                    high_level_cornell.MAX_TOKENS))
+    vocab = emb_dict if isinstance(emb_dict, vocabulary.Vocabulary) else vocabulary.Vocabulary.from_dict(emb_dict)
+    torch.jit.save(scripted, path, _extra_files={VOCAB_FILE: bytes(vocab.buf)})
+    return scripted
+
+"""
+Saves state_dict of the model with the dictionary into .npz archive read by numpy_model.NumpyPhraseModel.
+"""
+def export_npz(net, emb_dict, path):
+    if not isinstance(net.output, nn.Sequential):
+        raise ValueError("Only models with the dense output layer can be exported")
+    arrays = {name: value.detach().cpu().numpy() for name, value in net.state_dict().items()}
+    vocab = emb_dict if isinstance(emb_dict, vocabulary.Vocabulary) else vocabulary.Vocabulary.from_dict(emb_dict)
+    arrays["vocab"] = np.frombuffer(bytes(vocab.buf), dtype=np.uint8)
+    arrays["end_token"] = np.array(emb_dict[high_level_cornell.END_TOKEN])
+    arrays["max_tokens"] = np.array(high_level_cornell.MAX_TOKENS)
+    arrays["npz_version"] = np.array(numpy_model.NPZ_VERSION)
+    with open(path, "wb") as f:
+        np.savez(f, **arrays)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(format="%(asctime)-15s %(levelname)s %(message)s", level=logging.INFO)
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-m", "--model", required=True, help="Model file to export, its directory has the dictionary")
+    parser.add_argument("-o", "--out", required=True, help="Archive to write")
+    parser.add_argument("--format", choices=("torchscript", "npz"), default="torchscript",
+                        help="TorchScript for scripted_model.py or NumPy arrays for numpy_model.py")
+    parser.add_argument("--output", choices=softmax.OUTPUT_MODES, default="dense", help="Output layer of model saved without its configuration")
+    args = parser.parse_args()
+
+    emb_dict = high_level_cornell.load_emb_dict(os.path.dirname(args.model))
+    net = model.load_checkpoint(args.model, emb_dict, output=args.output)
+    if args.format == "npz":
+        export_npz(net, emb_dict, args.out)
+    else:
+        export(net, emb_dict, args.out)
+    log.info("Model %s exported to %s", args.model, args.out)
@@ -6,6 +6,8 @@ import torch.nn.functional as F
 import numpy as np
 
 import utils
+import softmax
+from utilities import vocabulary
 
 """
 Dimension of hidden state on expected i/p and RNN o/p.
@@ -18,30 +20,45 @@ We want to train it alongside the model.
 Embedding are vectors which represent tokens in our dictionary.
 """
 EMBEDDING_DIM = 50
+#Stacked layers of the encoder and of the decoder.
+NUM_LAYERS = 1
+#Version of the checkpoint layout written by save_checkpoint().
+CHECKPOINT_VERSION = 1
+#Steps between checks whether all rows of device-resident decoding are finished.
+DEVICE_CHECK_EVERY = 4
+#Beam search ranks finished beams by log-probability / length ** BEAM_LENGTH_ALPHA.
+BEAM_LENGTH_ALPHA = 1.0
+#Nucleus sampling on CPU looks for the nucleus among this many most probable tokens, then among
+#TOP_P_GROWTH times more of them and so on, before sorting the whole vocabulary.
+TOP_P_WINDOW = 64
+TOP_P_GROWTH = 8
 
 class PhraseModel(nn.Module):
-    def __init__(self,emb_size,dict_size,hid_size):
+    def __init__(self,emb_size,dict_size,hid_size,output="dense",num_layers=NUM_LAYERS):
         super(PhraseModel,self).__init__()
+        #Arguments of the constructor, saved with checkpoints to rebuild the same architecture.
+        self.config = dict(emb_size=emb_size,dict_size=dict_size,hid_size=hid_size,output=output,num_layers=num_layers)
         #Convert words to embeddings.
         self.emb = nn.Embedding(num_embeddings=dict_size,embedding_dim=emb_size)
         """
-        One layer for encoder and another for decoder.
+        num_layers stacked layers for encoder and the same for decoder.
         If batch_first is True, the batch will be provided as the 1st dimension.
         input_size is the no. of expected features from input.
         hidden_size is no. of features in hidden state.
         """
-        self.encoder = nn.LSTM(input_size=emb_size,hidden_size=hid_size,batch_first=True)
-        self.decoder = nn.LSTM(input_size=emb_size,hidden_size=hid_size,batch_first=True)
-        #Gives the probability distribution at the output.
-        self.output = nn.Sequential(nn.Linear(hid_size,dict_size))
+        self.encoder = nn.LSTM(input_size=emb_size,hidden_size=hid_size,num_layers=num_layers,batch_first=True)
+        self.decoder = nn.LSTM(input_size=emb_size,hidden_size=hid_size,num_layers=num_layers,batch_first=True)
+        #Gives the probability distribution at the output, dense Linear or adaptive softmax(see softmax.py).
+        self.output = softmax.make_output(output,hid_size,dict_size)
 
-    def encode(self,x):
+    def encode(self,x,hid=None):
         """
         The output of that encoder has output,(hn,cn).
         output comprises all hidden states in the last layer.
         Tuple (hn,cn) is hidden and cell state of overall architecture.
+        hid continues encoding from an earlier state(zeros if None).
         """
-        _,hidden = self.encoder(x)
+        _,hidden = run_lstm(self.encoder,x,hid)
         return hidden
 
     def get_encoded_item(self,encoded,index):
@@ -62,23 +79,40 @@ class PhraseModel(nn.Module):
         correct token next.
 
         """
-        out , _ = self.decoder(input_seq, hid)
         #.data is used just to make sure we get underlying tensor from the variable.
-        out = self.output(out.data)
+        out = self.output(self.decode_teacher_hidden(hid,input_seq))
         return out
 
+    def decode_teacher_hidden(self,hid,input_seq):
+        """
+        Decoder outputs [N,H] of teacher-forcing before the output layer, in the order of packed input_seq.
+        output_nll() and output_predict() take them without computing scores of every word.
+        """
+        out , _ = run_lstm(self.decoder,input_seq,hid)
+        return out.data
+
+    def output_nll(self,hidden,targets,sampled=0):
+        """
+        Summed negative log-likelihood of targets, sampled > 0 uses sampled softmax with the dense layer.
+        """
+        return softmax.output_nll(self.output,hidden,targets,sampled)
+
+    def output_predict(self,hidden):
+        return softmax.output_predict(self.output,hidden)
+
     def decode_one(self,hid,input_x):
         """
-        Performs one single decoding when there is a single input.
+        Performs one single decoding step. input_x has one row of embeddings for every
+        row of the batch(just one row when a single item is decoded).
         Output is the raw scores(Logits) of every token instead of Prob. distribution
         and the new hidden state.
 
         """
-        #unsqueeze(0) adds a dimension of size one inserted at specified position(0).
-        out, new_hid = self.decoder(input_x.unsqueeze(0), hid)
+        #unsqueeze(1) adds a dimension of size one inserted at specified position(1), it's the sequence of length 1.
+        out, new_hid = self.decoder(input_x.unsqueeze(1), hid)
         out = self.output(out)
-        #squeeze(0) removes dimension of size 1 from input.
-        return out.squeeze(dim=0) , new_hid
+        #squeeze(1) removes dimension of size 1 from input.
+        return out.squeeze(dim=1) , new_hid
 
     def decode_chain_argmax(self,hid,begin_emb,seq_len,stop_token=None):
         """
@@ -91,6 +125,72 @@ class PhraseModel(nn.Module):
                  stop_token is the #END token in our case.
         Outputs :Tensor with resulting logits(used for training to calculate the loss)
                  and list of Token IDs(to pass to BLEU score calculation).
+        On CPU the token is read back every step, which costs nothing there, other devices
+        decode with decode_chain_device() and copy the tokens to host once.
+        """
+        if begin_emb.device.type == "cpu":
+            return self._decode_chain_host(hid,begin_emb,seq_len,stop_token)
+        logits,tokens,lens = self.decode_chain_device(hid,begin_emb,seq_len,stop_token)
+        #The only copy to host, after the whole chain is decoded.
+        out_len = int(lens[0])
+        return logits[0,:out_len],tokens[0,:out_len].tolist()
+
+    def decode_chain_argmax_batch(self,hid,begin_emb,seq_len,stop_token=None):
+        """
+        Greedy decoding of the whole batch at once. hid is the hidden state of encoder
+        for B rows(as returned by encode()), begin_emb has B rows or one row used for all of them.
+        All rows are decoded in lockstep, a row is dropped from the active set once it produces
+        stop_token and decoding ends when every row is finished or after seq_len steps.
+        seq_len can also be a list with max length of every row.
+        Outputs : list of B tensors with logits and list of B lists of Token IDs,
+                  the same as decode_chain_argmax() gives for every row.
+        """
+        batch_size = hid[0].size(1)
+        curr_emb = begin_emb.expand(batch_size,-1) if begin_emb.size(0) == 1 else begin_emb
+        row_lens = seq_len if isinstance(seq_len,(list,tuple)) else [seq_len] * batch_size
+        #Rows of the batch which are still being decoded.
+        active = list(range(batch_size))
+        out_logits = [[] for _ in range(batch_size)]
+        out_tokens = [[] for _ in range(batch_size)]
+
+        for i in range(max(row_lens,default=0)):
+            logits,hid = self.decode_one(hid,curr_emb)
+            tokens_v = torch.max(logits,dim=1)[1]
+            #One copy to host per step for the whole batch.
+            tokens = tokens_v.tolist()
+            for row,step_logits,token in zip(active,logits.unbind(0),tokens):
+                out_logits[row].append(step_logits)
+                out_tokens[row].append(token)
+            keep = [pos for pos,token in enumerate(tokens)
+                    if token != stop_token and row_lens[active[pos]] > i+1]
+            if len(keep) < len(active):
+                if not keep:
+                    break
+                active = [active[pos] for pos in keep]
+                keep_v = torch.LongTensor(keep).to(tokens_v.device)
+                hid = (hid[0].index_select(1,keep_v),hid[1].index_select(1,keep_v))
+                tokens_v = tokens_v.index_select(0,keep_v)
+            curr_emb = self.emb(tokens_v)
+        return [torch.stack(l) for l in out_logits],out_tokens
+
+    def decode_chain_sampling(self,hid,begin_emb,seq_len,stop_token=None,temperature=1.0,top_k=0,top_p=1.0):
+        """
+        Here we act based on probabilities. Predicted token is fed to the network again.
+        Inputs and Outputs are similar to the above function. The difference is we will
+        be using Softmax here and it performs random sampling from returned probability
+        distribution. temperature, top_k and top_p reshape the distribution, see sample_tokens().
+        Like decode_chain_argmax(), only other devices than CPU decode with decode_chain_device().
+        """
+        if begin_emb.device.type == "cpu":
+            return self._decode_chain_host(hid,begin_emb,seq_len,stop_token,True,temperature,top_k,top_p)
+        logits,actions,lens = self.decode_chain_device(hid,begin_emb,seq_len,stop_token,sample=True,
+                                                       temperature=temperature,top_k=top_k,top_p=top_p)
+        out_len = int(lens[0])
+        return logits[0,:out_len],actions[0,:out_len].tolist()
+
+    def _decode_chain_host(self,hid,begin_emb,seq_len,stop_token=None,sample=False,temperature=1.0,top_k=0,top_p=1.0):
+        """
+        Decoding of one row which reads every token back and stops right at stop_token.
         """
         out_logits = []
         out_tokens = []
@@ -98,45 +198,265 @@ class PhraseModel(nn.Module):
 
         for i in range(seq_len):
             logits,hid = self.decode_one(hid,curr_emb)
-            #torch.max()[1] has indices.nump()[0] as 2D array is returned([[x,y,..]])
-            token = torch.max(logits,dim=1)[1].data.cpu().numpy()[0]#Max along rows.
-            curr_emb = self.emb(torch.max(logits,dim=1)[1])
-
+            if sample:
+                tokens = sample_tokens(logits.detach(),temperature,top_k,top_p)
+            else:
+                tokens = torch.max(logits,dim=1)[1]
+            token = int(tokens[0])
             out_logits.append(logits)
             out_tokens.append(token)
-
-            if stop_token is not None and token == stop_token:
+            if token == stop_token:
                 break
+            curr_emb = self.emb(tokens)
         return torch.cat(out_logits),out_tokens
 
-    def decode_chain_sampling(self,hid,begin_emb,seq_len,stop_token=None):
+    def decode_chain_device(self,hid,begin_emb,seq_len,stop_token=None,sample=False,check_every=DEVICE_CHECK_EVERY,
+                            temperature=1.0,top_k=0,top_p=1.0):
         """
-        Here we act based on probabilities. Predicted token is fed to the network again.
-        Inputs and Outputs are similar to the above function. The difference is we will
-        be using Softmax here and it performs random sampling from returned probability
-        distribution.
+        Device-resident decoding of a batch, argmax or sampling(on-device sample_tokens()).
+        Tokens are never copied to host during decoding: rows which produced stop_token keep being
+        decoded and are cut by their lengths computed at the end, whether every row is finished is checked
+        with one reduction every check_every steps. Callers copy the token matrix to host once at the end.
+        Inputs : hidden state [1,B,H], begin_emb [1,E] or [B,E], max length and stop_token.
+        Outputs : logits [B,T,V], tokens [B,T] and lengths [B](stop_token included) on the device,
+                  positions past the length of a row are padding.
         """
+        batch_size = hid[0].size(1)
+        curr_emb = begin_emb.expand(batch_size,-1) if begin_emb.size(0) == 1 else begin_emb
+        finished = torch.zeros(batch_size,dtype=torch.bool,device=curr_emb.device)
         out_logits = []
-        out_actions = []
-        curr_emb = begin_emb
+        out_tokens = []
 
         for i in range(seq_len):
             logits,hid = self.decode_one(hid,curr_emb)
-            token_probs = F.softmax(logits, dim=1).data.cpu().numpy()[0]
-            """
-            Argument p defines the probability associated with each entry.
-            we reshape it to [0] as the input has to be a 1D array.
-            """
-            action = int(np.random.choice(token_probs.shape[0], p=token_probs))
-            take_action = torch.LongTensor([action]).to(begin_emb.device)
-            curr_emb = self.emb(take_action)
-
+            if sample:
+                tokens = sample_tokens(logits.detach(),temperature,top_k,top_p)
+            else:
+                tokens = torch.max(logits,dim=1)[1]
             out_logits.append(logits)
-            out_actions.append(action)
+            out_tokens.append(tokens)
+            if stop_token is not None:
+                finished |= tokens == stop_token
+                if (i+1) % check_every == 0 and bool(finished.all()):
+                    break
+            curr_emb = self.emb(tokens)
+        tokens = torch.stack(out_tokens,dim=1)
+        return torch.stack(out_logits,dim=1),tokens,_chain_lens(tokens,stop_token)
 
-            if stop_token is not None and action == stop_token:
+    def decode_beam(self,hid,begin_emb,seq_len,beam_width,stop_token=None,length_alpha=BEAM_LENGTH_ALPHA):
+        """
+        Beam search for a batch. Beams of all inputs live in one hidden state tensor [1,B*beam_width,H],
+        so every step is one decoder call whatever the width is. Every step all beams of an input are
+        extended by every word and the beam_width best log-probability sums are kept. A beam which has
+        produced stop_token is finished: it keeps its score and only carries stop_token on.
+        Decoding stops early once all beams are finished.
+        At the end the beam with the best score / length ** length_alpha is chosen for every input.
+        Inputs : hidden state [1,B,H], begin_emb [1,E] or [B,E], max length, width and stop_token.
+        Outputs : list of B lists of Token IDs(stop_token included) and tensor [B] of their normalized scores.
+        """
+        batch_size = hid[0].size(1)
+        begin_emb = begin_emb.expand(batch_size,-1) if begin_emb.size(0) == 1 else begin_emb
+        device = begin_emb.device
+        hid = tuple(h.repeat_interleave(beam_width,dim=1) for h in hid)
+        curr_emb = begin_emb.repeat_interleave(beam_width,dim=0)
+        #Only the first beam is alive at the start, otherwise all beams would be the same.
+        scores = torch.full((batch_size,beam_width),float("-inf"),device=device)
+        scores[:,0] = 0.0
+        finished = torch.zeros((batch_size,beam_width),dtype=torch.bool,device=device)
+        lens = torch.zeros((batch_size,beam_width),dtype=torch.long,device=device)
+        history = torch.zeros((batch_size,beam_width,0),dtype=torch.long,device=device)
+        #Position of the first beam of every input in the flat beam dimension.
+        beam_base = torch.arange(batch_size,device=device).unsqueeze(1) * beam_width
+
+        for i in range(seq_len):
+            logits,hid = self.decode_one(hid,curr_emb)
+            log_probs = F.log_softmax(logits,dim=1).view(batch_size,beam_width,-1)
+            dict_size = log_probs.size(2)
+            if stop_token is not None:
+                frozen = torch.full((dict_size,),float("-inf"),device=device)
+                frozen[stop_token] = 0.0
+                log_probs = torch.where(finished.unsqueeze(2),frozen,log_probs)
+            candidates = (scores.unsqueeze(2) + log_probs).view(batch_size,-1)
+            scores,flat_idx = candidates.topk(beam_width,dim=1)
+            beam_idx = flat_idx // dict_size
+            tokens = flat_idx % dict_size
+            history = torch.cat([history.gather(1,beam_idx.unsqueeze(2).expand(-1,-1,history.size(2))),
+                                 tokens.unsqueeze(2)],dim=2)
+            was_finished = finished.gather(1,beam_idx)
+            lens = torch.where(was_finished,lens.gather(1,beam_idx),torch.full_like(lens,i+1))
+            finished = was_finished
+            if stop_token is not None:
+                finished = finished | (tokens == stop_token)
+            rows = (beam_idx + beam_base).view(-1)
+            hid = tuple(h.index_select(1,rows) for h in hid)
+            curr_emb = self.emb(tokens.view(-1))
+            if stop_token is not None and bool(finished.all()):
                 break
-        return torch.cat(out_logits),out_actions
+
+        norm_scores = scores / lens.float() ** length_alpha
+        best_scores,best = norm_scores.max(dim=1)
+        best_tokens = history.gather(1,best.view(-1,1,1).expand(-1,1,history.size(2))).squeeze(1)
+        best_lens = lens.gather(1,best.unsqueeze(1)).squeeze(1)
+        out_tokens = [row[:l] for row,l in zip(best_tokens.tolist(),best_lens.tolist())]
+        return out_tokens,best_scores
+
+    def decode_rollouts(self,hid,begin_emb,seq_len,samples,stop_token=None,check_every=4,
+                        temperature=1.0,top_k=0,top_p=1.0):
+        """
+        SCST rollouts for a batch: the argmax baseline and `samples` random samples of every row,
+        all decoded in lockstep in one pass. Hidden state of every row is repeated `samples` times,
+        tokens are drawn on the device with draw_tokens() and stay there, rows which produced
+        stop_token keep being decoded but the rest is masked out by their lengths. Whether all rows are
+        finished is checked only every check_every steps, so the host isn't synchronized every step.
+        temperature, top_k and top_p change the distribution samples are drawn from(see sampling_logits()),
+        log_probs are of that distribution too, so the policy gradient isn't biased by the truncation.
+        Inputs : hidden state [1,B,H], begin_emb [1,E] or [B,E], max length and count of samples.
+        Outputs : RolloutBatch.
+        """
+        batch_size = hid[0].size(1)
+        begin_emb = begin_emb.expand(batch_size,-1) if begin_emb.size(0) == 1 else begin_emb
+        #Rows 0..B-1 are argmax ones, then `samples` rows of every input.
+        hid = tuple(torch.cat([h,h.repeat_interleave(samples,dim=1)],dim=1) for h in hid)
+        curr_emb = torch.cat([begin_emb,begin_emb.repeat_interleave(samples,dim=0)])
+        rows = batch_size * (samples + 1)
+        finished = torch.zeros(rows,dtype=torch.bool,device=curr_emb.device)
+        out_actions = []
+        out_log_probs = []
+
+        for i in range(seq_len):
+            logits,hid = self.decode_one(hid,curr_emb)
+            greedy = torch.max(logits[:batch_size],dim=1)[1]
+            values,ids = sampling_logits(logits[batch_size:],temperature,top_k,top_p)
+            choice = draw_tokens(F.softmax(values.detach(),dim=1))
+            out_log_probs.append(F.log_softmax(values,dim=1).gather(1,choice).squeeze(1))
+            sampled = choice.squeeze(1) if ids is None else ids.gather(1,choice).squeeze(1)
+            tokens = torch.cat([greedy,sampled])
+            out_actions.append(tokens)
+            if stop_token is not None:
+                finished |= tokens == stop_token
+                if (i+1) % check_every == 0 and bool(finished.all()):
+                    break
+            curr_emb = self.emb(tokens)
+        actions = torch.stack(out_actions,dim=1)
+        lens = _chain_lens(actions,stop_token)
+        return RolloutBatch(actions[:batch_size],lens[:batch_size],actions[batch_size:],lens[batch_size:],
+                            torch.stack(out_log_probs,dim=1),samples)
+
+
+def _candidates(logits, temperature, top_k, top_p):
+    """
+    Candidate tokens of sampling_logits() before the nucleus is cut: their logits, probabilities
+    and IDs(None for all V tokens). With top_k or top_p they are in descending order.
+    """
+    if temperature != 1.0:
+        logits = logits / temperature
+    dict_size = logits.size(1)
+    if top_k and top_k < dict_size:
+        values,ids = logits.topk(top_k,dim=1)
+        return values,F.softmax(values,dim=1),ids
+    if top_p >= 1.0:
+        return logits,F.softmax(logits,dim=1),None
+    if logits.device.type == "cpu":
+        #Probabilities of the whole vocabulary, so the nucleus is the same as after sorting.
+        full_probs = F.softmax(logits,dim=1)
+        window = TOP_P_WINDOW
+        while window < dict_size:
+            values,ids = logits.topk(window,dim=1)
+            probs = full_probs.gather(1,ids)
+            if float(probs.sum(dim=1).min()) >= top_p:
+                return values,probs,ids
+            window *= TOP_P_GROWTH
+    values,ids = logits.sort(dim=1,descending=True)
+    return values,F.softmax(values,dim=1),ids
+
+
+def sampling_logits(logits, temperature=1.0, top_k=0, top_p=1.0):
+    """
+    Logits of the candidate tokens of every row of logits [B,V] and their IDs, the distribution
+    sample_tokens() draws from. Logits are divided by temperature, then only top_k most probable tokens(0 for all)
+    are kept, and of them only the smallest set with probability mass of at least top_p(nucleus), the rest
+    get -inf. The nucleus is exact: top_p alone sorts the whole vocabulary, on CPU only if growing windows of
+    the most probable tokens(see TOP_P_WINDOW) don't hold the nucleus of every row. Every check reads one value
+    back, which costs nothing on CPU, but sorting the vocabulary does. IDs are None when all V tokens are candidates.
+    Gradients flow through the returned logits.
+    """
+    values,probs,ids = _candidates(logits,temperature,top_k,top_p)
+    if top_p < 1.0:
+        #Tokens after the mass before them reached top_p, the most probable one always stays.
+        values = values.masked_fill((probs.cumsum(dim=1) - probs >= top_p).detach(),float("-inf"))
+    return values,ids
+
+
+def draw_tokens(probs, top_p=1.0):
+    """
+    Draws one column of every row of probs [B,K] by inverting the cumulative distribution, which is
+    cheaper than torch.multinomial for one draw. Rows don't have to be normalized, zeros are never drawn.
+    top_p < 1 draws from the nucleus of rows sorted in descending order: the columns up to the first one
+    where the cumulative probability reaches top_p, without masking the rest.
+    Returns column indices [B,1].
+    """
+    cum = probs.float().cumsum(dim=1)
+    last = cum.size(1) - 1
+    if top_p < 1.0:
+        top_p_v = torch.full((cum.size(0),1),top_p,device=cum.device)
+        mass = cum.gather(1,torch.searchsorted(cum,top_p_v).clamp_(max=last))
+    else:
+        mass = cum[:,last:]
+    u = torch.rand(cum.size(0),1,device=cum.device) * mass
+    return torch.searchsorted(cum,u,right=True).clamp_(max=last)
+
+
+def sample_tokens(logits, temperature=1.0, top_k=0, top_p=1.0):
+    """
+    Draws one token for every row of logits [B,V] on the device from the distribution
+    reshaped by temperature, top_k and top_p, see sampling_logits().
+    """
+    _,probs,ids = _candidates(logits,temperature,top_k,top_p)
+    choice = draw_tokens(probs,top_p)
+    return choice.squeeze(1) if ids is None else ids.gather(1,choice).squeeze(1)
+
+
+def _chain_lens(tokens, stop_token):
+    """
+    Lengths of decoded rows [B,T] up to and including their first stop_token, computed on the device.
+    """
+    if stop_token is None:
+        return torch.full((tokens.size(0),),tokens.size(1),dtype=torch.long,device=tokens.device)
+    stopped = tokens == stop_token
+    #argmax gives the first maximal position.
+    first = torch.max(stopped.int(),dim=1)[1] + 1
+    return torch.where(stopped.any(dim=1),first,torch.full_like(first,tokens.size(1)))
+
+
+class RolloutBatch:
+    """
+    Result of PhraseModel.decode_rollouts(), all tensors stay on the device.
+    argmax_actions [B,T] and argmax_lens [B] are the greedy baseline of every input,
+    actions [B*samples,T], lens and log_probs(log-probability of every drawn action) are the samples,
+    rows b*samples..(b+1)*samples-1 belong to input b. Positions past the length are padding.
+    """
+    def __init__(self, argmax_actions, argmax_lens, actions, lens, log_probs, samples):
+        self.argmax_actions = argmax_actions
+        self.argmax_lens = argmax_lens
+        self.actions = actions
+        self.lens = lens
+        self.log_probs = log_probs
+        self.samples = samples
+
+    def mask(self):
+        """
+        Float [B*samples,T] mask of the real positions of samples.
+        """
+        positions = torch.arange(self.actions.size(1),device=self.actions.device)
+        return (positions.unsqueeze(0) < self.lens.unsqueeze(1)).float()
+
+    def to_lists(self):
+        """
+        Copies actions to the host once, returns token lists of argmax rows and of sample rows.
+        """
+        def cut(actions,lens):
+            return [row[:l] for row,l in zip(actions.tolist(),lens.tolist())]
+        return cut(self.argmax_actions,self.argmax_lens),cut(self.actions,self.lens)
 
 """
 Following functions can be used to process the input that will be given to the
@@ -144,18 +464,27 @@ model. It has to be in the form of PyTorch Tensor.
 
 We are only padding the input phrases but not response phrases.
 """
-"""
-
-Inputs: batch is list of tuples(phrase,reply) (They are in the form of token IDs).
-        embeddings(dictionary) is used to convert token ids to embeddings.
-        (Unique token ids for each token will be converted into
-        a vector of real numbers(embeddings) for sentences).
-
-Outputs : packed sequence to be given to encoder,
-          list of lists of integer ids of phrases and replies.
-"""
+class PreparedBatch:
+    """
+    Batch converted into index tensors on CPU, ready to be moved to the device and embedded.
+    input_seq is PackedSequence of token IDs of phrases, lens are their lengths,
+    phr and rep are lists of token IDs of phrases and replies.
+    output_seqs are PackedSequences of token IDs of replies(without '#END') for teacher-forcing,
+    they are only filled by prepare_batch().
+    """
+    def __init__(self, input_seq, lens, phr, rep, output_seqs=None):
+        self.input_seq = input_seq
+        self.lens = lens
+        self.phr = phr
+        self.rep = rep
+        self.output_seqs = output_seqs
 
-def pack_batch_no_out(batch, embeddings, device="cpu"):
+def prepare_batch_no_out(batch, pin_memory=False):
+    """
+    CPU part of pack_batch_no_out(), it doesn't touch the model, so it can run in a background
+    thread(see pipeline.BatchPrefetcher). With pin_memory the index tensors are put into page-locked
+    memory, which makes copying them to GPU asynchronous.
+    """
     assert isinstance(batch,list) #check if batch is a list.
     """
     Sorting them in descending(when reverse='True') order for CuDNN(CUDA backend).
@@ -175,7 +504,7 @@ def pack_batch_no_out(batch, embeddings, device="cpu"):
     for idx,phrase in enumerate(phr):
         #For every row, upto len(phrase) column fill it with phrase(Remaining were already padded with zeros).
         input_matrix[idx, :len(phrase)] = phrase
-    input_tensor = torch.tensor(input_matrix).to(device)
+    input_tensor = torch.tensor(input_matrix)
     """
     This is an in-built function.
     Inputs : The tensor with phrases, list of length of phrases,batch_first is true,
@@ -186,11 +515,57 @@ def pack_batch_no_out(batch, embeddings, device="cpu"):
     Output : PackedSequence ready to be given to LSTM.
     """
     input_seq = rnn_utils.pack_padded_sequence(input_tensor,lens,batch_first=True)
-    #Convert to word embeddings.
-    r = embeddings(input_seq.data)
-    #Convert the embeddings to PackedSequence.
-    emb_input_seq = rnn_utils.PackedSequence(r,input_seq.batch_sizes)
-    return emb_input_seq, phr,rep
+    return PreparedBatch(_pin_seq(input_seq,pin_memory),lens,phr,rep)
+
+def prepare_batch(batch, pin_memory=False):
+    """
+    CPU part of pack_batch(), also packs token IDs of replies without '#END' token.
+    """
+    prepared = prepare_batch_no_out(batch,pin_memory)
+    prepared.output_seqs = []
+    for each in prepared.rep:
+        output_v = torch.LongTensor([each[:-1]])
+        output_seq = rnn_utils.pack_padded_sequence(output_v,[len(each)-1],batch_first=True)
+        prepared.output_seqs.append(_pin_seq(output_seq,pin_memory))
+    return prepared
+
+def _pin_seq(seq, pin_memory):
+    if not pin_memory:
+        return seq
+    return rnn_utils.PackedSequence(seq.data.pin_memory(),seq.batch_sizes)
+
+def _embed_seq(seq, embeddings, device):
+    #Packing only reorders the tokens, so embedding packed IDs is the same as packing embeddings.
+    data = seq.data.to(device,non_blocking=True)
+    return rnn_utils.PackedSequence(embeddings(data),seq.batch_sizes)
+
+def embed_batch_no_out(prepared, embeddings, device="cpu"):
+    """
+    Device part of pack_batch_no_out(): copies index tensors and converts them to word embeddings.
+    """
+    return _embed_seq(prepared.input_seq,embeddings,device), prepared.phr, prepared.rep
+
+def embed_batch(prepared, embeddings, device="cpu"):
+    """
+    Device part of pack_batch(), the batch has to be made by prepare_batch().
+    """
+    emb_input_seq = _embed_seq(prepared.input_seq,embeddings,device)
+    emb_output_seq_list = [_embed_seq(seq,embeddings,device) for seq in prepared.output_seqs]
+    return emb_input_seq,emb_output_seq_list,prepared.phr,prepared.rep
+
+"""
+
+Inputs: batch is list of tuples(phrase,reply) (They are in the form of token IDs).
+        embeddings(dictionary) is used to convert token ids to embeddings.
+        (Unique token ids for each token will be converted into
+        a vector of real numbers(embeddings) for sentences).
+
+Outputs : packed sequence to be given to encoder,
+          list of lists of integer ids of phrases and replies.
+"""
+
+def pack_batch_no_out(batch, embeddings, device="cpu"):
+    return embed_batch_no_out(prepare_batch_no_out(batch),embeddings,device)
 
 def pack_input(input_data,embeddings,device="cpu"):
     """
@@ -207,12 +582,102 @@ def pack_batch(batch, embeddings, device="cpu"):
     into list of packed sequences to be used in teacher-forcing mode of training.
     It also removes '#END' token from sentences.
     """
-    emb_input_seq,phr,rep = pack_batch_no_out(batch,embeddings,device)
-    emb_output_seq_list = []
-    for each in rep:
-        #Remove the '#END' token.
-        emb_output_seq_list.append(pack_input(each[:-1],embeddings,device))
-    return emb_input_seq,emb_output_seq_list,phr,rep
+    return embed_batch(prepare_batch(batch),embeddings,device)
+
+def pack_teacher_batch(replies, embeddings, device="cpu"):
+    """
+    Packs replies of several samples to run teacher-forcing for all of them in one decode_teacher() call.
+    Inputs are the replies without '#END' token and targets are the replies without '#BEG' token.
+    Both have the same lengths, so they are packed in the same order and logits of decode_teacher()
+    match target token IDs row by row. Replies don't have to be sorted, LSTM takes the hidden state
+    rows in the order of replies.
+    Outputs : PackedSequence of embeddings and PackedSequence of target token IDs.
+    """
+    input_seq = rnn_utils.pack_sequence([torch.LongTensor(r[:-1]) for r in replies],enforce_sorted=False).to(device)
+    target_seq = rnn_utils.pack_sequence([torch.LongTensor(r[1:]) for r in replies],enforce_sorted=False).to(device)
+    emb_seq = rnn_utils.PackedSequence(embeddings(input_seq.data),input_seq.batch_sizes,
+                                       input_seq.sorted_indices,input_seq.unsorted_indices)
+    return emb_seq,target_seq
+
+def unpack_tokens(tokens, packed_like):
+    """
+    Converts token IDs in packed order(like argmax of decode_teacher() logits) back to
+    a list of token lists in the order of the original sequences.
+    """
+    seq = rnn_utils.PackedSequence(tokens,packed_like.batch_sizes,packed_like.sorted_indices,packed_like.unsorted_indices)
+    padded,lens = rnn_utils.pad_packed_sequence(seq,batch_first=True)
+    return [row[:l] for row,l in zip(padded.tolist(),lens.tolist())]
+
+def quantize_dynamic(net):
+    """
+    Dynamic int8 quantization for inference on CPU: weights of both LSTMs and of the Linear layers of
+    the output(dense or adaptive) are stored as int8 and activations are quantized on the fly.
+    Embeddings stay in fp32. Returns a new model, net itself is moved to CPU but left in fp32.
+    """
+    return torch.ao.quantization.quantize_dynamic(net.cpu().eval(),{nn.LSTM,nn.Linear},dtype=torch.qint8)
+
+def save_checkpoint(net,path,emb_dict):
+    """
+    Saves weights of the model together with its configuration and the fingerprint of its dictionary,
+    so load_checkpoint() rebuilds the model without knowing how it was trained.
+    """
+    torch.save({"version":CHECKPOINT_VERSION,"config":net.config,
+                "vocab_fingerprint":vocabulary.fingerprint(emb_dict),"state_dict":net.state_dict()},path)
+
+def load_checkpoint(path,emb_dict=None,device="cpu",output="dense"):
+    """
+    Builds PhraseModel from a checkpoint of save_checkpoint() on device. With emb_dict, the checkpoint
+    has to be trained with the same dictionary. Checkpoints saved before the configuration was stored
+    hold only the state_dict, they get the default sizes, len(emb_dict) words and the given output layer.
+    """
+    #Checkpoints hold only tensors and plain types, so they load without unpickling arbitrary objects.
+    data = torch.load(path,map_location=device,weights_only=True)
+    if "state_dict" in data:
+        if data["version"] != CHECKPOINT_VERSION:
+            raise ValueError("Unsupported checkpoint version %d in %s" % (data["version"],path))
+        if emb_dict is not None and data["vocab_fingerprint"] != vocabulary.fingerprint(emb_dict):
+            raise ValueError("Checkpoint %s was trained with another dictionary" % path)
+        config,state = data["config"],data["state_dict"]
+    else:
+        if emb_dict is None:
+            raise ValueError("Checkpoint %s has no configuration, the dictionary is needed to load it" % path)
+        config = dict(emb_size=EMBEDDING_DIM,dict_size=len(emb_dict),hid_size=HIDDEN_STATE_SIZE,output=output)
+        state = data
+    net = PhraseModel(**config)
+    net.load_state_dict(state)
+    return net.to(device)
+
+def autocast(device,enabled=True):
+    """
+    Autocast context of the mixed-precision training mode: bfloat16 on CPU and float16 on GPU,
+    where the loss needs grad_scaler(). enabled=False keeps everything in fp32.
+    """
+    device_type = torch.device(device).type
+    dtype = torch.float16 if device_type == "cuda" else torch.bfloat16
+    return torch.autocast(device_type,dtype=dtype,enabled=enabled)
+
+def grad_scaler(device,enabled=True):
+    """
+    Gradient scaler of the mixed-precision mode. Small float16 gradients underflow without scaling,
+    bfloat16 has the exponent range of fp32, so on CPU the scaler only calls backward() and step().
+    """
+    device_type = torch.device(device).type
+    return torch.amp.GradScaler(device_type,enabled=enabled and device_type == "cuda")
+
+def run_lstm(lstm,x,hid=None):
+    """
+    Calls lstm on x with hid. CPU autocast casts only padded input of LSTMs, so for a PackedSequence
+    the input, the state and the weights are cast to the autocast dtype here. The weights are given to
+    torch.func.functional_call(), so the module keeps its fp32 parameters and gradients reach them
+    through the differentiable casts.
+    """
+    if not (isinstance(x,rnn_utils.PackedSequence) and x.data.device.type == "cpu" and torch.is_autocast_enabled("cpu")):
+        return lstm(x,hid)
+    dtype = torch.get_autocast_dtype("cpu")
+    params = {name: p.to(dtype) for name,p in lstm.named_parameters()}
+    if hid is not None:
+        hid = tuple(h.to(dtype) for h in hid)
+    return torch.func.functional_call(lstm,params,(x._replace(data=x.data.to(dtype)),hid))
 
 def seq_bleu(model_out,ref_seq):
     """
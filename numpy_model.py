@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+"""
+Inference of a trained PhraseModel in NumPy only, for the command line and deployments where the start
+time matters: importing torch takes longer than replying to a phrase.
+The model is read from the .npz archive written by 'export.py --format npz': state_dict arrays under
+their PhraseModel names plus the dictionary. Encoding and decoding follow nn.LSTM and the dense output
+layer step by step, so greedy replies are the same as PhraseModel.decode_chain_argmax() gives.
+"""
+import argparse
+import logging
+
+import numpy as np
+
+from utilities import high_level_cornell, vocabulary
+import utils
+
+#Version of the archive layout, written by export.export_npz().
+NPZ_VERSION = 1
+
+log = logging.getLogger("use")
+
+
+def _sigmoid(x, out):
+    np.negative(x, out=out)
+    np.exp(out, out=out)
+    out += 1.0
+    np.reciprocal(out, out=out)
+    return out
+
+
+class NumpyLSTM:
+    """
+    One layer of nn.LSTM with gates in PyTorch order(input, forget, cell, output).
+    Step buffers are allocated once and reused, so decoding doesn't allocate per token. The encoder layers
+    also keep their state and per-phrase buffers for rows tokens, grown only when a longer phrase comes.
+    """
+    def __init__(self, state, prefix, layer=0, rows=1):
+        name = "%s.%%s_l%d" % (prefix, layer)
+        self.w_ih = np.ascontiguousarray(state[name % "weight_ih"])
+        self.w_hh = np.ascontiguousarray(state[name % "weight_hh"])
+        self.bias = state[name % "bias_ih"] + state[name % "bias_hh"]
+        self.hid_size = self.w_hh.shape[1]
+        self.gates = np.empty(4 * self.hid_size, dtype=np.float32)
+        self.hh = np.empty(4 * self.hid_size, dtype=np.float32)
+        self.x_proj = np.empty(4 * self.hid_size, dtype=np.float32)
+        self.tmp = np.empty(self.hid_size, dtype=np.float32)
+        self.h = np.empty(self.hid_size, dtype=np.float32)
+        self.c = np.empty(self.hid_size, dtype=np.float32)
+        self.resize(rows)
+
+    def resize(self, rows):
+        """
+        Allocates the buffers of the input projection and the outputs of a phrase of up to rows tokens.
+        """
+        self.proj_buf = np.empty((rows, 4 * self.hid_size), dtype=np.float32)
+        self.out_buf = np.empty((rows, self.hid_size), dtype=np.float32)
+
+    def step(self, x_proj, h, c):
+        """
+        Updates h and c in place, x_proj is the input already multiplied by w_ih with the bias added.
+        """
+        size = self.hid_size
+        np.dot(self.w_hh, h, out=self.hh)
+        np.add(x_proj, self.hh, out=self.gates)
+        gates = self.gates
+        _sigmoid(gates[:2 * size], gates[:2 * size])
+        np.tanh(gates[2 * size:3 * size], out=gates[2 * size:3 * size])
+        _sigmoid(gates[3 * size:], gates[3 * size:])
+        #c = f * c + i * g, h = o * tanh(c)
+        c *= gates[size:2 * size]
+        np.multiply(gates[:size], gates[2 * size:3 * size], out=self.tmp)
+        c += self.tmp
+        np.tanh(c, out=self.tmp)
+        np.multiply(gates[3 * size:], self.tmp, out=h)
+
+    def project(self, x):
+        """
+        Input projection of all the rows of x at once into the reused buffer.
+        """
+        if len(x) > len(self.proj_buf):
+            self.resize(len(x))
+        proj = self.proj_buf[:len(x)]
+        np.dot(x, self.w_ih.T, out=proj)
+        proj += self.bias
+        return proj
+
+    def project_one(self, x):
+        """
+        Input projection of one vector into the reused buffer.
+        """
+        np.dot(self.w_ih, x, out=self.x_proj)
+        self.x_proj += self.bias
+        return self.x_proj
+
+
+class NumpyPhraseModel:
+    """
+    Greedy and sampling replies of a model exported to .npz, see PhraseModel for the meaning of the parts.
+    """
+    def __init__(self, path):
+        with np.load(path) as archive:
+            state = {name: archive[name] for name in archive.files}
+        if int(state["npz_version"]) != NPZ_VERSION:
+            raise ValueError("Unsupported archive version %d in %s" % (int(state["npz_version"]), path))
+        self.emb = state["emb.weight"]
+        #Stacked layers of nn.LSTM have weights ending with _l0, _l1, ...
+        layers = sum(1 for name in state if name.startswith("encoder.weight_ih_l"))
+        self.max_tokens = int(state["max_tokens"])
+        #Phrases of the training data have up to max_tokens words between #BEG and #END.
+        self.encoder = [NumpyLSTM(state, "encoder", layer, self.max_tokens + 2) for layer in range(layers)]
+        self.decoder = [NumpyLSTM(state, "decoder", layer) for layer in range(layers)]
+        self.out_w = np.ascontiguousarray(state["output.0.weight"])
+        self.out_b = state["output.0.bias"]
+        self.vocab = vocabulary.Vocabulary(state["vocab"].tobytes())
+        self.end_token = int(state["end_token"])
+        self.logits = np.empty(len(self.out_b), dtype=np.float32)
+        self.probs = np.empty(len(self.out_b), dtype=np.float32)
+        self.cdf = np.empty(len(self.out_b), dtype=np.float32)
+        self.rand = np.random.RandomState()
+
+    def encode(self, tokens):
+        """
+        List of hidden and cell states of every encoder layer after the token IDs of the phrase.
+        The states are buffers of the encoder layers, so they are valid until the next call.
+        """
+        x = self.emb[tokens]
+        hid = []
+        for layer in self.encoder:
+            h, c = layer.h, layer.c
+            h.fill(0.0)
+            c.fill(0.0)
+            proj = layer.project(x)
+            #Outputs of the layer are the input of the next one.
+            out = layer.out_buf[:len(tokens)]
+            for idx in range(len(tokens)):
+                layer.step(proj[idx], h, c)
+                out[idx] = h
+            hid.append((h, c))
+            x = out
+        return hid
+
+    def decode(self, hid, begin_token, seq_len, stop_token=None, sample=False, temperature=1.0):
+        """
+        Token IDs of the decoded reply(stop_token included), states of hid are updated in place.
+        """
+        token = begin_token
+        out_tokens = []
+        for _ in range(seq_len):
+            x = self.emb[token]
+            for layer, (h, c) in zip(self.decoder, hid):
+                layer.step(layer.project_one(x), h, c)
+                x = h
+            np.dot(self.out_w, x, out=self.logits)
+            self.logits += self.out_b
+            if sample:
+                np.multiply(self.logits, 1.0 / temperature, out=self.probs)
+                self.probs -= self.probs.max()
+                np.exp(self.probs, out=self.probs)
+                np.cumsum(self.probs, out=self.cdf)
+                token = int(np.searchsorted(self.cdf, self.rand.random_sample() * self.cdf[-1], side="right"))
+                token = min(token, len(self.cdf) - 1)
+            else:
+                token = int(np.argmax(self.logits))
+            out_tokens.append(token)
+            if stop_token is not None and token == stop_token:
+                break
+        return out_tokens
+
+    def reply_tokens(self, tokens, sample=False, temperature=1.0):
+        out_tokens = self.decode(self.encode(tokens), tokens[0], self.max_tokens, self.end_token, sample, temperature)
+        if out_tokens and out_tokens[-1] == self.end_token:
+            out_tokens = out_tokens[:-1]
+        return out_tokens
+
+    def reply(self, words, sample=False, temperature=1.0):
+        tokens = high_level_cornell.encode_words(words, self.vocab)
+        return high_level_cornell.decode_words(self.reply_tokens(tokens, sample, temperature), self.vocab)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(format="%(asctime)-15s %(levelname)s %(message)s", level=logging.INFO)
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-m", "--model", required=True, help="Archive written by 'export.py --format npz'")
+    parser.add_argument("-s", "--string", help="String to process, otherwise will loop")
+    parser.add_argument("--sample", default=False, action="store_true", help="Enable sampling generation instead of argmax")
+    parser.add_argument("--temperature", type=float, default=1.0, help="Temperature of sampling")
+    parser.add_argument("--self", type=int, default=1, help="Enable self-loop mode with given amount of phrases.")
+    args = parser.parse_args()
+    if args.temperature <= 0:
+        parser.error("--temperature should be positive")
+
+    net = NumpyPhraseModel(args.model)
+    while True:
+        if args.string:
+            input_string = args.string
+        else:
+            input_string = input(">>> ")
+        if not input_string:
+            break
+
+        words = utils.tokenize(input_string)
+        for _ in range(args.self):
+            words = net.reply(words, sample=args.sample, temperature=args.temperature)
+            print(utils.untokenize(words))
+
+        if args.string:
+            break
@@ -0,0 +1,66 @@
+"""
+Background preparation of training batches.
+Sorting a batch, filling the padded index matrix and packing sequences doesn't need the model,
+so a worker thread does it for the next batches while the training loop runs the forward
+and backward passes. The loop is left with copying index tensors and the embedding lookup.
+"""
+import queue
+import threading
+
+#Marks the end of the batches in the queue.
+_END = object()
+
+
+class BatchPrefetcher:
+    """
+    Iterates prepare(batch) results for every batch of batches.
+    Up to depth prepared batches are kept ready in a bounded queue, so memory stays limited
+    however fast the worker is. With depth=0 batches are prepared synchronously in the caller thread.
+    Exceptions from the worker thread are raised in the caller.
+    """
+    def __init__(self, batches, prepare, depth=2):
+        self.batches = batches
+        self.prepare = prepare
+        self.depth = depth
+
+    def __iter__(self):
+        if self.depth <= 0:
+            for batch in self.batches:
+                yield self.prepare(batch)
+            return
+        q = queue.Queue(maxsize=self.depth)
+        stop = threading.Event()
+
+        def put(item):
+            #Returns False when the consumer has gone away.
+            while not stop.is_set():
+                try:
+                    q.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        def worker():
+            try:
+                for batch in self.batches:
+                    if not put((self.prepare(batch), None)):
+                        return
+                put((_END, None))
+            except Exception as e:
+                put((_END, e))
+
+        thread = threading.Thread(target=worker, name="batch-prefetch", daemon=True)
+        thread.start()
+        try:
+            while True:
+                item, error = q.get()
+                if error is not None:
+                    raise error
+                if item is _END:
+                    break
+                yield item
+        finally:
+            #The caller may leave the loop early, the worker mustn't stay blocked on the full queue.
+            stop.set()
+            thread.join()
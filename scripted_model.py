@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+"""
+Chatting with a model exported by export.py.
+The TorchScript archive has the compiled encoder and decode loops together with the dictionary,
+so neither model.py nor the checkpoint directory is needed here.
+"""
+import argparse
+import logging
+
+import torch
+
+from utilities import high_level_cornell, vocabulary
+import utils
+
+#Name of the vocabulary inside of the archive, the same as export.VOCAB_FILE.
+VOCAB_FILE = "vocab.bin"
+
+log = logging.getLogger("use")
+
+
+class ScriptedChatbot:
+    """
+    Replies of the exported model, greedy or sampled with the given temperature, top_k and top_p.
+    """
+    def __init__(self, path, sample=False, temperature=1.0, top_k=0, top_p=1.0):
+        extra_files = {VOCAB_FILE: ""}
+        self.module = torch.jit.load(path, map_location="cpu", _extra_files=extra_files)
+        self.vocab = vocabulary.Vocabulary(extra_files[VOCAB_FILE])
+        self.sample = sample
+        self.temperature = temperature
+        self.top_k = top_k
+        self.top_p = top_p
+
+    def reply_tokens(self, tokens):
+        with torch.no_grad():
+            out = self.module(torch.LongTensor(tokens), self.sample, self.temperature, self.top_k, self.top_p)
+        return out.tolist()
+
+    def reply(self, words):
+        tokens = high_level_cornell.encode_words(words, self.vocab)
+        return high_level_cornell.decode_words(self.reply_tokens(tokens), self.vocab)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(format="%(asctime)-15s %(levelname)s %(message)s", level=logging.INFO)
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-m", "--model", required=True, help="TorchScript archive written by export.py")
+    parser.add_argument("-s", "--string", help="String to process, otherwise will loop")
+    parser.add_argument("--sample", default=False, action="store_true", help="Enable sampling generation instead of argmax")
+    parser.add_argument("--temperature", type=float, default=1.0, help="Temperature of sampling")
+    parser.add_argument("--top-k", type=int, default=0, help="Sample only from given count of most probable words, 0 for all")
+    parser.add_argument("--top-p", type=float, default=1.0, help="Sample only from most probable words with this probability mass")
+    parser.add_argument("--self", type=int, default=1, help="Enable self-loop mode with given amount of phrases.")
+    args = parser.parse_args()
+    if args.temperature <= 0 or args.top_k < 0 or not 0 < args.top_p <= 1:
+        parser.error("--temperature should be positive, --top-k not negative and --top-p in range (0, 1]")
+
+    bot = ScriptedChatbot(args.model, sample=args.sample, temperature=args.temperature, top_k=args.top_k, top_p=args.top_p)
+    while True:
+        if args.string:
+            input_string = args.string
+        else:
+            input_string = input(">>> ")
+        if not input_string:
+            break
+
+        words = utils.tokenize(input_string)
+        for _ in range(args.self):
+            words = bot.reply(words)
+            print(utils.untokenize(words))
+
+        if args.string:
+            break
@@ -0,0 +1,135 @@
+"""
+Multi-turn conversations with a trained model.
+A ChatSession keeps the LSTM state of one conversation between turns, so a new phrase is encoded
+starting from where the previous turn ended instead of re-encoding anything from scratch.
+SessionStore holds many sessions keyed by an ID and evicts the least recently used ones,
+so a long-running process keeps a bounded amount of memory whatever the count of conversations is.
+"""
+import collections
+
+import torch
+
+from utilities import high_level_cornell
+import model
+
+#Sessions kept by SessionStore by default, every one holds two [1,1,H] tensors.
+STORE_CAPACITY = 1000
+
+
+class ChatSession:
+    """
+    One conversation. Every turn a phrase is encoded and the reply is decoded greedily,
+    by sampling(reshaped by temperature, top_k and top_p) or by beam search of width beam.
+    With keep_context the encoder state is carried over turns: the phrase is encoded starting from
+    the state after the previous turn and the reply is fed to the encoder too, so the next phrase
+    continues the whole conversation with the cost of its own tokens only.
+    Without it every phrase is encoded from zero state, the same as the model was trained.
+    """
+    def __init__(self, net, emb_dict, rev_emb_dict, keep_context=False, use_sampling=False, beam=0,
+                 temperature=1.0, top_k=0, top_p=1.0):
+        self.net = net
+        self.emb_dict = emb_dict
+        self.rev_emb_dict = rev_emb_dict
+        self.keep_context = keep_context
+        self.use_sampling = use_sampling
+        self.beam = beam
+        self.temperature = temperature
+        self.top_k = top_k
+        self.top_p = top_p
+        self.end_token = emb_dict[high_level_cornell.END_TOKEN]
+        #Encoder state after the last turn, None before the first one.
+        self.state = None
+        self.turns = 0
+
+    def reset(self):
+        self.state = None
+        self.turns = 0
+
+    def _encode(self, tokens, hid):
+        device = next(self.net.parameters()).device
+        return self.net.encode(model.pack_input(tokens, self.net.emb, device), hid)
+
+    def reply_tokens(self, tokens):
+        """
+        Token IDs of the reply(without '#END') to the encoded phrase(with '#BEG' and '#END').
+        """
+        with torch.no_grad():
+            hid = self._encode(tokens, self.state if self.keep_context else None)
+            begin_emb = self.net.emb(torch.LongTensor(tokens[:1]).to(hid[0].device))
+            if self.beam:
+                out_tokens = self.net.decode_beam(hid, begin_emb, high_level_cornell.MAX_TOKENS, self.beam,
+                                                  stop_token=self.end_token)[0][0]
+            elif self.use_sampling:
+                _, out_tokens = self.net.decode_chain_sampling(hid, begin_emb, high_level_cornell.MAX_TOKENS,
+                                                               stop_token=self.end_token, temperature=self.temperature,
+                                                               top_k=self.top_k, top_p=self.top_p)
+            else:
+                _, out_tokens = self.net.decode_chain_argmax(hid, begin_emb, high_level_cornell.MAX_TOKENS,
+                                                             stop_token=self.end_token)
+            if out_tokens and out_tokens[-1] == self.end_token:
+                out_tokens = out_tokens[:-1]
+            if self.keep_context:
+                #The reply is the part of conversation the next phrase follows.
+                reply = [tokens[0]] + out_tokens + [self.end_token]
+                self.state = self._encode(reply, hid)
+        self.turns += 1
+        return out_tokens
+
+    def reply(self, words):
+        tokens = high_level_cornell.encode_words(words, self.emb_dict)
+        return high_level_cornell.decode_words(self.reply_tokens(tokens), self.rev_emb_dict)
+
+    def self_talk(self, words, count):
+        """
+        Model talks to itself for count turns starting from words, every reply is the next phrase.
+        Replies are passed on as token IDs, so words are not looked up again. Returns list of replies.
+        """
+        tokens = high_level_cornell.encode_words(words, self.emb_dict)
+        out = []
+        for _ in range(count):
+            reply = self.reply_tokens(tokens)
+            out.append(high_level_cornell.decode_words(reply, self.rev_emb_dict))
+            tokens = [tokens[0]] + reply + [self.end_token]
+        return out
+
+
+class SessionStore:
+    """
+    ChatSessions by ID with least recently used eviction once there are more than capacity of them.
+    Evicted conversations start over with the next phrase.
+    """
+    def __init__(self, net, emb_dict, rev_emb_dict, capacity=STORE_CAPACITY, **session_args):
+        self.net = net
+        self.emb_dict = emb_dict
+        self.rev_emb_dict = rev_emb_dict
+        self.capacity = capacity
+        self.session_args = session_args
+        self.sessions = collections.OrderedDict()
+        self.evicted = 0
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def __contains__(self, session_id):
+        return session_id in self.sessions
+
+    def get(self, session_id):
+        """
+        Session with given ID, a new one if there is no such session. It becomes the most recently used.
+        """
+        session = self.sessions.get(session_id)
+        if session is None:
+            session = ChatSession(self.net, self.emb_dict, self.rev_emb_dict, **self.session_args)
+            self.sessions[session_id] = session
+            while len(self.sessions) > self.capacity:
+                self.sessions.popitem(last=False)
+                self.evicted += 1
+        else:
+            self.sessions.move_to_end(session_id)
+        return session
+
+    def drop(self, session_id):
+        self.sessions.pop(session_id, None)
+
+    def reply(self, session_id, words):
+        return self.get(session_id).reply(words)
@@ -0,0 +1,104 @@
+"""
+Output layers of PhraseModel for large vocabularies.
+The dense layer computes a score for every word of the dictionary at every step. Dictionary IDs are
+ordered by word frequency(special tokens first), so the adaptive softmax can give frequent words a full
+size head and put rare ones into smaller clusters, and sampled softmax can draw negative words from
+a log-uniform distribution over IDs. Scores of every word are still available from both layers,
+so decoding is exact whichever layer the model was trained with.
+"""
+import math
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+OUTPUT_MODES = ("dense", "adaptive")
+#Words with IDs below the first cutoff are in the head, then one cluster per interval.
+ADAPTIVE_CUTOFFS = (2000, 10000)
+#Every next cluster gets hid_size / ADAPTIVE_DIV_VALUE ** n features.
+ADAPTIVE_DIV_VALUE = 4.0
+
+
+class AdaptiveOutput(nn.Module):
+    """
+    Adaptive softmax output. forward() returns exact log-probabilities of all words, which work as logits
+    everywhere the dense layer's output is used(argmax, softmax, cross-entropy give the same results).
+    Training and greedy decoding can avoid the full distribution with output_nll() and output_predict().
+    """
+    def __init__(self, hid_size, dict_size, cutoffs=ADAPTIVE_CUTOFFS, div_value=ADAPTIVE_DIV_VALUE):
+        super(AdaptiveOutput, self).__init__()
+        #Small dictionaries get one cluster of the less frequent half.
+        cutoffs = [c for c in cutoffs if c < dict_size - 1] or [dict_size // 2]
+        self.adaptive = nn.AdaptiveLogSoftmaxWithLoss(hid_size, dict_size, cutoffs, div_value=div_value)
+
+    def forward(self, x):
+        #The adaptive softmax takes 2D input only, decoder steps are [B,1,H].
+        return self.adaptive.log_prob(x.reshape(-1, x.size(-1))).view(*x.shape[:-1], -1)
+
+    def predict(self, x):
+        return self.adaptive.predict(x.reshape(-1, x.size(-1))).view(x.shape[:-1])
+
+    def target_log_probs(self, x, targets):
+        return self.adaptive(x, targets).output
+
+
+def make_output(mode, hid_size, dict_size):
+    if mode == "dense":
+        return nn.Sequential(nn.Linear(hid_size, dict_size))
+    if mode == "adaptive":
+        return AdaptiveOutput(hid_size, dict_size)
+    raise ValueError("Unknown output layer %r, expected one of %s" % (mode, ", ".join(OUTPUT_MODES)))
+
+
+"""
+Log of expected count of word IDs among count draws from the log-uniform(Zipfian) distribution
+over dict_size IDs, P(k) = log((k+2)/(k+1)) / log(dict_size+1), which suits frequency-ordered IDs.
+"""
+def log_uniform_expected(ids, count, dict_size):
+    ids = ids.float()
+    return torch.log(torch.log((ids + 2) / (ids + 1)) / math.log(dict_size + 1) * count)
+
+"""
+Draws count word IDs from the log-uniform distribution.
+"""
+def log_uniform_sample(count, dict_size, device="cpu"):
+    ids = torch.exp(torch.rand(count, device=device) * math.log(dict_size + 1)).long() - 1
+    return ids.clamp(0, dict_size - 1)
+
+
+"""
+Sampled softmax loss(sum over tokens) of the dense output layer: the target word competes only with
+sampled words, shared by all tokens of the batch. Scores of the target and sampled words are corrected
+by log of their expected counts, sampled words equal to the target are left out.
+"""
+def sampled_softmax_nll(linear, hidden, targets, sampled):
+    dict_size = linear.out_features
+    ids = log_uniform_sample(sampled, dict_size, hidden.device)
+    true_logits = (hidden * linear.weight[targets]).sum(dim=1) + linear.bias[targets] - \
+        log_uniform_expected(targets, sampled, dict_size)
+    sampled_logits = hidden @ linear.weight[ids].t() + linear.bias[ids] - log_uniform_expected(ids, sampled, dict_size)
+    sampled_logits = sampled_logits.masked_fill(targets.unsqueeze(1) == ids.unsqueeze(0), float("-inf"))
+    logits = torch.cat([true_logits.unsqueeze(1), sampled_logits], dim=1)
+    return F.cross_entropy(logits, torch.zeros_like(targets), reduction="sum")
+
+
+"""
+Negative log-likelihood of targets summed over tokens, from decoder outputs [N,H].
+sampled > 0 uses sampled softmax with that many words for the dense layer(training only,
+the adaptive layer is cheap enough on its own).
+"""
+def output_nll(output, hidden, targets, sampled=0):
+    if isinstance(output, AdaptiveOutput):
+        return -output.target_log_probs(hidden, targets).sum()
+    if sampled:
+        return sampled_softmax_nll(output[0], hidden, targets, sampled)
+    return F.cross_entropy(output(hidden), targets, reduction="sum")
+
+
+"""
+Most probable word of every row of decoder outputs [N,H], exact for both layers.
+"""
+def output_predict(output, hidden):
+    if isinstance(output, AdaptiveOutput):
+        return output.predict(hidden)
+    return torch.max(output(hidden), dim=1)[1]
@@ -14,7 +14,8 @@ import torch
 import torch.optim as optim
 import torch.nn.functional as F
 
-import high_level_cornell,model,utils
+from utilities import high_level_cornell, corpus_cache, batching, shards
+import model,utils,pipeline,softmax
 
 SAVES_DIR = "saves"
 
@@ -25,132 +26,232 @@ MAX_EPOCHS = 100
 log = logging.getLogger("train")
 
 TEACH_CURR_PROB = 0.5
+#Test phrases are decoded in batches of this size.
+TEST_BATCH_SIZE = 256
 
-def run_test(test_data, net, end_token, device="cpu"):
+def run_test(test_data, net, end_token, device="cpu", beam=0):
     """
     We calculate mean bleu score for every epoch for hold-out test dataset.
     Inputs: small test dataset, our LSTM network, end_token.
+    Replies are decoded greedily or with beam search of width beam.
     """
     bleu_sum = 0.0
     bleu_count = 0
 
-    for p1,p2 in test_data:
-        #Encoded phrase to packed sequence.
-        input_seq = model.pack_input(p1, net.emb, device)
+    for start in range(0,len(test_data),TEST_BATCH_SIZE):
+        batch = list(test_data[start:start+TEST_BATCH_SIZE])
+        #Encoded phrases to packed sequence, batch gets sorted by length of phrases.
+        input_seq, phr, rep = model.pack_batch_no_out(batch, net.emb, device)
         #Encode function is used to get hidden state.
         enc = net.encode(input_seq)
-        #Passing hidden state, start_token, seq_len and stop_token to get list of Token IDs.
-        _ , tokens = net.decode_chain_argmax(enc, input_seq.data[0:1],seq_len=high_level_cornell.MAX_TOKENS,stop_token=end_token)
-        #Pass the above tokens along with reference tokens(replies without #BEGIN token).
-        bleu_sum += utils.calc_bleu(tokens,p2[1:])
-        bleu_count += 1
+        #Every phrase starts with its #BEG token.
+        begin_emb = net.emb(torch.LongTensor([p[0] for p in phr]).to(device))
+        #Passing hidden state, start_token, seq_len and stop_token to get list of Token IDs for every phrase.
+        if beam:
+            tokens, _ = net.decode_beam(enc, begin_emb, high_level_cornell.MAX_TOKENS, beam, stop_token=end_token)
+        else:
+            _ , tokens = net.decode_chain_argmax_batch(enc, begin_emb,seq_len=high_level_cornell.MAX_TOKENS,stop_token=end_token)
+        for out_tokens,p2 in zip(tokens,rep):
+            #Pass the above tokens along with reference tokens(replies without #BEGIN token).
+            bleu_sum += utils.calc_bleu(out_tokens,p2[1:])
+            bleu_count += 1
     return bleu_sum / bleu_count
 
+def train_batch(net, input_seq, out_idx, device="cpu", sampled=0):
+    """
+    Cross-entropy loss of one batch, every sample is randomly decoded with teacher-forcing
+    or as argmax chain(curriculum learning). Samples of each kind are decoded together:
+    teacher-forcing ones in one decoder call over packed replies and
+    curriculum ones by decode_chain_argmax_batch() with the length of every reference reply.
+    Teacher-forcing loss skips scores of every word with the adaptive output layer
+    or with sampled softmax of sampled words(sampled > 0).
+    Inputs: packed embedded phrases and token IDs of replies in the same order.
+    Returns loss, sum of BLEU scores and count of samples.
+    """
+    enc = net.encode(input_seq)
+    #Draw for every sample in batch order, as the per-sample loop did.
+    teacher = [random.random() < TEACH_CURR_PROB for _ in out_idx]
+    teach_rows = [idx for idx,t in enumerate(teacher) if t]
+    curr_rows = [idx for idx,t in enumerate(teacher) if not t]
+
+    nll_sum = 0.0
+    token_count = 0
+    bleu_sum = 0.0
+    if teach_rows:
+        #Hidden states of the teacher-forcing samples only.
+        rows_v = torch.LongTensor(teach_rows).to(device)
+        hid = (enc[0].index_select(1,rows_v),enc[1].index_select(1,rows_v))
+        #We give actual output tokens of all the replies and ask it to produce next output tokens.
+        out_seq, target_seq = model.pack_teacher_batch([out_idx[idx] for idx in teach_rows],net.emb,device)
+        out_hidden = net.decode_teacher_hidden(hid,out_seq)
+        nll_sum = nll_sum + net.output_nll(out_hidden,target_seq.data,sampled)
+        token_count += target_seq.data.size(0)
+        with torch.no_grad():
+            tokens = model.unpack_tokens(net.output_predict(out_hidden),out_seq)
+        for idx,seq in zip(teach_rows,tokens):
+            bleu_sum += utils.calc_bleu(seq,out_idx[idx][1:])
+    if curr_rows:
+        rows_v = torch.LongTensor(curr_rows).to(device)
+        hid = (enc[0].index_select(1,rows_v),enc[1].index_select(1,rows_v))
+        begin_emb = net.emb(torch.LongTensor([out_idx[idx][0] for idx in curr_rows]).to(device))
+        #Every sample is decoded for the length of its reference reply.
+        ref_lens = [len(out_idx[idx]) - 1 for idx in curr_rows]
+        r, seqs = net.decode_chain_argmax_batch(hid,begin_emb,ref_lens)
+        ref_seqs = []
+        for idx,seq in zip(curr_rows,seqs):
+            bleu_sum += utils.calc_bleu(seq,out_idx[idx][1:])
+            ref_seqs.extend(out_idx[idx][1:])
+        #Concatenation of logits and of reference token indices in the same order.
+        targets_v = torch.LongTensor(ref_seqs).to(device)
+        nll_sum = nll_sum + F.cross_entropy(torch.cat(r),targets_v,reduction="sum")
+        token_count += len(ref_seqs)
+    #Mean cross entropy loss over all the tokens.
+    loss_v = nll_sum / token_count
+    return loss_v, bleu_sum, len(out_idx)
+
 #Execute the following only when invoked directly.
 if __name__ == "__main__":
     logging.basicConfig(level=logging.INFO,format="%(asctime)-15s %(levelname)s %(message)s")
     #To pass the arguments.
     parser = argparse.ArgumentParser()
-    parser.add_argument("--data", required=True, help="Genre you want to train it on.Empty to train on full dataset.")
+    parser.add_argument("--data", help="Genre you want to train it on.Empty to train on full dataset.")
+    #Shards written by utilities/shards.py, every process reads shards of its rank only.
+    parser.add_argument("--shards", help="Directory with exported shards to train on instead of --data.")
+    parser.add_argument("--rank", type=int, default=0, help="Rank of this process, used with --shards.")
+    parser.add_argument("--world-size", type=int, default=1, help="Count of training processes, used with --shards.")
     #store_true action stores the argument as true.
     parser.add_argument("--cuda", action='store_true', default=False, help="Enable CUDA.")
+    parser.add_argument("--no-cache", action='store_true', default=False, help="Preprocess the corpus again instead of using cached data.")
+    parser.add_argument("--workers", type=int, default=1, help="Count of processes used to tokenize the corpus.")
+    #Lines are looked up in the memory-mapped movie_lines.txt, instead of tokenizing all of them up front.
+    parser.add_argument("--lazy", action='store_true', default=False, help="Tokenize only the lines used by conversations, to save memory.")
+    #Batches of similar length phrases, limited by padded tokens instead of BATCH_SIZE.
+    parser.add_argument("--token-budget", type=int, default=0, help="Max padded tokens of phrases and of replies per batch, 0 to use fixed BATCH_SIZE.")
+    #Batches are packed by a background thread while the model trains on the current one.
+    parser.add_argument("--prefetch", type=int, default=2, help="Count of batches prepared in background, 0 to disable.")
+    parser.add_argument("--beam", type=int, default=0, help="Beam width to decode test phrases, 0 for argmax.")
+    #Adaptive softmax keeps frequent words in a full size head and the rest in smaller clusters.
+    parser.add_argument("--output", choices=softmax.OUTPUT_MODES, default="dense", help="Output layer of the model.")
+    #Sizes of the model, saved with every checkpoint so loaders rebuild the same architecture.
+    parser.add_argument("--hidden-size", type=int, default=model.HIDDEN_STATE_SIZE, help="Size of LSTM hidden state.")
+    parser.add_argument("--emb-size", type=int, default=model.EMBEDDING_DIM, help="Size of word embeddings.")
+    parser.add_argument("--layers", type=int, default=model.NUM_LAYERS, help="Count of LSTM layers of encoder and decoder.")
+    parser.add_argument("--sampled", type=int, default=0, help="Words of sampled softmax for teacher-forcing loss, 0 for full softmax.")
+    #Weights stay in fp32, autocast runs the forward pass and the loss in lower precision.
+    parser.add_argument("--amp", action='store_true', default=False, help="Mixed-precision training: bfloat16 on CPU, float16 with gradient scaling with --cuda.")
     #To save checkpoints and also to use in TensorBoard.
     parser.add_argument("-n","--name",required=True,help="Name of the run")
     args = parser.parse_args()
+    if (args.data is None) == (args.shards is None):
+        parser.error("exactly one of --data and --shards is required")
+    if not 0 <= args.rank < args.world_size:
+        parser.error("--rank should be in range [0, --world-size)")
+    #Encoded pairs have #BEG and #END tokens besides MAX_TOKENS words, every pair has to fit into a batch.
+    if args.token_budget < 0 or 0 < args.token_budget < high_level_cornell.MAX_TOKENS + 2:
+        parser.error("--token-budget should be 0 or at least %d" % (high_level_cornell.MAX_TOKENS + 2))
+    #Adaptive softmax already skips most of the words, sampling is done by the dense layer only.
+    if args.sampled and args.output == "adaptive":
+        parser.error("--sampled can't be used with --output adaptive")
     device = torch.device("cuda" if args.cuda else "cpu")
     saves_path = os.path.join(SAVES_DIR, args.name)
     os.makedirs(saves_path, exist_ok=True)
-    #Outputs (phrase,phrase) list and dictionary with unique IDs for each word.
-    phrase_pairs, emb_dict = high_level_cornell.load_data(genre_filter=args.data)
-    log.info("Obtained %d phrase pairs with %d unique words", len(phrase_pairs),len(emb_dict))
+    """
+    Outputs encoded pairs [(list of tokens IDs of p11,list of token IDs of p21),
+                           (list of tokens IDs of p12,list of token IDs of p22)]
+    and dictionary with unique IDs for each word.
+    """
+    if args.shards:
+        #Shards hold the training set already shuffled and split, with the dictionary and the test set.
+        shard_reader = shards.ShardReader(args.shards,args.rank,args.world_size,seed=high_level_cornell.SHUFFLE_SEED)
+        emb_dict = high_level_cornell.load_emb_dict(args.shards)
+        test_data = shards.load_test_pairs(args.shards)
+        if test_data is None:
+            parser.error("%s has no test pairs, export the shards again" % args.shards)
+        rand = np.random.RandomState([high_level_cornell.SHUFFLE_SEED,args.rank])
+        log.info("Rank %d of %d has %d training samples and %d test samples",
+                 args.rank,args.world_size,len(shard_reader),len(test_data))
+    else:
+        shard_reader = None
+        train_data, emb_dict = high_level_cornell.load_encoded_data(genre_filter=args.data,
+                                                                    cache_dir=None if args.no_cache else corpus_cache.CACHE_DIR,
+                                                                    workers=args.workers,lazy=args.lazy)
+        log.info("Obtained %d encoded pairs with %d unique words", len(train_data),len(emb_dict))
+        #Shuffle with seed as we have to shuffle it same way while using RL.
+        rand = np.random.RandomState(high_level_cornell.SHUFFLE_SEED)
+        train_data.shuffle(rand)
+        log.info("Training data consisting of %d samples was shuffled", len(train_data))
+        #Splitting into training and testing dataset.
+        train_data,test_data = high_level_cornell.split_train_test(train_data)
+        log.info("Training set has %d samples and test set has %d samples",len(train_data),len(test_data))
     #We save the embedding dictionary.
     high_level_cornell.save_emb_dict(saves_path,emb_dict)
     #Access the end token(#END)
     end_token = emb_dict[high_level_cornell.END_TOKEN]
-    """
-    (phrase,phrase) list becomes [(list of tokens IDs of p11,list of token IDs of p21),
-                                  (list of tokens IDs of p12,list of token IDs of p22)]
-    """
-    train_data = high_level_cornell.encode_phrase_pairs(phrase_pairs, emb_dict)
-    #Shuffle with seed as we have to shuffle it same way while using RL.
-    rand = np.random.RandomState(high_level_cornell.SHUFFLE_SEED)
-    rand.shuffle(train_data)
-    log.info("Training data consisting of %d samples was shuffled", len(train_data))
-    #Splitting into training and testing dataset.
-    train_data,test_data = high_level_cornell.split_train_test(train_data)
-    log.info("Training set has %d samples and test set has %d samples",len(train_data),len(test_data))
     #Our LSTM network.
-    net = model.PhraseModel(emb_size=model.EMBEDDING_DIM, dict_size=len(emb_dict),
-                            hid_size=model.HIDDEN_STATE_SIZE).to(device)
+    net = model.PhraseModel(emb_size=args.emb_size, dict_size=len(emb_dict),
+                            hid_size=args.hidden_size,output=args.output,num_layers=args.layers).to(device)
     log.info("Model : %s", net)
 
     writer = SummaryWriter(comment="-" + args.name)
 
     optimiser = optim.Adam(net.parameters(), lr=LEARNING_RATE)
+    scaler = model.grad_scaler(device,enabled=args.amp)
     best_bleu = None
+    #Share of real tokens among padded input positions.
+    padding = batching.PaddingStats()
     for epoch in range(MAX_EPOCHS):
         losses = []
         bleu_sum = 0.0
         bleu_count = 0
-        for batch in high_level_cornell.iterate_batches(train_data,BATCH_SIZE):
+        padding.reset()
+        if shard_reader is not None and args.token_budget:
+            #Own shards are read in a new order every epoch and bucketed by length within windows of pairs.
+            batches = batching.iterate_bucketed_stream(shard_reader.iterate(epoch),args.token_budget,rand=rand)
+        elif shard_reader is not None:
+            batches = shard_reader.iterate_batches(BATCH_SIZE,epoch)
+        elif args.token_budget:
+            batches = batching.iterate_bucketed_batches(train_data,args.token_budget,rand=rand)
+        else:
+            batches = high_level_cornell.iterate_batches(train_data,BATCH_SIZE)
+        prepared_batches = pipeline.BatchPrefetcher(batches,lambda batch: model.prepare_batch_no_out(batch,pin_memory=args.cuda),
+                                                    depth=args.prefetch)
+        for prepared in prepared_batches:
+            padding.add_lengths(prepared.lens)
             optimiser.zero_grad()
-            #pack_batch returns packed input and output seq along with input and output token ids indices.
-            input_seq, out_seq_list, input_idx, out_idx = model.pack_batch(batch, net.emb, device)
-            #Returns hidden state from RNN.
-            enc = net.encode(input_seq)
-
-            net_results = []
-            net_targets = []
-            for idx,out_seq in enumerate(out_seq_list):
-                ref_seqs = out_idx[idx][1:]
-                #Gets the encoded input seq of that particular index.
-                enc_item = net.get_encoded_item(enc,idx)
-                """
-                Randomize betwwen teacher-forcing and curriculum learning.
-                Difference comes in calculation of bleu score.
-                """
-                if random.random() < TEACH_CURR_PROB:
-                    #We give actual output token and ask it to produce output token(r).
-                    r = net.decode_teacher(enc_item,out_seq)
-                    bleu_sum += model.seq_bleu(r, ref_seqs)
-                else:
-                    #resulting logits and list of output token ids.
-                    r,seq = net.decode_chain_argmax(enc_item,out_seq.data[0:1],len(ref_seqs))
-                    bleu_sum += utils.calc_bleu(seq,ref_seqs)
-                net_results.append(r)
-                net_targets.extend(ref_seqs)
-                bleu_count += 1
-            #Concatenation of logits.
-            results_v = torch.cat(net_results)
-            #Tensor of reference token indices.
-            targets_v = torch.LongTensor(net_targets).to(device)
-            #Calculating cross entropy loss.
-            loss_v = F.cross_entropy(results_v,targets_v)
-            loss_v.backward()
-            optimiser.step()
+            with model.autocast(device,enabled=args.amp):
+                #embed_batch_no_out returns packed input along with input and output token ids indices.
+                input_seq, input_idx, out_idx = model.embed_batch_no_out(prepared, net.emb, device)
+                loss_v, batch_bleu, batch_count = train_batch(net,input_seq,out_idx,device,sampled=args.sampled)
+            bleu_sum += batch_bleu
+            bleu_count += batch_count
+            scaler.scale(loss_v).backward()
+            scaler.step(optimiser)
+            scaler.update()
             losses.append(loss_v.item())
         #Mean bleu score.
         bleu = bleu_sum / bleu_count
         #We calculate bleu for hold-out set to assess output metrics.
-        bleu_test = run_test(test_data,net,end_token,device)
+        bleu_test = run_test(test_data,net,end_token,device,beam=args.beam)
         log.info("Epoch %d: mean loss %.3f, Mean BLEU %.3f, test BLEU %.3f ",
                   epoch,np.mean(losses),bleu,bleu_test)
+        log.info("Epoch %d: %d batches, padding efficiency %.3f",epoch,padding.batches,padding.efficiency)
         #Add to our SummaryWriter.
         writer.add_scalar("loss",np.mean(losses),epoch)
         writer.add_scalar("BLEU",bleu,epoch)
         writer.add_scalar("BLEU_Test",bleu_test,epoch)
+        writer.add_scalar("padding_efficiency",padding.efficiency,epoch)
         #Saving models scores with the best test BLEU seen so far for fine-tuning.
         if best_bleu is None or best_bleu < bleu_test:
             if best_bleu is not None:
                 out_name = os.path.join(saves_path,"pre_bleu_%.3f_%02d.dat" % (bleu_test,epoch))
-                #State_dict() maps each layer to its parameters.
-                torch.save(net.state_dict(),out_name)
+                #State_dict() maps each layer to its parameters, it's saved with the configuration of the model.
+                model.save_checkpoint(net,out_name,emb_dict)
                 log.info("Best BLEU updated %.3f",bleu_test)
             #If best_bleu is less than test_bleu.
             best_bleu = bleu_test
         #Save checkpoint for every 10 epochs.
         if epoch % 10 == 0:
             out_name = os.path.join(saves_path,"epoch_%03d_%.3f_%.3f.dat" % (epoch,bleu,bleu_test))
-            torch.save(net.state_dict(), out_name)
+            model.save_checkpoint(net, out_name, emb_dict)
 
     writer.close()
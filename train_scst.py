@@ -6,11 +6,11 @@ import logging
 import numpy as np
 from tensorboardX import SummaryWriter
 
-import high_level_cornell, model, utils
+from utilities import high_level_cornell, corpus_cache, batching
+import model, utils, pipeline, softmax
 
 import torch
 import torch.optim as optim
-import torch.nn.functional as F
 
 import ptan
 
@@ -20,29 +20,36 @@ BATCH_SIZE = 16
 #GPU requirements for SCST are higher, so a smaller alpha.
 LEARNING_RATE = 1e-4
 MAX_EPOCHES = 5000
+#Test phrases are decoded in batches of this size.
+TEST_BATCH_SIZE = 256
 
 log = logging.getLogger("train")
 
 
-def run_test(test_data, net, end_token, device="cpu"):
+def run_test(test_data, net, end_token, device="cpu", beam=0):
     """
     While training on every epoch we calculate BLEU for test dataset.
     Shape of the data is [(phrase,[responses])].
-    We strip the #BEG token as well.
+    We strip the #BEG token as well. With beam > 0 replies are decoded by beam search.
     """
     bleu_sum = 0.0
     bleu_count = 0
-    for p1, p2 in test_data:
-        input_seq = model.pack_input(p1, net.emb, device)
+    for start in range(0, len(test_data), TEST_BATCH_SIZE):
+        input_seq, phr, rep = model.pack_batch_no_out(test_data[start:start + TEST_BATCH_SIZE], net.emb, device)
         enc = net.encode(input_seq)
-        _, tokens = net.decode_chain_argmax(enc, input_seq.data[0:1], seq_len=high_level_cornell.MAX_TOKENS,
-                                            stop_token=end_token)
-        ref_indices = [
-            indices[1:]
-            for indices in p2
-        ]
-        bleu_sum += utils.calc_bleu_many(tokens, ref_indices)
-        bleu_count += 1
+        begin_emb = net.emb(torch.LongTensor([p[0] for p in phr]).to(device))
+        if beam:
+            tokens, _ = net.decode_beam(enc, begin_emb, high_level_cornell.MAX_TOKENS, beam, stop_token=end_token)
+        else:
+            _, tokens = net.decode_chain_argmax_batch(enc, begin_emb, seq_len=high_level_cornell.MAX_TOKENS,
+                                                      stop_token=end_token)
+        for out_tokens, p2 in zip(tokens, rep):
+            ref_indices = [
+                indices[1:]
+                for indices in p2
+            ]
+            bleu_sum += utils.calc_bleu_many(out_tokens, ref_indices)
+            bleu_count += 1
     return bleu_sum / bleu_count
 
 
@@ -51,40 +58,57 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--data", required=True, help="Category to use for training. Empty string to train on full dataset")
     parser.add_argument("--cuda", action='store_true', default=False, help="Enable cuda")
+    parser.add_argument("--no-cache", action='store_true', default=False, help="Preprocess the corpus again instead of using cached data")
+    parser.add_argument("--workers", type=int, default=1, help="Count of processes used to tokenize the corpus")
+    parser.add_argument("--lazy", action='store_true', default=False, help="Tokenize only the lines used by conversations, to save memory")
+    parser.add_argument("--token-budget", type=int, default=0, help="Max padded input tokens per batch, 0 to use fixed BATCH_SIZE")
+    parser.add_argument("--prefetch", type=int, default=2, help="Count of batches prepared in background, 0 to disable")
+    parser.add_argument("--beam", type=int, default=0, help="Beam width to decode test phrases, 0 for argmax")
+    parser.add_argument("--output", choices=softmax.OUTPUT_MODES, default="dense", help="Output layer of loaded model saved without its configuration")
     parser.add_argument("-n", "--name", required=True, help="Name of the run")
     #Load pretrained Cross-entropy model to continue RL training from that point.
     parser.add_argument("-l", "--load", required=True, help="Load model and continue in RL mode")
     #Number of samples taken in each epoch. More the no., faster the PG will converge but increases GPU.
     parser.add_argument("--samples", type=int, default=4, help="Count of samples in prob mode")
     #Disabling the skips disables skipping of training samples with high BLEU score.
+    #Sampling settings of rollouts, defaults sample from the model's distribution as it is.
+    parser.add_argument("--temperature", type=float, default=1.0, help="Temperature of sampled rollouts")
+    parser.add_argument("--top-k", type=int, default=0, help="Sample rollouts from given count of most probable words, 0 for all")
+    parser.add_argument("--top-p", type=float, default=1.0, help="Sample rollouts from most probable words with this probability mass")
     parser.add_argument("--disable-skip", default=False, action='store_true', help="Disable skipping of samples with high argmax BLEU")
+    parser.add_argument("--amp", default=False, action='store_true', help="Mixed-precision training: bfloat16 on CPU, float16 with gradient scaling with --cuda")
     args = parser.parse_args()
+    if args.temperature <= 0 or args.top_k < 0 or not 0 < args.top_p <= 1:
+        parser.error("--temperature should be positive, --top-k not negative and --top-p in range (0, 1]")
+    #Encoded pairs have #BEG and #END tokens besides MAX_TOKENS words, every pair has to fit into a batch.
+    if args.token_budget < 0 or 0 < args.token_budget < high_level_cornell.MAX_TOKENS + 2:
+        parser.error("--token-budget should be 0 or at least %d" % (high_level_cornell.MAX_TOKENS + 2))
     device = torch.device("cuda" if args.cuda else "cpu")
 
     saves_path = os.path.join(SAVES_DIR, args.name)
     os.makedirs(saves_path, exist_ok=True)
 
-    phrase_pairs, emb_dict = high_level_cornell.load_data(genre_filter=args.data)
-    log.info("Obtained %d phrase pairs with %d uniq words", len(phrase_pairs), len(emb_dict))
+    train_data, emb_dict = high_level_cornell.load_encoded_data(genre_filter=args.data,
+                                                                cache_dir=None if args.no_cache else corpus_cache.CACHE_DIR,
+                                                                workers=args.workers, lazy=args.lazy)
+    log.info("Obtained %d encoded pairs with %d uniq words", len(train_data), len(emb_dict))
     high_level_cornell.save_emb_dict(saves_path, emb_dict)
     end_token = emb_dict[high_level_cornell.END_TOKEN]
-    train_data = high_level_cornell.encode_phrase_pairs(phrase_pairs, emb_dict)
     rand = np.random.RandomState(high_level_cornell.SHUFFLE_SEED)
-    rand.shuffle(train_data)
+    train_data.shuffle(rand)
     train_data, test_data = high_level_cornell.split_train_test(train_data)
     log.info("Training data converted, got %d samples", len(train_data))
     train_data = high_level_cornell.group_train_data(train_data)
     test_data = high_level_cornell.group_train_data(test_data)
     log.info("Train set has %d phrases, test %d", len(train_data), len(test_data))
 
-    rev_emb_dict = {idx: word for word, idx in emb_dict.items()}
+    rev_emb_dict = high_level_cornell.reverse_emb_dict(emb_dict)
 
-    net = model.PhraseModel(emb_size=model.EMBEDDING_DIM, dict_size=len(emb_dict),
-                            hid_size=model.HIDDEN_STATE_SIZE).to(device)
+    #Sizes of the model come from the checkpoint, which has to be trained with the same dictionary.
+    net = model.load_checkpoint(args.load, emb_dict, device, output=args.output)
     log.info("Model: %s", net)
 
     writer = SummaryWriter(comment="-" + args.name)
-    net.load_state_dict(torch.load(args.load))
     log.info("Model loaded from %s, continue training in RL mode...", args.load)
 
     # BEGIN token
@@ -92,8 +116,10 @@ if __name__ == "__main__":
 
     with ptan.common.utils.TBMeanTracker(writer, batch_size=100) as tb_tracker:
         optimiser = optim.Adam(net.parameters(), lr=LEARNING_RATE, eps=1e-3)
+        scaler = model.grad_scaler(device, enabled=args.amp)
         batch_idx = 0
         best_bleu = None
+        padding = batching.PaddingStats()
         for epoch in range(MAX_EPOCHES):
             random.shuffle(train_data)
             dial_shown = False
@@ -103,17 +129,32 @@ if __name__ == "__main__":
             skipped_samples = 0
             bleus_argmax = []
             bleus_sample = []
-
-            for batch in high_level_cornell.iterate_batches(train_data, BATCH_SIZE):
+            padding.reset()
+            if args.token_budget:
+                batches = batching.iterate_bucketed_batches(train_data, args.token_budget, rand=rand,
+                                                             length=batching.phrase_length)
+            else:
+                batches = high_level_cornell.iterate_batches(train_data, BATCH_SIZE)
+
+            prepared_batches = pipeline.BatchPrefetcher(
+                batches, lambda batch: model.prepare_batch_no_out(batch, pin_memory=args.cuda), depth=args.prefetch)
+            for prepared in prepared_batches:
+                padding.add_lengths(prepared.lens)
                 batch_idx += 1
                 optimiser.zero_grad()
-                input_seq, input_batch, output_batch = model.pack_batch_no_out(batch, net.emb, device)
-                enc = net.encode(input_seq)
-
-                net_policies = []
-                net_actions = []
+                with model.autocast(device, enabled=args.amp):
+                    input_seq, input_batch, output_batch = model.embed_batch_no_out(prepared, net.emb, device)
+                    enc = net.encode(input_seq)
+
+                    beg_embedding = net.emb(beg_token)
+                    #Argmax baselines and all the samples of the batch are decoded at once.
+                    rollouts = net.decode_rollouts(enc, beg_embedding, high_level_cornell.MAX_TOKENS, args.samples,
+                                                   stop_token=end_token, temperature=args.temperature,
+                                                   top_k=args.top_k, top_p=args.top_p)
+                batch_actions, sample_actions = rollouts.to_lists()
+                #Sample rows which take part in the loss and their advantages.
+                train_rows = []
                 net_advantages = []
-                beg_embedding = net.emb(beg_token)
 
                 for idx, inp_idx in enumerate(input_batch):
                     total_samples += 1
@@ -121,9 +162,7 @@ if __name__ == "__main__":
                         indices[1:]
                         for indices in output_batch[idx]
                     ]
-                    item_enc = net.get_encoded_item(enc, idx)
-                    r_argmax, actions = net.decode_chain_argmax(item_enc, beg_embedding, high_level_cornell.MAX_TOKENS,
-                                                                stop_token=end_token)
+                    actions = batch_actions[idx]
 
                     argmax_bleu = utils.calc_bleu_many(actions, ref_indices)
                     #This will be used as baseline for our PG algorithm.
@@ -142,9 +181,8 @@ if __name__ == "__main__":
                         log.info("Argmax: %s, bleu=%.4f", utils.untokenize(high_level_cornell.decode_words(actions, rev_emb_dict)),
                                  argmax_bleu)
 
-                    for _ in range(args.samples):
-                        r_sample, actions = net.decode_chain_sampling(item_enc, beg_embedding,
-                                                                      high_level_cornell.MAX_TOKENS, stop_token=end_token)
+                    for row in range(idx * args.samples, (idx + 1) * args.samples):
+                        actions = sample_actions[row]
                         #Obtaining bleu of samples.
                         sample_bleu = utils.calc_bleu_many(actions, ref_indices)
 
@@ -152,43 +190,45 @@ if __name__ == "__main__":
                             log.info("Sample: %s, bleu=%.4f", utils.untokenize(high_level_cornell.decode_words(actions, rev_emb_dict)),
                                      sample_bleu)
 
-                        net_policies.append(r_sample)
-                        net_actions.extend(actions)
-                        net_advantages.extend([sample_bleu - argmax_bleu] * len(actions))
+                        train_rows.append(row)
+                        net_advantages.append(sample_bleu - argmax_bleu)
                         bleus_sample.append(sample_bleu)
                     dial_shown = True
 
-                if not net_policies:
+                if not train_rows:
                     continue
 
-                policies_v = torch.cat(net_policies)
-                actions_t = torch.LongTensor(net_actions).to(device)
-                adv_v = torch.FloatTensor(net_advantages).to(device)
-                log_prob_v = F.log_softmax(policies_v, dim=1)
-                log_prob_actions_v = adv_v * log_prob_v[range(len(net_actions)), actions_t]
-                loss_policy_v = -log_prob_actions_v.mean()
+                rows_v = torch.LongTensor(train_rows).to(device)
+                mask_v = rollouts.mask()[rows_v]
+                #Advantage of the sample for every real position of it.
+                adv_v = torch.FloatTensor(net_advantages).to(device).unsqueeze(1) * mask_v
+                #Log-probabilities are in lower precision with --amp, the loss is summed in fp32.
+                log_prob_actions_v = adv_v * rollouts.log_probs[rows_v].float()
+                loss_policy_v = -log_prob_actions_v.sum() / mask_v.sum()
 
                 loss_v = loss_policy_v
-                loss_v.backward()
-                optimiser.step()
+                scaler.scale(loss_v).backward()
+                scaler.step(optimiser)
+                scaler.update()
 
-                tb_tracker.track("advantage", adv_v, batch_idx)
+                tb_tracker.track("advantage", adv_v[mask_v > 0], batch_idx)
                 tb_tracker.track("loss_policy", loss_policy_v, batch_idx)
                 tb_tracker.track("loss_total", loss_v, batch_idx)
 
-            bleu_test = run_test(test_data, net, end_token, device)
+            bleu_test = run_test(test_data, net, end_token, device, beam=args.beam)
             bleu = np.mean(bleus_argmax)
             writer.add_scalar("bleu_test", bleu_test, batch_idx)
             writer.add_scalar("bleu_argmax", bleu, batch_idx)
             writer.add_scalar("bleu_sample", np.mean(bleus_sample), batch_idx)
             writer.add_scalar("skipped_samples", skipped_samples / total_samples, batch_idx)
             writer.add_scalar("epoch", batch_idx, epoch)
-            log.info("Epoch %d, test BLEU: %.3f", epoch, bleu_test)
+            writer.add_scalar("padding_efficiency", padding.efficiency, batch_idx)
+            log.info("Epoch %d, test BLEU: %.3f, padding efficiency: %.3f", epoch, bleu_test, padding.efficiency)
             if best_bleu is None or best_bleu < bleu_test:
                 best_bleu = bleu_test
                 log.info("Best bleu updated: %.4f", bleu_test)
-                torch.save(net.state_dict(), os.path.join(saves_path, "bleu_%.3f_%02d.dat" % (bleu_test, epoch)))
+                model.save_checkpoint(net, os.path.join(saves_path, "bleu_%.3f_%02d.dat" % (bleu_test, epoch)), emb_dict)
             if epoch % 10 == 0:
-                torch.save(net.state_dict(), os.path.join(saves_path, "epoch_%03d_%.3f_%.3f.dat" % (epoch, bleu, bleu_test)))
+                model.save_checkpoint(net, os.path.join(saves_path, "epoch_%03d_%.3f_%.3f.dat" % (epoch, bleu, bleu_test)), emb_dict)
 
     writer.close()
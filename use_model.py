@@ -3,31 +3,19 @@ import os
 import argparse
 import logging
 
-import high_level_cornell,model,utils
-
-import torch
+from utilities import high_level_cornell
+import model,utils,sessions,softmax
 
 log = logging.getLogger("use")
 
 
-def words_to_words(words, emb_dict, rev_emb_dict, net, use_sampling=False):
-    tokens = high_level_cornell.encode_words(words, emb_dict)
-    input_seq = model.pack_input(tokens, net.emb)
-    enc = net.encode(input_seq)
-    end_token = emb_dict[high_level_cornell.END_TOKEN]
-    if use_sampling:
-        _, out_tokens = net.decode_chain_sampling(enc, input_seq.data[0:1], seq_len=high_level_cornell.MAX_TOKENS,
-                                                  stop_token=end_token)
-    else:
-        _, out_tokens = net.decode_chain_argmax(enc, input_seq.data[0:1], seq_len=high_level_cornell.MAX_TOKENS,
-                                                stop_token=end_token)
-    if out_tokens[-1] == end_token:
-        out_tokens = out_tokens[:-1]
-    out_words = high_level_cornell.decode_words(out_tokens, rev_emb_dict)
-    return out_words
+def words_to_words(words, emb_dict, rev_emb_dict, net, use_sampling=False, beam=0):
+    session = sessions.ChatSession(net, emb_dict, rev_emb_dict, use_sampling=use_sampling, beam=beam)
+    return session.reply(words)
 
 
 def process_string(s, emb_dict, rev_emb_dict, net, use_sampling=False):
+    words = utils.tokenize(s)
     out_words = words_to_words(words, emb_dict, rev_emb_dict, net, use_sampling=use_sampling)
     print(" ".join(out_words))
 
@@ -38,14 +26,27 @@ if __name__ == "__main__":
     parser.add_argument("-m", "--model", required=True, help="Model name to load")
     parser.add_argument("-s", "--string", help="String to process, otherwise will loop")
     parser.add_argument("--sample", default=False, action="store_true", help="Enable sampling generation instead of argmax")
+    parser.add_argument("--temperature", type=float, default=1.0, help="Temperature of sampling")
+    parser.add_argument("--top-k", type=int, default=0, help="Sample only from given count of most probable words, 0 for all")
+    parser.add_argument("--top-p", type=float, default=1.0, help="Sample only from most probable words with this probability mass")
+    parser.add_argument("--beam", type=int, default=0, help="Beam search with given width instead of argmax, 0 to disable")
+    parser.add_argument("--output", choices=softmax.OUTPUT_MODES, default="dense", help="Output layer of model saved without its configuration")
+    parser.add_argument("--quantize", default=False, action="store_true", help="Run int8 dynamically quantized model on CPU")
+    parser.add_argument("--context", default=False, action="store_true", help="Carry encoder state over turns of the conversation")
     parser.add_argument("--self", type=int, default=1, help="Enable self-loop mode with given amount of phrases.")
     args = parser.parse_args()
+    if args.temperature <= 0 or args.top_k < 0 or not 0 < args.top_p <= 1:
+        parser.error("--temperature should be positive, --top-k not negative and --top-p in range (0, 1]")
 
     emb_dict = high_level_cornell.load_emb_dict(os.path.dirname(args.model))
-    net = model.PhraseModel(emb_size=model.EMBEDDING_DIM, dict_size=len(emb_dict), hid_size=model.HIDDEN_STATE_SIZE)
-    net.load_state_dict(torch.load(args.model))
+    net = model.load_checkpoint(args.model, emb_dict, output=args.output)
+    if args.quantize:
+        net = model.quantize_dynamic(net)
 
-    rev_emb_dict = {idx: word for word, idx in emb_dict.items()}
+    rev_emb_dict = high_level_cornell.reverse_emb_dict(emb_dict)
+    session = sessions.ChatSession(net, emb_dict, rev_emb_dict, keep_context=args.context,
+                                   use_sampling=args.sample, beam=args.beam, temperature=args.temperature,
+                                   top_k=args.top_k, top_p=args.top_p)
 
     while True:
         if args.string:
@@ -56,9 +57,8 @@ if __name__ == "__main__":
             break
 
         words = utils.tokenize(input_string)
-        for _ in range(args.self):
-            words = words_to_words(words, emb_dict, rev_emb_dict, net, use_sampling=args.sample)
-            print(utils.untokenize(words))
+        for reply in session.self_talk(words, args.self):
+            print(utils.untokenize(reply))
 
         if args.string:
             break
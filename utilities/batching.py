@@ -0,0 +1,127 @@
+"""
+Length-bucketed batching with a token budget.
+pack_batch_no_out() pads every input phrase to the longest one of the batch, so batches cut from
+a shuffled list waste many positions on padding and their cost varies a lot. Replies are padded the
+same way by the decoder. Here pairs are grouped by the longer of their phrase and reply(by the phrase
+alone for SCST, which never pads replies) and every batch takes as many pairs as fit into token_budget
+padded positions.
+"""
+import numpy as np
+
+from .encoded_dataset import EncodedDataset
+
+#Pairs of a stream which are bucketed together, only so many of them are kept in memory.
+STREAM_WINDOW = 8192
+
+
+class PaddingStats:
+    """
+    Counts real and padded input positions of batches, efficiency is the share of real ones.
+    """
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.batches = 0
+        self.samples = 0
+        self.tokens = 0
+        self.padded = 0
+
+    def add_batch(self, batch):
+        self.add_lengths([len(s[0]) for s in batch])
+
+    def add_lengths(self, lens):
+        self.batches += 1
+        self.samples += len(lens)
+        self.tokens += sum(lens)
+        self.padded += max(lens) * len(lens)
+
+    @property
+    def efficiency(self):
+        return self.tokens / self.padded if self.padded else 1.0
+
+
+class BucketBatchSampler:
+    """
+    Sorts pairs by length(ties are broken randomly), splits them into buckets of
+    bucket_width lengths and cuts every bucket into batches with batch_size * longest pair
+    not above token_budget. Length of a pair is the longer of its phrase and reply. Order of batches is shuffled, so buckets are mixed during an epoch.
+    Batches of one pair are kept, unlike iterate_batches(), so no data is dropped.
+    """
+    def __init__(self, lengths, token_budget, bucket_width=2, rand=None):
+        self.lengths = np.asarray(lengths, dtype=np.int64)
+        assert token_budget >= self.lengths.max(initial=0), "Budget is smaller than the longest pair"
+        self.token_budget = token_budget
+        self.bucket_width = bucket_width
+        self.rand = rand if rand is not None else np.random.RandomState()
+
+    def batches(self):
+        """
+        Returns list of arrays with positions of pairs for one epoch.
+        """
+        order = np.lexsort((self.rand.random_sample(len(self.lengths)), self.lengths))
+        buckets = self.lengths[order] // self.bucket_width
+        out = []
+        start = 0
+        while start < len(order):
+            #Sorted by length, so the last pair of the batch is the longest one.
+            end = start + 1
+            while end < len(order) and buckets[end] == buckets[start] and \
+                    (end - start + 1) * self.lengths[order[end]] <= self.token_budget:
+                end += 1
+            out.append(order[start:end])
+            start = end
+        self.rand.shuffle(out)
+        return out
+
+
+"""
+Length of a pair for the token budget: the longer of phrase and reply, both are padded in training.
+"""
+def pair_length(pair):
+    return max(len(pair[0]), len(pair[1]))
+
+"""
+Length of the phrase only, for samples without padded replies like (phrase, [reply, ...]) groups
+of high_level_cornell.group_train_data() in SCST.
+"""
+def phrase_length(pair):
+    return len(pair[0])
+
+"""
+Lengths of samples of data(list or EncodedDataset) for BucketBatchSampler, given by the length function.
+"""
+def pair_lengths(data, length=pair_length):
+    if isinstance(data, EncodedDataset) and length is pair_length:
+        return np.maximum(data.phrase_lengths(), data.reply_lengths())
+    if isinstance(data, EncodedDataset) and length is phrase_length:
+        return data.phrase_lengths()
+    return [length(s) for s in data]
+
+"""
+Iterates batches(lists of pairs) of data(list or EncodedDataset) with the token budget.
+Every call is a new epoch with its own bucketing and order of batches.
+length gives the length of every sample, see pair_length() and phrase_length().
+"""
+def iterate_bucketed_batches(data, token_budget, bucket_width=2, rand=None, length=pair_length):
+    lengths = pair_lengths(data, length)
+    sampler = BucketBatchSampler(lengths, token_budget, bucket_width, rand)
+    for positions in sampler.batches():
+        if isinstance(data, EncodedDataset):
+            yield data.view(data.order[positions]).pairs()
+        else:
+            yield [data[pos] for pos in positions]
+
+"""
+Iterates batches of pairs coming from an iterator(ShardReader.iterate() for example) with the token budget.
+Pairs are bucketed within consecutive windows of window pairs, so the stream is never loaded as a whole.
+"""
+def iterate_bucketed_stream(pairs, token_budget, window=STREAM_WINDOW, bucket_width=2, rand=None, length=pair_length):
+    chunk = []
+    for pair in pairs:
+        chunk.append(pair)
+        if len(chunk) == window:
+            yield from iterate_bucketed_batches(chunk, token_budget, bucket_width, rand, length)
+            chunk = []
+    if chunk:
+        yield from iterate_bucketed_batches(chunk, token_budget, bucket_width, rand, length)
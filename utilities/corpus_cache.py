@@ -0,0 +1,102 @@
+"""
+On-disk cache of the preprocessed and encoded Cornell corpus.
+Parsing and tokenizing movie_lines.txt takes minutes, so load_encoded_data() stores the encoded
+phrase pairs(flat int32 token IDs with offsets, the layout of EncodedDataset) together with the
+word dictionary(binary format of vocabulary.Vocabulary) and reuses them on later runs.
+Both are memory-mapped on load, so a cached start doesn't build any Python lists.
+Every cache entry lives in its own directory named after a key which covers the genre filter,
+max no. of tokens, minimum token frequency and size/mtime/hash of the source files.
+"""
+import os
+import json
+import shutil
+import hashlib
+import logging
+
+import numpy as np
+
+from . import vocabulary
+from .encoded_dataset import EncodedDataset
+
+log = logging.getLogger("cache")
+
+CACHE_DIR = "./cache"
+#Bump this whenever the layout of the files below or the preprocessing changes, old entries will be ignored.
+CACHE_VERSION = 3
+SOURCE_FILES = ("movie_titles_metadata.txt", "movie_lines.txt", "movie_conversations.txt")
+
+META_NAME = "meta.json"
+VOCAB_NAME = "vocab.bin"
+PHRASES_NAME = "phrases.npy"
+PHRASE_OFFSETS_NAME = "phrase_offsets.npy"
+REPLIES_NAME = "replies.npy"
+REPLY_OFFSETS_NAME = "reply_offsets.npy"
+
+"""
+Fingerprint of one source file: size and modification time plus the hash of its contents.
+Hashing the whole 40 MB of the corpus costs well below 100 ms.
+"""
+def file_fingerprint(path):
+    st = os.stat(path)
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return {"size": st.st_size, "mtime": st.st_mtime_ns, "sha1": h.hexdigest()}
+
+"""
+Builds the key of cache entry from loading parameters and the state of source files.
+Any change in these gives a new key, so stale entries are never used.
+"""
+def cache_key(data_dir, genre_filter, max_tokens, min_token_frequency):
+    desc = {
+        "version": CACHE_VERSION,
+        "genre_filter": genre_filter or "",
+        "max_tokens": max_tokens,
+        "min_token_frequency": min_token_frequency,
+        "files": {name: file_fingerprint(os.path.join(data_dir, name)) for name in SOURCE_FILES},
+    }
+    return hashlib.sha1(json.dumps(desc, sort_keys=True).encode("utf-8")).hexdigest(), desc
+
+"""
+Stores encoded pairs(EncodedDataset in storage order, as encode_phrase_pairs() builds it)
+and the word dictionary under the given key.
+Files are written into temporary directory which is renamed at the end,
+so interrupted runs never leave half-written entries behind.
+"""
+def save(cache_dir, key, desc, data, emb_dict):
+    entry_dir = os.path.join(cache_dir, key)
+    tmp_dir = "%s.tmp%d" % (entry_dir, os.getpid())
+    os.makedirs(tmp_dir, exist_ok=True)
+    np.save(os.path.join(tmp_dir, PHRASES_NAME), data.phrases)
+    np.save(os.path.join(tmp_dir, PHRASE_OFFSETS_NAME), data.phrase_offsets)
+    np.save(os.path.join(tmp_dir, REPLIES_NAME), data.replies)
+    np.save(os.path.join(tmp_dir, REPLY_OFFSETS_NAME), data.reply_offsets)
+    with open(os.path.join(tmp_dir, VOCAB_NAME), "wb") as f:
+        f.write(vocabulary.serialize(emb_dict))
+    with open(os.path.join(tmp_dir, META_NAME), "w", encoding="utf-8") as f:
+        json.dump(dict(desc, pairs=len(data)), f, indent=2, sort_keys=True)
+    try:
+        os.replace(tmp_dir, entry_dir)
+    except OSError:
+        #Another process has stored the same entry meanwhile.
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    log.info("Stored %d encoded pairs in cache %s", len(data), entry_dir)
+
+"""
+Loads the cache entry with the given key.
+Token arrays and the dictionary are memory-mapped, so only the pages actually touched are read from disk.
+Returns (EncodedDataset, vocabulary.Vocabulary) or None if there is no such entry.
+"""
+def load(cache_dir, key):
+    entry_dir = os.path.join(cache_dir, key)
+    if not os.path.isfile(os.path.join(entry_dir, META_NAME)):
+        return None
+    try:
+        arrays = [np.load(os.path.join(entry_dir, name), mmap_mode="r")
+                  for name in (PHRASES_NAME, PHRASE_OFFSETS_NAME, REPLIES_NAME, REPLY_OFFSETS_NAME)]
+        emb_dict = vocabulary.Vocabulary.load(os.path.join(entry_dir, VOCAB_NAME))
+    except (OSError, ValueError) as e:
+        log.warning("Ignoring broken cache entry %s: %s", entry_dir, e)
+        return None
+    return EncodedDataset(*arrays), emb_dict
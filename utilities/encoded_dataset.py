@@ -0,0 +1,103 @@
+"""
+Compact storage of encoded (phrase,reply) pairs.
+Instead of a list of tuples of Python int lists, token IDs of all phrases and all replies
+are kept in two flat int32 arrays with int64 offsets, and an index array gives the order of pairs.
+Shuffling and slicing only touch the index array, token buffers are shared between views.
+"""
+import array
+
+import numpy as np
+
+
+class EncodedDataset:
+    """
+    Pair i of the dataset is (phrases[phrase_offsets[k]:phrase_offsets[k+1]],
+    replies[reply_offsets[k]:reply_offsets[k+1]]) where k = order[i].
+    Indexing with int gives the pair as two lists of token IDs, the same as
+    high_level_cornell.encode_phrase_pairs() used to return, slicing gives another dataset.
+    """
+    def __init__(self, phrases, phrase_offsets, replies, reply_offsets, order=None):
+        self.phrases = phrases
+        self.phrase_offsets = phrase_offsets
+        self.replies = replies
+        self.reply_offsets = reply_offsets
+        if order is None:
+            order = np.arange(len(phrase_offsets) - 1, dtype=np.int64)
+        self.order = order
+
+    @classmethod
+    def from_pairs(cls, pairs):
+        builder = DatasetBuilder()
+        for p1, p2 in pairs:
+            builder.append(p1, p2)
+        return builder.build()
+
+    def __len__(self):
+        return len(self.order)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return self.view(self.order[idx])
+        k = self.order[idx]
+        return self.phrase(k).tolist(), self.reply(k).tolist()
+
+    def __iter__(self):
+        for k in self.order:
+            yield self.phrase(k).tolist(), self.reply(k).tolist()
+
+    def phrase(self, k):
+        """
+        Token IDs of phrase with storage index k(not position in the dataset) as an array.
+        """
+        return self.phrases[self.phrase_offsets[k]:self.phrase_offsets[k + 1]]
+
+    def reply(self, k):
+        return self.replies[self.reply_offsets[k]:self.reply_offsets[k + 1]]
+
+    def view(self, order):
+        """
+        Dataset sharing token buffers with this one, with pairs in the given storage order.
+        """
+        return EncodedDataset(self.phrases, self.phrase_offsets, self.replies, self.reply_offsets, order)
+
+    def pairs(self, start=0, end=None):
+        """
+        List of (phrase,reply) lists for positions start..end.
+        """
+        return [(self.phrase(k).tolist(), self.reply(k).tolist()) for k in self.order[start:end]]
+
+    def shuffle(self, rand):
+        """
+        Shuffles pairs in place with given np.random.RandomState. The permutation is the same
+        as rand.shuffle() would do with the list of pairs of the same length.
+        """
+        rand.shuffle(self.order)
+
+    def phrase_lengths(self):
+        return np.diff(self.phrase_offsets)[self.order]
+
+    def reply_lengths(self):
+        return np.diff(self.reply_offsets)[self.order]
+
+
+class DatasetBuilder:
+    """
+    Collects pairs into growable int32 buffers and makes an EncodedDataset from them.
+    """
+    def __init__(self):
+        self.phrases = array.array("i")
+        self.replies = array.array("i")
+        self.phrase_offsets = array.array("q", [0])
+        self.reply_offsets = array.array("q", [0])
+
+    def append(self, p1, p2):
+        self.phrases.extend(p1)
+        self.replies.extend(p2)
+        self.phrase_offsets.append(len(self.phrases))
+        self.reply_offsets.append(len(self.replies))
+
+    def build(self):
+        return EncodedDataset(np.frombuffer(self.phrases, dtype=np.int32).copy(),
+                              np.frombuffer(self.phrase_offsets, dtype=np.int64).copy(),
+                              np.frombuffer(self.replies, dtype=np.int32).copy(),
+                              np.frombuffer(self.reply_offsets, dtype=np.int64).copy())
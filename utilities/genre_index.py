@@ -0,0 +1,147 @@
+"""
+Inverted index over the Cornell corpus metadata.
+It maps every genre to the set of movie ids and every movie id to the byte ranges
+its lines occupy in movie_lines.txt, so a genre subset can be read without scanning the whole file.
+The index is built once and stored in the cache directory next to the preprocessed corpus.
+"""
+import os
+import json
+import logging
+
+from . import corpus_cache
+
+log = logging.getLogger("genre_index")
+
+INDEX_VERSION = 1
+INDEX_NAME = "genre_index.json"
+SEPARATOR = b"+++$+++"
+
+
+class GenreIndex:
+    """
+    movie_genres maps movie id to list of its genres,
+    line_ranges maps movie id to list of (offset,length) byte ranges in movie_lines.txt.
+    """
+    def __init__(self, movie_genres, line_ranges):
+        self.movie_genres = movie_genres
+        self.line_ranges = line_ranges
+        self.genres = {}
+        for m_id, m_genres in movie_genres.items():
+            for genre in m_genres:
+                self.genres.setdefault(genre, set()).add(m_id)
+
+    def movies_with(self, term):
+        """
+        Set of movies having a genre which contains the term.
+        Substring match keeps the behaviour of the old get_filtered_set(), so 'sci' finds 'sci-fi'.
+        """
+        out = set()
+        for genre, movies in self.genres.items():
+            if genre.find(term) != -1:
+                out |= movies
+        return out
+
+    def query(self, expr):
+        """
+        Evaluates queries like 'comedy', 'comedy AND romance' or 'horror OR thriller AND crime'.
+        AND binds tighter than OR, the same as in boolean algebra. Operators are case insensitive.
+        """
+        out = set()
+        for alternative in _split_words(expr, "OR"):
+            movies = None
+            for term in _split_words(alternative, "AND"):
+                found = self.movies_with(term)
+                movies = found if movies is None else movies & found
+            out |= movies
+        return out
+
+    def ranges_for(self, movies):
+        """
+        (start,end) byte ranges of lines which belong to given movies, sorted by offset.
+        """
+        out = []
+        for m_id in movies:
+            out.extend((offset, offset + length) for offset, length in self.line_ranges.get(m_id, []))
+        out.sort()
+        return out
+
+    def save(self, path, fingerprint):
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({"version": INDEX_VERSION, "files": fingerprint, "movie_genres": self.movie_genres,
+                       "line_ranges": self.line_ranges}, f)
+
+
+def _split_words(expr, operator):
+    parts = []
+    curr = []
+    for word in expr.split():
+        if word.upper() == operator:
+            parts.append(" ".join(curr))
+            curr = []
+        else:
+            curr.append(word)
+    parts.append(" ".join(curr))
+    return [part for part in parts if part]
+
+
+"""
+Parses movie_titles_metadata.txt and finds byte ranges of every movie in movie_lines.txt.
+Lines of one movie normally follow each other, so every movie gets just one range.
+"""
+def build(data_dir):
+    movie_genres = {}
+    with open(os.path.join(data_dir, "movie_titles_metadata.txt"), "rb") as f:
+        for line in f:
+            fields = str(line, encoding="utf-8", errors="ignore").split(SEPARATOR.decode())
+            m_id, m_genres = fields[0].strip(), fields[5].strip()
+            movie_genres[m_id] = [s.strip("'") for s in m_genres.strip("[]").split(", ")]
+
+    line_ranges = {}
+    offset = 0
+    with open(os.path.join(data_dir, "movie_lines.txt"), "rb") as f:
+        for line in f:
+            m_id = str(line.split(SEPARATOR, 3)[2].strip(), encoding="utf-8", errors="ignore")
+            ranges = line_ranges.setdefault(m_id, [])
+            if ranges and sum(ranges[-1]) == offset:
+                ranges[-1][1] += len(line)
+            else:
+                ranges.append([offset, len(line)])
+            offset += len(line)
+    return GenreIndex(movie_genres, line_ranges)
+
+
+def _fingerprint(data_dir):
+    out = {}
+    for name in ("movie_titles_metadata.txt", "movie_lines.txt"):
+        st = os.stat(os.path.join(data_dir, name))
+        out[name] = [st.st_size, st.st_mtime_ns]
+    return out
+
+
+_loaded = {}
+
+"""
+Returns the index for data_dir. It is loaded from cache_dir if the source files haven't changed
+since it was built, otherwise it is built and stored again.
+Indices are also kept in memory, so repeated calls in one process are free.
+"""
+def load(data_dir, cache_dir=corpus_cache.CACHE_DIR):
+    fingerprint = _fingerprint(data_dir)
+    key = os.path.abspath(data_dir)
+    if key in _loaded and _loaded[key][0] == fingerprint:
+        return _loaded[key][1]
+    index = None
+    path = os.path.join(cache_dir, INDEX_NAME) if cache_dir is not None else None
+    if path is not None and os.path.isfile(path):
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        if data.get("version") == INDEX_VERSION and data.get("files") == fingerprint:
+            index = GenreIndex(data["movie_genres"], data["line_ranges"])
+    if index is None:
+        log.info("Building genre index of %s", data_dir)
+        index = build(data_dir)
+        if path is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            index.save(path, fingerprint)
+    _loaded[key] = (fingerprint, index)
+    return index
@@ -3,13 +3,10 @@ Collections module in python has many containers that we can use like counters,
 """
 import collections
 import os,sys,logging
-"""
-Itertools module works as a fast, memory-efficient tool that is used in combination to form iterator algebra.
-"""
-import itertools
 import pickle
 
-from . import low_level_cornell
+from . import low_level_cornell, corpus_cache, vocabulary
+from .encoded_dataset import EncodedDataset, DatasetBuilder
 
 """
 We'll replace all words which occur less than 10 times with #UNK to save some memory and time.
@@ -20,8 +17,11 @@ BEGIN_TOKEN = '#BEG'
 END_TOKEN = '#END'
 MAX_TOKENS = 20
 MIN_TOKEN_FREQ = 10
+#Training data is shuffled with this seed, so that cross-entropy and SCST training get the same test split.
+SHUFFLE_SEED = 5871
 
 EMB_DICT_NAME = "emb_dict.dat"
+VOCAB_NAME = "vocab.bin"
 EMB_NAME = "emb.npy"
 
 log = logging.getLogger("data")
@@ -29,17 +29,33 @@ log = logging.getLogger("data")
 """
 We save the file which maps tokens to some integer IDs.
 (word -> ID)
+It is stored in the binary format of vocabulary.Vocabulary, which is memory-mapped on load.
 """
 def save_emb_dict(dir_name,emb_dict):
-    with open(os.path.join(dir_name, EMB_DICT_NAME),"wb") as f:
-        pickle.dump(emb_dict,f)
+    with open(os.path.join(dir_name, VOCAB_NAME),"wb") as f:
+        #Vocabulary already holds the serialized dictionary.
+        f.write(emb_dict.buf if isinstance(emb_dict,vocabulary.Vocabulary) else vocabulary.serialize(emb_dict))
 
 """
 To load the file which has tokens mapped to some integer IDs.
+Returns vocabulary.Vocabulary, which works as the dictionary and as the reverse dictionary for decode_words().
+Directories saved before the binary format was introduced have a pickled dictionary instead.
 """
 def load_emb_dict(dir_name):
+    path = os.path.join(dir_name,VOCAB_NAME)
+    if os.path.exists(path):
+        return vocabulary.Vocabulary.load(path)
     with open(os.path.join(dir_name,EMB_DICT_NAME),"rb") as f:
-        return pickle.load(f)
+        return vocabulary.Vocabulary.from_dict(pickle.load(f))
+
+"""
+Reverse dictionary(ID -> word) to be given to decode_words().
+Vocabulary already has ID -> word array, plain dictionaries are converted to Vocabulary.
+"""
+def reverse_emb_dict(emb_dict):
+    if isinstance(emb_dict,vocabulary.Vocabulary):
+        return emb_dict
+    return vocabulary.Vocabulary.from_dict(emb_dict)
 
 """
 List of words and embeddings dictionary are given as inputs.
@@ -59,19 +75,20 @@ def encode_words(words,emb_dict):
 
 """
 Converts list of phrase pairs(list of (phrase,phrase)) to
-list of tuples ([input_phrase_id_sequence],[output_phrase_id_sequence])
+EncodedDataset of ([input_phrase_id_sequence],[output_phrase_id_sequence]) pairs.
+Token IDs are stored in flat int32 arrays, indexing the dataset gives tuple of 2 lists.
 """
 def encode_phrase_pairs(phrase_pairs, emb_dict, filter_unknowns=True):
     unknown_tkn = emb_dict[UNKNOWN_TOKEN]
-    out = []
+    out = DatasetBuilder()
     for p1,p2 in phrase_pairs:
         #Tuple of 2 lists
         p = encode_words(p1,emb_dict), encode_words(p2,emb_dict)
         #If we encounter unknown tokens, go to the start of loop again.
         if unknown_tkn in p[0] or unknown_tkn in p[1]:
             continue
-        out.append(p)
-    return out
+        out.append(*p)
+    return out.build()
 
 """
 We group the training data(list of (seq1,seq2) pairs) by first phrase.
@@ -84,6 +101,7 @@ grouped by the 1st phrase.
 """
 def group_train_data(training_data):
     groups = collections.defaultdict(list)
+    #Iterating EncodedDataset gives the pairs one by one without building the whole list.
     for p1,p2 in training_data:
         l = groups[tuple(p1)]
         l.append(p2)
@@ -91,18 +109,22 @@ def group_train_data(training_data):
 
 """
 Iterates batches of given size.
-Input : Data and the batch size.
-Output: A generator variable with batches.
+Input : Data(list or EncodedDataset) and the batch size.
+Output: A generator variable with batches, every batch is a list of pairs.
 """
 def iterate_batches(data,batch_size):
     #assert isinstance() can be used to check whether the object belongs to certain class.
     #If this is false, it will lead to assertation error.
-    assert isinstance(data,list)
+    assert isinstance(data,(list,EncodedDataset))
     assert isinstance(batch_size,int)
 
     count = 0
     while True:
-        batch = data[count*batch_size:(count+1)*batch_size]
+        if isinstance(data,EncodedDataset):
+            #Only pairs of this batch are converted to lists.
+            batch = data.pairs(count*batch_size,(count+1)*batch_size)
+        else:
+            batch = data[count*batch_size:(count+1)*batch_size]
         if len(batch)<=1:
             break
         #generator object will be returned(We use this instead of appending to another variable).
@@ -114,10 +136,14 @@ Loads dialogues and converts it into phase-reply pairs suitable for training.
 Inputs : Genre filter(Optional), max no. of tokens , the minimum token frequency.
 We'll replace all words which occur less than 10 times with #UNK to save some memory and time.
 Training pairs will be created with 20 tokens to reduce no. of operations and memory.
+workers is the no. of processes used to tokenize the corpus, it doesn't change the result.
+Genre and line indices of the corpus are kept in cache_dir, None doesn't write anything to disk.
+lazy=True tokenizes only the lines used by conversations instead of keeping tokens of every line,
+see low_level_cornell.load_dialogues(), the result is the same.
 Outputs : list of (phrase,phrase) pairs and dictionary with each word as key and a unique ID as value.
 """
-def load_data(genre_filter,max_tokens=MAX_TOKENS,min_token_frequency=MIN_TOKEN_FREQ):
-    dialogues = low_level_cornell.load_dialogues(genre_filter=genre_filter)
+def load_data(genre_filter,max_tokens=MAX_TOKENS,min_token_frequency=MIN_TOKEN_FREQ,workers=1,cache_dir=corpus_cache.CACHE_DIR,lazy=False):
+    dialogues = low_level_cornell.load_dialogues(genre_filter=genre_filter,workers=workers,lazy=lazy,cache_dir=cache_dir)
     if not dialogues:
         log.error("No dialogues found!")
         sys.exit()
@@ -125,43 +151,33 @@ def load_data(genre_filter,max_tokens=MAX_TOKENS,min_token_frequency=MIN_TOKEN_F
     phrase_pairs = dialogues_to_pairs(dialogues,max_tokens=max_tokens)
     log.info("Counting frequency of the words....")
     #Counts the frequency of each word.(For example,{'red':4,'how':5,'not':10}. The output will be like this.)
-    word_counts = collections.Counter()
-    for each in dialogues:
-        for phrase in each:
-            #By updating, you are sending that particular phrase(List of word tokens) to the counter.
-            word_counts.update(phrase)
-    """
-    map(function, iterable). Takes each element of iterable and calls the function with it.
-    filter(function,sequence). Function checks if each element of sequence is True or False.
-    Sequence is the sequence we want to filter.
-    word_count.items() converts that dictionary into list of (element,count) pairs.
-    phrase[1] refers to the freq. number and phrase[0] is the actual word.
-    So freq_set will be a set of words which are repeated more than 10 times(min_token_frequency).
-    """
-    freq_set = set(map(lambda phrase:phrase[0], filter(lambda phrase:phrase[1] >= min_token_frequency, word_counts.items())))
-    log.info("Data has %d unique words, %d of them occur more than %d times", len(word_counts),len(freq_set), min_token_frequency)
-    #Dictionary of words with unique ID.
-    phrase_dict = phrase_pair_dict(phrase_pairs, freq_set)
+    builder = vocabulary.VocabularyBuilder()
+    builder.update_dialogues(dialogues)
+    #Dictionary of words with unique ID, the most frequent words get the smallest IDs.
+    phrase_dict = builder.build(min_token_frequency,(UNKNOWN_TOKEN,BEGIN_TOKEN,END_TOKEN))
+    log.info("Data has %d unique words, %d of them occur more than %d times", len(builder.counts),len(phrase_dict)-3, min_token_frequency)
     return phrase_pairs,phrase_dict
 
 """
-Inputs: list of (phrase,phrase) pairs and the set of words which are repeated more than 10 times.
-Output : dictionary with words as keys and a unique ID as value.
+load_data() followed by encode_phrase_pairs(), which is what the training scripts need.
+Results are stored in cache_dir and reused by later runs with the same arguments and source files,
+a cached start memory-maps the token arrays and the dictionary instead of building them.
+Pass cache_dir=None to always preprocess from scratch.
+Outputs : EncodedDataset of the pairs without unknown words and the dictionary(vocabulary.Vocabulary when cached).
 """
-
-def phrase_pair_dict(phrase_pairs,freq_set):
-    out = {UNKNOWN_TOKEN: 0, BEGIN_TOKEN: 1, END_TOKEN: 2}
-    #next_id assigns an ID to the next word other than the above 3.
-    next_id = 3
-    for p1,p2 in phrase_pairs:
-        #itertools.chain() splits the elements from the 2 lists.
-        #Ex: chain('ABC','DEF') --> A B C D E F.
-        for each in map(str.lower,itertools.chain(p1,p2)):
-            #If it's a word from freq_set, give it an ID.
-            if each not in out and each in freq_set:
-                out[each] = next_id
-                next_id += 1
-    return out
+def load_encoded_data(genre_filter,max_tokens=MAX_TOKENS,min_token_frequency=MIN_TOKEN_FREQ,cache_dir=corpus_cache.CACHE_DIR,workers=1,lazy=False):
+    if cache_dir is not None:
+        key, desc = corpus_cache.cache_key(low_level_cornell.DATA_DIR,genre_filter,max_tokens,min_token_frequency)
+        cached = corpus_cache.load(cache_dir,key)
+        if cached is not None:
+            log.info("Loaded %d encoded pairs from cache %s",len(cached[0]),key)
+            return cached
+    phrase_pairs, phrase_dict = load_data(genre_filter,max_tokens,min_token_frequency,workers,cache_dir,lazy)
+    log.info("Obtained %d phrase pairs with %d unique words",len(phrase_pairs),len(phrase_dict))
+    data = encode_phrase_pairs(phrase_pairs,phrase_dict)
+    if cache_dir is not None:
+        corpus_cache.save(cache_dir,key,desc,data,phrase_dict)
+    return data, phrase_dict
 
 """
 Inputs: Dialogues from low_level_cornell.py load_dialogues() function.(List of list of list of word tokens) and in our case max tokens is 20.
@@ -180,6 +196,9 @@ def dialogues_to_pairs(dialogues,max_tokens=None):
 
 
 def decode_words(indices,rev_emb_dict):
+    if isinstance(rev_emb_dict,vocabulary.Vocabulary):
+        #Gather from ID -> word array instead of a lookup for every token.
+        return rev_emb_dict.decode(indices,UNKNOWN_TOKEN)
     #.get() returns value of the item with specified key
     return [rev_emb_dict.get(idx,UNKNOWN_TOKEN) for idx in indices]
 
@@ -200,7 +219,7 @@ def trim_tokens_seq(tokens,end_token):
 """
 We split the whole data into training and test set.
 Inputs: data and split ratio.
-Output : Train and Test data.
+Output : Train and Test data. Slices of EncodedDataset share its token buffers.
 """
 def split_train_test(data,train_ratio=0.95):
     part = int(len(data) * train_ratio)
@@ -0,0 +1,144 @@
+"""
+Random access into movie_lines.txt.
+The file is memory-mapped and a compact index of sorted numeric line ids with (offset,length)
+of every line is kept as one int64 array, so any line can be found with a binary search.
+This lets conversations be resolved lazily: only the lines they refer to are decoded and tokenized,
+instead of keeping tokens of every line of the corpus in a dictionary.
+"""
+import os
+import mmap
+import logging
+
+import numpy as np
+
+import utils
+from . import corpus_cache
+
+log = logging.getLogger("line_index")
+
+LINES_FILE = "movie_lines.txt"
+SEPARATOR = b"+++$+++"
+
+
+class LineIndex:
+    """
+    index is (N,3) array of (numeric line id, offset, length) rows sorted by id.
+    Lines are tokenized by the shared utils.TOKENIZER, which is built once per process.
+    """
+    def __init__(self, path, index, tokenizer=utils.TOKENIZER):
+        self.path = path
+        self.index = index
+        self.tokenizer = tokenizer
+        self.ids = index[:, 0]
+        with open(path, "rb") as f:
+            #Empty files can't be mapped.
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if os.path.getsize(path) else b""
+
+    def __len__(self):
+        return len(self.index)
+
+    def get_entry(self, line_id):
+        """
+        Raw bytes of the line with given id (like 'L1045') or None if there is no such line.
+        """
+        num = _parse_id(line_id)
+        if num is None:
+            return None
+        pos = int(np.searchsorted(self.ids, num))
+        if pos == len(self.ids) or self.ids[pos] != num:
+            return None
+        _, offset, length = self.index[pos]
+        return self.mm[offset:offset + length]
+
+    def get_text(self, line_id):
+        entry = self.get_entry(line_id)
+        if entry is None:
+            return None
+        fields = str(entry, encoding="utf-8", errors="ignore").split(SEPARATOR.decode())
+        return fields[4].strip()
+
+    def get_tokens(self, line_id):
+        text = self.get_text(line_id)
+        if text is None:
+            return None
+        return self.tokenizer.tokenize(text)
+
+    def lines(self):
+        """
+        Dictionary-like view which tokenizes lines on access.
+        It can be passed to low_level_cornell.load_conversations() instead of read_phrases() result.
+        """
+        return LazyLines(self)
+
+
+class LazyLines:
+    """
+    Mapping of line id to its tokens which tokenizes lines only when they are asked for.
+    Lines without any token are reported as missing, the same as read_phrases() drops them.
+    The last looked up line is remembered, so 'if id in lines: lines[id]' tokenizes it just once.
+    """
+    def __init__(self, line_index):
+        self.line_index = line_index
+        self.last = (None, None)
+
+    def _lookup(self, line_id):
+        if self.last[0] != line_id:
+            self.last = (line_id, self.line_index.get_tokens(line_id))
+        return self.last[1]
+
+    def __contains__(self, line_id):
+        return bool(self._lookup(line_id))
+
+    def __getitem__(self, line_id):
+        tokens = self._lookup(line_id)
+        if not tokens:
+            raise KeyError(line_id)
+        return tokens
+
+    def __len__(self):
+        return len(self.line_index)
+
+
+def _parse_id(line_id):
+    if isinstance(line_id, bytes):
+        line_id = str(line_id, encoding="utf-8", errors="ignore")
+    if len(line_id) < 2 or line_id[0] != "L" or not line_id[1:].isdigit():
+        return None
+    return int(line_id[1:])
+
+
+"""
+Scans the file once and returns the sorted (id,offset,length) array.
+Lines with ids which are not like 'L<number>' are skipped.
+"""
+def build(path):
+    rows = []
+    offset = 0
+    with open(path, "rb") as f:
+        for line in f:
+            num = _parse_id(line.split(SEPARATOR, 1)[0].strip())
+            if num is not None:
+                rows.append((num, offset, len(line)))
+            offset += len(line)
+    index = np.array(rows, dtype=np.int64).reshape(-1, 3)
+    return index[np.argsort(index[:, 0], kind="stable")]
+
+
+"""
+Returns the LineIndex of movie_lines.txt in data_dir.
+The index array is stored in cache_dir under a name made of size and mtime of the file,
+and is memory-mapped from there on later calls.
+"""
+def load(data_dir, cache_dir=corpus_cache.CACHE_DIR):
+    path = os.path.join(data_dir, LINES_FILE)
+    if cache_dir is None:
+        return LineIndex(path, build(path))
+    st = os.stat(path)
+    index_path = os.path.join(cache_dir, "line_index_%d_%d.npy" % (st.st_size, st.st_mtime_ns))
+    if not os.path.isfile(index_path):
+        log.info("Building line index of %s", path)
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_path = "%s.tmp%d.npy" % (index_path[:-4], os.getpid())
+        np.save(tmp_path, build(path))
+        os.replace(tmp_path, index_path)
+    return LineIndex(path, np.load(index_path, mmap_mode="r"))
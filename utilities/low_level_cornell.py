@@ -1,16 +1,23 @@
 import os
+import operator
+from concurrent.futures import ProcessPoolExecutor
 """
 Logging provides a set of convenience functions for simple logging usage.
 These are debug(), info(), warning(), error() and critical().
 """
 import logging
 import utils
+from . import genre_index, line_index, corpus_cache
 """
 getLogger() returns a reference to a logger instance with the specified name if it is provided, or root if not
 """
 log = logging.getLogger("cornell")
 DATA_DIR = "./cornell"
 SEPARATOR = "+++$+++"
+#Every worker of parallel read_phrases gets this many byte-range chunks on average to balance the load.
+CHUNKS_PER_WORKER = 4
+#Size of blocks read by iterate_columns.
+READ_CHUNK_SIZE = 1 << 22
 
 """
 Using this function we open the file from the directory.
@@ -23,53 +30,136 @@ an iterable list and returned using yield.
 def iterate_entries(data_dir,text_file):
     with open(os.path.join(data_dir,text_file),"rb") as f:
         for each in f:
-            each = str(each,encoding="utf-8",errors="ignore")
-            yield list(map(str.strip,each.split(SEPARATOR)))
+            yield _split_entry(each)
+
+def _split_entry(line):
+    line = str(line,encoding="utf-8",errors="ignore")
+    return list(map(str.strip,line.split(SEPARATOR)))
+
+"""
+Faster alternative to iterate_entries for callers which need only some of the columns.
+The file is read in large blocks which are decoded(with errors="ignore") and split at once,
+only the requested fields are stripped. Yields tuple of those fields for every line.
+"""
+def iterate_columns(data_dir,text_file,columns,chunk_size=READ_CHUNK_SIZE):
+    with open(os.path.join(data_dir,text_file),"rb") as f:
+        tail = b""
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            data = tail + chunk
+            #Incomplete last line is kept for the next block.
+            end = data.rfind(b"\n") + 1
+            tail = data[end:]
+            yield from split_columns(data[:end],columns)
+        if tail:
+            yield from split_columns(tail,columns)
+
+"""
+Splits a buffer of complete lines and yields tuples of the requested columns.
+Whole buffer is decoded at once: the decoder never swallows ASCII bytes into an invalid
+sequence, so newlines and separators stay where they were in the bytes.
+"""
+def split_columns(data,columns):
+    #Splitting one field further keeps the last requested one clean of the following columns.
+    max_split = max(columns) + 1
+    lines = str(data,encoding="utf-8",errors="ignore").split("\n")
+    #Buffer ending with a newline gives one empty string at the end.
+    if lines and not lines[-1]:
+        lines.pop()
+    pick = operator.itemgetter(*columns)
+    strip = str.strip
+    for line in lines:
+        fields = pick(line.split(SEPARATOR,max_split))
+        if len(columns) == 1:
+            yield (strip(fields),)
+        else:
+            yield tuple(map(strip,fields))
 
 """
 This function gives out the set of movies which has the genre that we
-requested.
+requested. Queries combining several genres like 'comedy AND romance' or
+'horror OR thriller' are supported as well, see genre_index.GenreIndex.query().
 """
-def get_filtered_set(data_dir,genre_filter):
-    movies = set()
-    for each in iterate_entries(data_dir,"movie_titles_metadata.txt"):
-        m_id = each[0]
-        m_genres = each[5]
-        #'.find()' finds first occurence of specified value.
-        #Returns -1 if not found.
-        if m_genres.find(genre_filter) != -1:
-            movies.add(m_id)
-    return movies
+def get_filtered_set(data_dir,genre_filter,cache_dir=corpus_cache.CACHE_DIR):
+    return genre_index.load(data_dir,cache_dir).query(genre_filter)
 
 """
 movies_line.txt has line_id,movie_id,speaker_name and movie_dialogue.
 We just access the movie dialogue and tokenize it.
 Our output is a dictionary for which keys are dialogue_id and values are phrase tokens.
-"""
-def read_phrases(data_dir,movies=None):
+With workers > 1 the file is split into byte ranges which are tokenized in a process pool.
+Chunks are merged in file order, so the result is the same as with a single worker.
+If byte_ranges is given, only these (start,end) parts of the file are read.
+"""
+def read_phrases(data_dir,movies=None,workers=1,byte_ranges=None):
+    path = os.path.join(data_dir,"movie_lines.txt")
+    if byte_ranges is None:
+        if workers <= 1:
+            return _tokenize_entries(iterate_columns(data_dir,"movie_lines.txt",(0,2,4)),movies)
+        byte_ranges = chunk_ranges(path,workers*CHUNKS_PER_WORKER)
+    ranges = list(byte_ranges)
     out = {}
-    for each in iterate_entries(data_dir,"movie_lines.txt"):
-        dialogue_id = each[0]
-        m_id = each[2]
-        dialogue = each[4]
+    if workers <= 1:
+        for byte_range in ranges:
+            out.update(_read_phrases_chunk(path,byte_range,movies))
+        return out
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        #map() returns results in the order of ranges, no matter which chunk finished first.
+        for chunk in pool.map(_read_phrases_chunk,[path]*len(ranges),ranges,[movies]*len(ranges)):
+            out.update(chunk)
+    return out
+
+def _tokenize_entries(entries,movies):
+    dialogue_ids = []
+    dialogues = []
+    for dialogue_id,m_id,dialogue in entries:
         #If it doesn't find the filtered genre and movie id,
         #it goes to the top level loop ignoring next lines.
         if movies and m_id not in movies:
             continue
-        tokens = utils.tokenize(dialogue)
+        dialogue_ids.append(dialogue_id)
+        dialogues.append(dialogue)
+    out = {}
+    for dialogue_id,tokens in zip(dialogue_ids,utils.TOKENIZER.tokenize_many(dialogues)):
         if tokens:
             out[dialogue_id] = tokens
     return out
 
+def _read_phrases_chunk(path,byte_range,movies):
+    start, end = byte_range
+    with open(path,"rb") as f:
+        f.seek(start)
+        data = f.read(end-start)
+    return _tokenize_entries(split_columns(data,(0,2,4)),movies)
+
+"""
+Splits the file into (start,end) byte ranges of roughly the same size.
+Every range begins right after a newline, so no line is cut in two.
+"""
+def chunk_ranges(path,count):
+    size = os.path.getsize(path)
+    bounds = [0]
+    with open(path,"rb") as f:
+        for i in range(1,count):
+            f.seek(max(size*i//count,bounds[-1]))
+            #Skip the rest of the current line.
+            f.readline()
+            pos = min(f.tell(),size)
+            if pos > bounds[-1]:
+                bounds.append(pos)
+    if bounds[-1] < size:
+        bounds.append(size)
+    return list(zip(bounds,bounds[1:]))
+
 """
 movie_conversations.txt has a list of the line_ids which make a conversation together.
 """
 
 def load_conversations(data_dir,lines,movies=None):
     out = []
-    for each in iterate_entries(data_dir,"movie_conversations.txt"):
-        m_id = each[2]
-        convo = each[3]
+    for m_id,convo in iterate_columns(data_dir,"movie_conversations.txt",(2,3)):
         if movies and m_id not in movies:
             continue
         #Take them out of list.
@@ -88,18 +178,30 @@ def load_conversations(data_dir,lines,movies=None):
 """
 Data_dir can also be given as an argument, if different.
 genre_filter is optional as well.
+workers is the no. of processes used to tokenize the lines.
+With lazy=True lines are looked up in the memory-mapped line index and only the lines
+used by conversations get tokenized, which saves memory of the full lines dictionary.
+Genre and line indices are kept in cache_dir, None builds them in memory only.
 load_dialogues loads dialogues from cornell dataset.
 Returns list of list of list of words.
 
 """
-def load_dialogues(data_dir=DATA_DIR, genre_filter=''):
+def load_dialogues(data_dir=DATA_DIR, genre_filter='', workers=1, lazy=False, cache_dir=corpus_cache.CACHE_DIR):
     filter_movie = None
+    byte_ranges = None
     if genre_filter:
-        filter_movie = get_filtered_set(data_dir,genre_filter)
+        index = genre_index.load(data_dir,cache_dir)
+        filter_movie = index.query(genre_filter)
+        #Only lines of these movies will be read from movie_lines.txt.
+        byte_ranges = index.ranges_for(filter_movie)
         log.info("Loaded %d movies belonging to %s genre",len(filter_movie),genre_filter)
-    log.info("Reading and tokenizing phrases...")
-    lines = read_phrases(data_dir, movies=filter_movie)
-    log.info("Loaded %d phrases",len(lines))
+    if lazy:
+        lines = line_index.load(data_dir,cache_dir).lines()
+        log.info("Indexed %d phrases, they will be tokenized on demand",len(lines))
+    else:
+        log.info("Reading and tokenizing phrases...")
+        lines = read_phrases(data_dir, movies=filter_movie, workers=workers, byte_ranges=byte_ranges)
+        log.info("Loaded %d phrases",len(lines))
     dialogues = load_conversations(data_dir,lines,filter_movie)
     return dialogues
 
@@ -107,14 +209,8 @@ def load_dialogues(data_dir=DATA_DIR, genre_filter=''):
 Takes data directory as input and gives out a dictionary of
 movie ids mapped to their respective genres.
 """
-def read_genres(data_dir):
-    out = {}
-    for each in iterate_entries(data_dir, "movie_titles_metadata.txt"):
-        m_id, m_genres = each[0], each[5]
-        l_genres = m_genres.strip("[]").split(", ")
-        l_genres = list(map(lambda s: s.strip("'"), l_genres))
-        out[m_id] = l_genres
-    return out
+def read_genres(data_dir,cache_dir=corpus_cache.CACHE_DIR):
+    return {m_id: list(l_genres) for m_id, l_genres in genre_index.load(data_dir,cache_dir).movie_genres.items()}
 
 
 #print(read_genres('./cornell'))
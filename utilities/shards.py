@@ -0,0 +1,179 @@
+"""
+Sharded binary format for encoded phrase pairs.
+The exporter splits training pairs into N shards with the same no. of pairs. Every shard is one file
+with a small header, int64 offsets and flat int32 token buffers of phrases and replies, so readers
+memory-map it and never load the whole corpus. Several training processes can each stream
+their own subset of shards (shard index modulo world size equals process rank).
+Test pairs are exported into a separate shard, so training from shards needs no raw corpus.
+"""
+import os
+import json
+import struct
+import logging
+import argparse
+
+import numpy as np
+
+log = logging.getLogger("shards")
+
+MAGIC = b"RLCS"
+FORMAT_VERSION = 1
+#Magic, version, count of pairs, count of phrase tokens, count of reply tokens.
+HEADER = struct.Struct("<4sIQQQ")
+INDEX_NAME = "shards.json"
+SHARD_NAME = "shard_%05d.bin"
+TEST_NAME = "test.bin"
+
+"""
+Writes one shard file from list of (phrase,reply) pairs of token IDs.
+"""
+def write_shard(path, pairs):
+    phrase_offsets = np.zeros(len(pairs) + 1, dtype=np.int64)
+    reply_offsets = np.zeros(len(pairs) + 1, dtype=np.int64)
+    np.cumsum([len(p1) for p1, _ in pairs], out=phrase_offsets[1:])
+    np.cumsum([len(p2) for _, p2 in pairs], out=reply_offsets[1:])
+    phrases = np.fromiter((t for p1, _ in pairs for t in p1), dtype=np.int32, count=int(phrase_offsets[-1]))
+    replies = np.fromiter((t for _, p2 in pairs for t in p2), dtype=np.int32, count=int(reply_offsets[-1]))
+    with open(path, "wb") as f:
+        f.write(HEADER.pack(MAGIC, FORMAT_VERSION, len(pairs), len(phrases), len(replies)))
+        for arr in (phrase_offsets, reply_offsets, phrases, replies):
+            f.write(arr.tobytes())
+
+"""
+Splits pairs into num_shards shards, which sizes differ by one pair at most, and writes them
+together with an index file into out_dir. Count of shards is rounded up to a multiple of world_size,
+so every process reads the same count of shards and of pairs(up to one pair per shard).
+Pairs of test_pairs are written into one separate shard, which is not given to ShardReader ranks.
+"""
+def export_shards(out_dir, pairs, num_shards, world_size=1, test_pairs=None):
+    assert num_shards > 0 and world_size > 0
+    num_shards = -(-num_shards // world_size) * world_size
+    os.makedirs(out_dir, exist_ok=True)
+    bounds = np.linspace(0, len(pairs), num_shards + 1).round().astype(np.int64)
+    names = []
+    for idx in range(num_shards):
+        name = SHARD_NAME % idx
+        write_shard(os.path.join(out_dir, name), pairs[bounds[idx]:bounds[idx + 1]])
+        names.append(name)
+    index = {"version": FORMAT_VERSION, "pairs": len(pairs), "shards": names}
+    if test_pairs is not None:
+        write_shard(os.path.join(out_dir, TEST_NAME), test_pairs)
+        index["test"] = TEST_NAME
+    with open(os.path.join(out_dir, INDEX_NAME), "w", encoding="utf-8") as f:
+        json.dump(index, f, indent=2)
+    log.info("Exported %d pairs into %d shards in %s", len(pairs), len(names), out_dir)
+    return names
+
+"""
+Returns list of test pairs exported with the shards in data_dir, None if they were not exported.
+"""
+def load_test_pairs(data_dir):
+    with open(os.path.join(data_dir, INDEX_NAME), "r", encoding="utf-8") as f:
+        index = json.load(f)
+    if "test" not in index:
+        return None
+    shard = Shard(os.path.join(data_dir, index["test"]))
+    return [shard[idx] for idx in range(len(shard))]
+
+class Shard:
+    """
+    Memory-mapped shard file. Pairs are returned as lists of token IDs,
+    the same as high_level_cornell.encode_phrase_pairs() produces.
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            magic, version, count, n_phrase, n_reply = HEADER.unpack(f.read(HEADER.size))
+        if magic != MAGIC or version != FORMAT_VERSION:
+            raise ValueError("%s is not a shard file of version %d" % (path, FORMAT_VERSION))
+        offset = HEADER.size
+        self.phrase_offsets = np.memmap(path, dtype=np.int64, mode="r", offset=offset, shape=(count + 1,))
+        offset += 8 * (count + 1)
+        self.reply_offsets = np.memmap(path, dtype=np.int64, mode="r", offset=offset, shape=(count + 1,))
+        offset += 8 * (count + 1)
+        #np.memmap doesn't accept zero-sized arrays.
+        self.phrases = np.memmap(path, dtype=np.int32, mode="r", offset=offset, shape=(n_phrase,)) \
+            if n_phrase else np.zeros(0, dtype=np.int32)
+        offset += 4 * n_phrase
+        self.replies = np.memmap(path, dtype=np.int32, mode="r", offset=offset, shape=(n_reply,)) \
+            if n_reply else np.zeros(0, dtype=np.int32)
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, idx):
+        p1 = self.phrases[self.phrase_offsets[idx]:self.phrase_offsets[idx + 1]]
+        p2 = self.replies[self.reply_offsets[idx]:self.reply_offsets[idx + 1]]
+        return p1.tolist(), p2.tolist()
+
+
+class ShardReader:
+    """
+    Streams pairs from the shards which belong to given rank out of world_size processes.
+    Every epoch the order of own shards and the order of pairs inside every shard
+    are shuffled with a generator seeded by seed and epoch, so runs are reproducible.
+    """
+    def __init__(self, data_dir, rank=0, world_size=1, seed=0):
+        assert 0 <= rank < world_size
+        with open(os.path.join(data_dir, INDEX_NAME), "r", encoding="utf-8") as f:
+            index = json.load(f)
+        if index["version"] != FORMAT_VERSION:
+            raise ValueError("Unsupported shards version %s" % index["version"])
+        #Otherwise some processes would get one shard more than the others.
+        if len(index["shards"]) % world_size:
+            raise ValueError("%d shards can't be split evenly between %d processes, export them with "
+                             "--world-size %d" % (len(index["shards"]), world_size, world_size))
+        self.data_dir = data_dir
+        self.names = index["shards"][rank::world_size]
+        self.seed = seed
+        self.rank = rank
+
+    def __len__(self):
+        return sum(len(Shard(os.path.join(self.data_dir, name))) for name in self.names)
+
+    def iterate(self, epoch=0, shuffle=True):
+        #Rank is mixed into the seed, so processes don't shuffle in lockstep.
+        rand = np.random.RandomState([self.seed, epoch, self.rank])
+        order = rand.permutation(len(self.names)) if shuffle else range(len(self.names))
+        for shard_idx in order:
+            shard = Shard(os.path.join(self.data_dir, self.names[shard_idx]))
+            indices = rand.permutation(len(shard)) if shuffle else range(len(shard))
+            for idx in indices:
+                yield shard[idx]
+
+    def iterate_batches(self, batch_size, epoch=0, shuffle=True):
+        """
+        Batches of pairs like high_level_cornell.iterate_batches(), the last batch with
+        a single pair is dropped the same way.
+        """
+        batch = []
+        for pair in self.iterate(epoch, shuffle):
+            batch.append(pair)
+            if len(batch) == batch_size:
+                yield batch
+                batch = []
+        if len(batch) > 1:
+            yield batch
+
+
+if __name__ == "__main__":
+    from . import high_level_cornell
+
+    logging.basicConfig(format="%(asctime)-15s %(levelname)s %(message)s", level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Export training pairs into binary shards")
+    parser.add_argument("--data", required=True, help="Genre to export. Empty string to export full dataset")
+    parser.add_argument("-o", "--out", required=True, help="Directory to write shards into")
+    parser.add_argument("--shards", type=int, default=8, help="Count of shards")
+    parser.add_argument("--world-size", type=int, default=1,
+                        help="Count of training processes, count of shards is rounded up to its multiple")
+    parser.add_argument("--lazy", action="store_true", default=False, help="Tokenize only the lines used by conversations, to save memory")
+    args = parser.parse_args()
+
+    train_data, emb_dict = high_level_cornell.load_encoded_data(genre_filter=args.data, lazy=args.lazy)
+    #Same shuffle and split as the training scripts do, test pairs go into their own shard.
+    rand = np.random.RandomState(high_level_cornell.SHUFFLE_SEED)
+    train_data.shuffle(rand)
+    train_data, test_data = high_level_cornell.split_train_test(train_data)
+    export_shards(args.out, train_data, args.shards, args.world_size, test_pairs=list(test_data))
+    high_level_cornell.save_emb_dict(args.out, emb_dict)
@@ -0,0 +1,168 @@
+"""
+Building and storing the dictionary which maps words to their integer IDs.
+IDs are assigned in one pass over the word counts: special tokens first, then words by descending
+frequency. Frequent words get small IDs, so hot rows of the embedding and of the output layer
+stay together in memory, and cheap output-layer tricks can cut the vocabulary by ID.
+Trained models keep their dictionary in the binary format of Vocabulary, which loads with one mmap.
+"""
+import mmap
+import struct
+import hashlib
+import collections
+import collections.abc
+import logging
+
+import numpy as np
+
+log = logging.getLogger("vocabulary")
+
+BINARY_MAGIC = b"RLVB"
+BINARY_VERSION = 1
+#Magic, version, count of words, reserved, size of string table.
+BINARY_HEADER = struct.Struct("<4sIIIQ")
+
+
+class VocabularyBuilder:
+    """
+    Counts words of tokenized phrases and builds the frequency-ordered dictionary.
+    """
+    def __init__(self):
+        self.counts = collections.Counter()
+
+    def update(self, tokens):
+        self.counts.update(tokens)
+
+    def update_dialogues(self, dialogues):
+        for dialogue in dialogues:
+            for phrase in dialogue:
+                self.counts.update(phrase)
+
+    def frequent_words(self, min_token_frequency):
+        """
+        Words which occur at least min_token_frequency times ordered by descending count,
+        ties keep the order in which the words were first seen.
+        Only lowercase words can be looked up(encode_words() lowercases every token),
+        so cased tokens like the emoticon ':D' are left out.
+        """
+        return [word for word, count in self.counts.most_common()
+                if count >= min_token_frequency and word == word.lower()]
+
+    def build(self, min_token_frequency, special_tokens):
+        out = {}
+        for word in special_tokens:
+            out[word] = len(out)
+        for word in self.frequent_words(min_token_frequency):
+            if word not in out:
+                out[word] = len(out)
+        return out
+
+
+class Vocabulary(collections.abc.Mapping):
+    """
+    Read-only word -> ID mapping backed by one binary file which is memory-mapped as a whole,
+    so loading costs a constant no. of syscalls regardless of the vocabulary size.
+    Layout after the header: int64 offsets of every word in the string table(ID order, one extra
+    at the end), int32 IDs sorted by the UTF-8 bytes of their words, and the string table itself
+    with words separated by newlines. Words are looked up by binary search over the sorted IDs.
+    """
+    def __init__(self, buf):
+        magic, version, count, _, table_size = BINARY_HEADER.unpack_from(buf, 0)
+        if magic != BINARY_MAGIC or version != BINARY_VERSION:
+            raise ValueError("Not a vocabulary file of version %d" % BINARY_VERSION)
+        self.buf = buf
+        self.count = count
+        pos = BINARY_HEADER.size
+        view = memoryview(buf)
+        self.offsets = view[pos:pos + 8 * (count + 1)].cast("q")
+        pos += 8 * (count + 1)
+        self.sorted_ids = view[pos:pos + 4 * count].cast("i")
+        pos += 4 * count
+        self.table_pos = pos
+        self.table_size = table_size
+        self._words = None
+
+    @classmethod
+    def from_dict(cls, emb_dict):
+        return cls(serialize(emb_dict))
+
+    @classmethod
+    def load(cls, path):
+        with open(path, "rb") as f:
+            return cls(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+    def save(self, path):
+        with open(path, "wb") as f:
+            f.write(self.buf)
+
+    def word_bytes(self, idx):
+        return self.buf[self.table_pos + self.offsets[idx]:self.table_pos + self.offsets[idx + 1] - 1]
+
+    def __getitem__(self, word):
+        key = word.encode("utf-8") if isinstance(word, str) else None
+        if key is None:
+            raise KeyError(word)
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.word_bytes(self.sorted_ids[mid]) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.count and self.word_bytes(self.sorted_ids[lo]) == key:
+            return self.sorted_ids[lo]
+        raise KeyError(word)
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        return iter(self.words.tolist())
+
+    @property
+    def words(self):
+        """
+        ID -> word array, the string table is decoded once on the first access.
+        """
+        if self._words is None:
+            table = bytes(self.buf[self.table_pos:self.table_pos + self.table_size])
+            self._words = np.array(str(table, encoding="utf-8").split("\n")[:-1], dtype=object)
+        return self._words
+
+    def decode(self, indices, unknown_word):
+        """
+        Words of the given IDs, gathered from the ID -> word array.
+        IDs outside of the vocabulary become unknown_word.
+        """
+        indices = np.asarray(indices, dtype=np.int64).reshape(-1)
+        valid = (indices >= 0) & (indices < self.count)
+        out = self.words[np.where(valid, indices, 0)]
+        out[~valid] = unknown_word
+        return out.tolist()
+
+
+"""
+Serializes word -> ID dictionary with contiguous IDs into the format read by Vocabulary.
+"""
+def serialize(emb_dict):
+    words = sorted(emb_dict, key=emb_dict.get)
+    assert [emb_dict[w] for w in words] == list(range(len(words))), "IDs have to be contiguous"
+    encoded = [w.encode("utf-8") for w in words]
+    offsets = np.zeros(len(words) + 1, dtype=np.int64)
+    np.cumsum([len(w) + 1 for w in encoded], out=offsets[1:])
+    sorted_ids = np.array(sorted(range(len(words)), key=encoded.__getitem__), dtype=np.int32)
+    table = b"".join(w + b"\n" for w in encoded)
+    return b"".join([BINARY_HEADER.pack(BINARY_MAGIC, BINARY_VERSION, len(words), 0, len(table)),
+                     offsets.tobytes(), sorted_ids.tobytes(), table])
+
+
+"""
+SHA-1 of the words in ID order, which identifies the dictionary a model was trained with.
+A plain dictionary and Vocabulary with the same words and IDs have the same fingerprint.
+"""
+def fingerprint(emb_dict):
+    if isinstance(emb_dict, Vocabulary):
+        table = emb_dict.buf[emb_dict.table_pos:emb_dict.table_pos + emb_dict.table_size]
+    else:
+        words = sorted(emb_dict, key=emb_dict.get)
+        table = b"".join(w.encode("utf-8") + b"\n" for w in words)
+    return hashlib.sha1(table).hexdigest()
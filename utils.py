@@ -1,14 +1,56 @@
-from nltk.tokenize import TweetTokenizer
+from nltk.tokenize import TweetTokenizer, casual
 from nltk.translate import bleu_score
+import regex
 import string
 
+class Tokenizer:
+    """
+    Lowercasing tweet tokenizer which is built once and reused for every phrase.
+    The fast path runs the same precompiled regular expressions as
+    TweetTokenizer(preserve_case=False), but skips the work which can't change
+    the result: HTML entities are only replaced if there is '&' in the text, and
+    emoticon check is done only for words which lowercasing would change.
+    With fast=False every call goes to nltk, output is the same in both modes.
+    """
+    def __init__(self, fast=True):
+        self.fast = fast
+        self.nltk_tokenizer = TweetTokenizer(preserve_case=False)
+        #Newer nltk versions keep phone numbers in a separate list of patterns.
+        patterns = getattr(casual, "REGEXPS_PHONE", casual.REGEXPS)
+        self.word_re = regex.compile("(%s)" % "|".join(patterns), regex.VERBOSE | regex.I | regex.UNICODE)
+
+    def tokenize(self, s):
+        if not self.fast:
+            return self.nltk_tokenizer.tokenize(s)
+        if "&" in s:
+            s = casual._replace_html_entities(s)
+        #Shorten problematic sequences of characters.
+        s = casual.HANG_RE.sub(r"\1\1\1", s)
+        out = []
+        for word in self.word_re.findall(s):
+            low = word.lower()
+            #Emoticons like :D keep their case.
+            if low != word and casual.EMOTICON_RE.search(word):
+                low = word
+            out.append(low)
+        return out
+
+    def tokenize_many(self, strings):
+        """
+        Tokenizes every string from the iterable, returns list of token lists.
+        """
+        tokenize = self.tokenize
+        return [tokenize(s) for s in strings]
+
+#Shared instance used by tokenize().
+TOKENIZER = Tokenizer()
+
 """
 We give a sentence and it tokenizes it.
-When we set preserve_case to False it will downcase the string.
-It is True by default.
+Tokens are lowercased, the same as TweetTokenizer with preserve_case set to False does.
 """
 def tokenize(s):
-    return TweetTokenizer(preserve_case=False).tokenize(s)
+    return TOKENIZER.tokenize(s)
 
 """
 Input : candidate sequence should be provided as a list of tokens and